@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""Writes the closed months of the measures, not archived yet, to the
+columnar archive (see libcitizenwatt/archive.py).
+
+worker.py does it before deleting the expired measures when the "archive"
+setting is enabled, this is for a first export or a manual one.
+
+Usage: archive_measures.py
+"""
+
+import sys
+
+from libcitizenwatt import archive
+from libcitizenwatt import database
+from libcitizenwatt.config import Config
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+
+# Configuration
+config = Config()
+
+# DB initialization
+database_url = (config.get("database_type") + "://" + config.get("username") +
+                ":" + config.get("password") + "@" + config.get("host") + "/" +
+                config.get("database"))
+engine = create_engine(database_url, echo=config.get("debug"))
+db = sessionmaker(bind=engine)()
+
+if len(sys.argv) > 1:
+    sys.exit(__doc__)
+
+count = archive.registry.export(db)
+print("Archived " + str(count) + " measures to " + config.get("archive_path") +
+      ".")
+for sensor in db.query(database.Sensor).all():
+    months = archive.registry.months(sensor.id)
+    if months:
+        print(sensor.name + ": " + archive.month_name(months[0]) + " to " +
+              archive.month_name(months[-1]))
+db.close()
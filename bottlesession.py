@@ -48,8 +48,11 @@ def authenticator(session_manager, login_url='/auth/login'):
     return(valid_user)
 
 
+import collections
+import json
 import pickle
 import os
+import threading
 import uuid
 
 
@@ -74,14 +77,15 @@ class BaseSession(object):
         return str(uuid.uuid4())
 
     def allocate_new_session_id(self):
-        #  retry allocating a unique sessionid
-        for i in range(100):
-            sessionid = self.make_session_id()
-            if not self.load(sessionid):
-                return sessionid
-        raise ValueError('Unable to allocate unique session')
+        #  uuid4 has 122 random bits, no need to probe the store for
+        #  collisions
+        return self.make_session_id()
 
     def get_session(self):
+        #  loaded once per request
+        if 'bottlesession.session' in bottle.request.environ:
+            return bottle.request.environ['bottlesession.session']
+
         #  get existing or create new session identifier
         sessionid = bottle.request.cookies.get('sessionid')
         if not sessionid:
@@ -90,12 +94,12 @@ class BaseSession(object):
                 'sessionid', sessionid, path='/',
                 expires=(int(time.time()) + self.cookie_expires))
 
-        #  load existing or create new session
+        #  load existing or create new session, only stored once saved
         data = self.load(sessionid)
         if not data:
             data = {'sessionid': sessionid, 'valid': False}
-            self.save(data)
 
+        bottle.request.environ['bottlesession.session'] = data
         return data
 
 
@@ -113,6 +117,9 @@ class PickleSession(BaseSession):
         filename = os.path.join(self.session_dir, 'session-%s' % sessionid)
         if not os.path.exists(filename):
             return None
+        if os.path.getmtime(filename) + self.cookie_expires < time.time():
+            os.remove(filename)
+            return None
         with open(filename, 'rb') as fp:
             session = pickle.load(fp)
         return session
@@ -126,6 +133,63 @@ class PickleSession(BaseSession):
         os.rename(tmpName, fileName)
 
 
+class RedisSession(BaseSession):
+    '''Class which stores session information in Redis, as JSON.  Sessions
+    expire with their cookie.
+
+    :param connection: Redis connection (a :class:`redis.Redis`).
+    :param prefix: Prefix of the keys of the sessions.
+            (default: ``'session:'``).
+    '''
+    def __init__(self, connection, prefix='session:', *args, **kwargs):
+        super(RedisSession, self).__init__(*args, **kwargs)
+        self.connection = connection
+        self.prefix = prefix
+
+    def load(self, sessionid):
+        session = self.connection.get(self.prefix + sessionid)
+        if session is None:
+            return None
+        return json.loads(session)
+
+    def save(self, data):
+        self.connection.setex(self.prefix + data['sessionid'],
+                              self.cookie_expires, json.dumps(data))
+
+
+class MemorySession(BaseSession):
+    '''Class which stores session information in the memory of the process,
+    keeping the ``max_sessions`` most recently used ones.  Sessions expire
+    with their cookie, and are lost when the process exits.
+
+    :param max_sessions: Number of sessions kept.  (default: 1024).
+    '''
+    def __init__(self, max_sessions=1024, *args, **kwargs):
+        super(MemorySession, self).__init__(*args, **kwargs)
+        self.max_sessions = max_sessions
+        self.sessions = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, sessionid):
+        with self.lock:
+            if sessionid not in self.sessions:
+                return None
+            expires, session = self.sessions[sessionid]
+            if expires < time.time():
+                del self.sessions[sessionid]
+                return None
+            self.sessions.move_to_end(sessionid)
+            return dict(session)
+
+    def save(self, data):
+        with self.lock:
+            self.sessions[data['sessionid']] = (
+                time.time() + self.cookie_expires, dict(data))
+            self.sessions.move_to_end(data['sessionid'])
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+
 class CookieSession(BaseSession):
     '''Session manager class which stores session in a signed browser cookie.
 
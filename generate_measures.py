@@ -9,30 +9,12 @@ import math
 from libcitizenwatt import database
 from libcitizenwatt import tools
 from libcitizenwatt.config import Config
+from libcitizenwatt.ingestion import MeasuresBuffer
+from libcitizenwatt.tariffs import NightRateSchedule
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 
-def get_rate_type(db):
-    """Returns "day" or "night" according to current time
-    """
-    user = db.query(database.User).filter_by(is_admin=1).first()
-    now = datetime.datetime.now()
-    now = 3600 * now.hour + 60 * now.minute
-    if user is None:
-        return -1
-    elif user.end_night_rate > user.start_night_rate:
-        if now > user.start_night_rate and now < user.end_night_rate:
-            return 1
-        else:
-            return 0
-    else:
-        if now > user.start_night_rate or now < user.end_night_rate:
-            return 1
-        else:
-            return 0
-
-
 # Configuration
 config = Config()
 
@@ -43,6 +25,8 @@ database_url = (config.get("database_type") + "://" + config.get("username") + "
 engine = create_engine(database_url, echo=config.get("debug"))
 create_session = sessionmaker(bind=engine)
 database.Base.metadata.create_all(engine)
+schedule = NightRateSchedule(create_session)
+buffer = MeasuresBuffer(create_session)
 
 try:
     while True:
@@ -54,18 +38,15 @@ try:
         sensor = (db.query(database.Sensor)
                   .filter_by(name="CitizenWatt")
                   .first())
+        db.close()
         if not sensor:
             tools.warning("Got packet "+str(power)+" but install is not " +
                           "complete ! Visit http://citizenwatt first.")
-            db.close()
         else:
             now = datetime.datetime.now().timestamp()
-            measure_db = database.Measures(sensor_id=sensor.id,
-                                           value=power,
-                                           timestamp=now,
-                                           night_rate=get_rate_type(db))
-            db.add(measure_db)
-            db.commit()
+            buffer.add(sensor.id, power, now, schedule.rate_type(),
+                       sensor.last_timer)
+            buffer.flush()
             print(now)
             print("Saved successfully.")
         time.sleep(8)
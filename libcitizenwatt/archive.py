@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Columnar archive of the measures of the closed months.
+
+Each archived month of a sensor is a directory of the "archive_path"
+setting, <sensor>/YYYY-MM (UTC months), holding one file per column of
+its measures, sorted by timestamp, as fixed-width values:
+
+* timestamp: int32 (so until 2038)
+* value: float32
+* night_rate: int8 (-1 when unknown)
+
+They are read with numpy.memmap, so that the long-range aggregations of
+cache.py scale with the disk rather than with the memory, without any SQL.
+A month is archived once closed and never written again.
+"""
+import array
+import calendar
+import datetime
+import numpy
+import os
+import shutil
+import threading
+
+from libcitizenwatt import database
+from libcitizenwatt import partitions
+from libcitizenwatt import tools
+from libcitizenwatt.config import Config
+from sqlalchemy import asc, func
+
+
+config = Config()
+
+COLUMNS = [("timestamp", numpy.int32),
+           ("value", numpy.float32),
+           ("night_rate", numpy.int8)]
+
+
+def month_name(start):
+    """Returns the name of the directory of the month starting at
+    <start>.
+    """
+    date = datetime.datetime.utcfromtimestamp(start)
+    return "%04d-%02d" % (date.year, date.month)
+
+
+def name_start(name):
+    """Returns the start of the month of the directory <name>, or None if
+    it is not the name of a month.
+    """
+    try:
+        date = datetime.datetime.strptime(name, "%Y-%m")
+    except ValueError:
+        return None
+    return calendar.timegm((date.year, date.month, 1, 0, 0, 0))
+
+
+class Archive():
+    """Columnar archive of the measures.
+
+    The memory maps of the archived months are kept open, as they never
+    change.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.maps = {}
+
+    def path(self, sensor, start=None):
+        """Returns the directory of the archive of <sensor>, or of its month
+        starting at <start>.
+        """
+        path = os.path.join(os.path.expanduser(config.get("archive_path")),
+                            str(sensor))
+        if start is not None:
+            path = os.path.join(path, month_name(start))
+        return path
+
+    def months(self, sensor):
+        """Returns the sorted list of the starts of the archived months of
+        <sensor>.
+        """
+        try:
+            names = os.listdir(self.path(sensor))
+        except FileNotFoundError:
+            return []
+        return sorted([i for i in [name_start(name) for name in names]
+                       if i is not None])
+
+    def end(self, sensor):
+        """Returns the end of the last archived month of <sensor>, 0 if
+        none is archived. The measures before it are in the archive.
+        """
+        months = self.months(sensor)
+        if not months:
+            return 0
+        return partitions.next_month(months[-1])
+
+    def write(self, db, sensor, start, chunk_size=10000):
+        """Archives the measures of <sensor> in the month starting at
+        <start>.
+
+        Returns the number of archived measures.
+        """
+        end = partitions.next_month(start)
+        source = partitions.registry.source(db, sensor, start, end)
+        rows = (db.query(source.c.timestamp,
+                         source.c.value,
+                         source.c.night_rate)
+                .filter(source.c.sensor_id == sensor,
+                        source.c.timestamp >= start,
+                        source.c.timestamp < end)
+                .order_by(asc(source.c.timestamp), asc(source.c.id))
+                .yield_per(chunk_size))
+        columns = [array.array(numpy.dtype(dtype).char)
+                   for column, dtype in COLUMNS]
+        for row in rows:
+            for index, value in enumerate(row):
+                columns[index].append(value or 0)
+
+        # Written aside, then renamed, so that readers only see whole months
+        path = self.path(sensor, start)
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for index, (column, dtype) in enumerate(COLUMNS):
+            with open(os.path.join(tmp_path, column), "wb") as fh:
+                columns[index].tofile(fh)
+        os.rename(tmp_path, path)
+        return len(columns[0])
+
+    def export(self, db):
+        """Archives the closed months of all the sensors not archived yet.
+        If a month fails to be archived, the next months of its sensor wait
+        for the next export.
+
+        Returns the number of archived measures.
+        """
+        # The last batch of a month can be written after its end
+        now = (datetime.datetime.now().timestamp() -
+               config.get("batch_max_latency") - 1)
+        count = 0
+        for sensor in db.query(database.Sensor).all():
+            start = self.end(sensor.id)
+            if not start:
+                source = partitions.registry.source(db, sensor.id)
+                first = (db.query(func.min(source.c.timestamp))
+                         .filter(source.c.sensor_id == sensor.id)
+                         .scalar())
+                if first is None:
+                    continue
+                start = partitions.month_start(first)
+            while partitions.next_month(start) <= now:
+                try:
+                    count += self.write(db, sensor.id, start)
+                except Exception as e:
+                    db.rollback()
+                    tools.warning("Unable to archive " + month_name(start) +
+                                  " of sensor " + str(sensor.id) + ": " +
+                                  str(e))
+                    break
+                start = partitions.next_month(start)
+        return count
+
+    def column(self, sensor, start, column, dtype):
+        """Returns the memory map of <column> of the month of <sensor>
+        starting at <start>.
+        """
+        path = os.path.join(self.path(sensor, start), column)
+        with self.lock:
+            if path not in self.maps:
+                if os.path.getsize(path) == 0:
+                    self.maps[path] = numpy.zeros(0, dtype=dtype)
+                else:
+                    self.maps[path] = numpy.memmap(path, dtype=dtype,
+                                                   mode="r")
+            return self.maps[path]
+
+    def columns(self, sensor, time1, time2):
+        """Returns the (timestamps, values, night_rates) arrays of the
+        archived measures of <sensor> with a timestamp in [<time1>,
+        <time2>[.
+        """
+        parts = [[] for i in COLUMNS]
+        for start in self.months(sensor):
+            if partitions.next_month(start) <= time1 or start >= time2:
+                continue
+            timestamps = self.column(sensor, start, *COLUMNS[0])
+            first, last = numpy.searchsorted(timestamps, [time1, time2])
+            for index, (column, dtype) in enumerate(COLUMNS):
+                parts[index].append(
+                    self.column(sensor, start, column, dtype)[first:last])
+        return [numpy.concatenate(parts[index]) if parts[index]
+                else numpy.zeros(0, dtype=dtype)
+                for index, (column, dtype) in enumerate(COLUMNS)]
+
+
+registry = Archive()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+import base64
+import hashlib
+import os
+import threading
+import time
+
+
+def new_token():
+    """Returns a new random API token."""
+    return base64.urlsafe_b64encode(os.urandom(32)).decode("ascii").rstrip("=")
+
+
+def hash_token(token):
+    """Returns the hash of an API token, as stored in database.ApiToken.
+
+    The tokens are random, hence a salt is not needed.
+    """
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class VerifiedCredentials():
+    """In-memory cache of the API credentials verified recently, so that the
+    API calls of a script polling the base do not query the database on
+    each call.
+
+    A credential is trusted for <lifetime> seconds after being verified.
+    They are all forgotten when a "credentials" invalidation (a password
+    changed or a token revoked) is received from `cache.invalidate`.
+    """
+    def __init__(self, listener=None, lifetime=300):
+        self.listener = listener
+        self.lifetime = lifetime
+        self.lock = threading.Lock()
+        self.verified = {}
+
+    def invalidate(self):
+        with self.lock:
+            self.verified = {}
+
+    def check(self, key, verify):
+        """Returns True if the credential <key> was verified less than
+        <lifetime> seconds ago, or if verify() returns True now.
+        """
+        now = time.time()
+        with self.lock:
+            if (self.listener is not None and
+                    self.listener.changed("credentials")):
+                self.verified = {}
+            if self.verified.get(key, 0) > now:
+                return True
+        if not verify():
+            return False
+        with self.lock:
+            # Drops the expired ones, so that the cache stays small
+            if len(self.verified) > 1024:
+                self.verified = dict([(i, expires) for i, expires in
+                                      self.verified.items() if expires > now])
+            self.verified[key] = now + self.lifetime
+        return True
+
+
+verified_credentials = VerifiedCredentials()
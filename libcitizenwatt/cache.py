@@ -1,19 +1,428 @@
 #!/usr/bin/env python3
 
-import bisect
 import datetime
 import json
 import numpy
 import redis
 
-from libcitizenwatt import database
+from libcitizenwatt import archive
+from libcitizenwatt import partitions
+from libcitizenwatt import ringbuffer
+from libcitizenwatt import rollups
+from libcitizenwatt import tariffs
 from libcitizenwatt import tools
-from sqlalchemy import asc, desc
+from sqlalchemy import asc
 from libcitizenwatt.config import Config
+from libcitizenwatt.ingestion import last_seq
 
 
 config = Config()
 
+if config.get("redis_socket"):
+    pool = redis.ConnectionPool(
+        connection_class=redis.UnixDomainSocketConnection,
+        path=config.get("redis_socket"),
+        db=config.get("redis_db"),
+        decode_responses=True)
+else:
+    pool = redis.ConnectionPool(host=config.get("redis_host"),
+                                port=config.get("redis_port"),
+                                db=config.get("redis_db"),
+                                decode_responses=True)
+
+
+def get_redis():
+    """
+    Returns a Redis client using the connection pool shared by the whole
+    process.
+    """
+    return redis.Redis(connection_pool=pool)
+
+
+def fetch_many(keys):
+    """
+    Fetches several cache keys in a single round trip.
+
+    Returns the list of the stored data, None for the missing keys.
+    """
+    if not keys:
+        return []
+    return [json.loads(i) if i is not None else None
+            for i in get_redis().mget(keys)]
+
+
+def store_many(items):
+    """
+    Stores several (key, data, lifetime) in a single pipeline. The
+    lifetime is in seconds, None to keep the data until evicted.
+    """
+    pipe = get_redis().pipeline(transaction=False)
+    for key, data, lifetime in items:
+        if lifetime is None:
+            pipe.set(key, json.dumps(data))
+        else:
+            pipe.set(key, json.dumps(data), ex=max(1, int(lifetime)))
+    pipe.execute()
+
+
+def fetch(key):
+    """
+    Returns the data stored under <key>, or None.
+    """
+    return fetch_many([key])[0]
+
+
+def store(key, data, lifetime):
+    """
+    Stores <data> under <key> for <lifetime> seconds.
+    """
+    store_many([(key, data, lifetime)])
+
+
+# Pub/sub channel used to notify the other processes of settings changes
+INVALIDATION_CHANNEL = "citizenwatt_invalidations"
+# Topic returned by InvalidationListener when notifications may have been lost
+ALL = "*"
+
+
+def invalidate(topic):
+    """
+    Notifies the other processes that the data behind <topic> (e.g.
+    "night_rate") changed and should be loaded again.
+    """
+    r = get_redis()
+    try:
+        if topic in GENERATIONS:
+            r.incr(GENERATION_PREFIX + topic)
+        r.publish(INVALIDATION_CHANNEL, topic)
+    except redis.ConnectionError:
+        tools.warning("Unable to publish invalidation of " + topic + ".")
+
+
+class InvalidationListener():
+    """
+    Non-blocking listener for the notifications sent by invalidate().
+    """
+    def __init__(self):
+        self.pubsub = None
+
+    def poll(self, timeout=0):
+        """
+        Returns the set of topics invalidated since the last call, waiting
+        for up to <timeout> seconds for a first one.
+
+        If Redis is not reachable, returns {ALL} as notifications may have
+        been missed.
+        """
+        topics = set()
+        try:
+            if self.pubsub is None:
+                r = get_redis()
+                self.pubsub = r.pubsub(ignore_subscribe_messages=True)
+                self.pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Nothing is known of what happened before subscribing
+                topics.add(ALL)
+            message = self.pubsub.get_message(timeout=timeout)
+            while message:
+                topics.add(message["data"])
+                message = self.pubsub.get_message()
+        except redis.ConnectionError:
+            self.pubsub = None
+            topics.add(ALL)
+        return topics
+
+    def changed(self, topic):
+        """
+        Returns True if <topic> was (or may have been) invalidated since the
+        last call.
+        """
+        topics = self.poll()
+        return topic in topics or ALL in topics
+
+
+# Prefix of all the cache keys, and version of the format of the cached data
+# (to be bumped whenever it changes)
+KEY_PREFIX = "citizenwatt"
+KEY_VERSION = 2
+# Generation counters, bumped to invalidate the cache entries depending on
+# them. "data:<sensor>" and "tail:<sensor>" are per sensor.
+GENERATION_PREFIX = KEY_PREFIX + ":generation:"
+GENERATIONS = ["providers"]
+# Hash of the lookups and misses counts, per kind of API call
+STATS_KEY = KEY_PREFIX + ":stats"
+
+
+def new_measures(measures):
+    """
+    Invalidates the open cache entries of the sensors which just got new
+    measures, as dicts with sensor_id and timestamp keys, and notifies
+    worker.py so that it computes them again.
+
+    A measure written late, e.g. a batch restored after a failed write, can
+    fall in entries already cached as closed: all the entries of its sensor
+    are then invalidated.
+    """
+    pipe = get_redis().pipeline(transaction=False)
+    for sensor_id in set([i["sensor_id"] for i in measures]):
+        pipe.incr(GENERATION_PREFIX + "tail:" + str(sensor_id))
+    for sensor_id in set([i["sensor_id"] for i in measures
+                          if is_closed(i["timestamp"])]):
+        pipe.incr(GENERATION_PREFIX + "data:" + str(sensor_id))
+    pipe.publish(INVALIDATION_CHANNEL, "measures")
+    try:
+        pipe.execute()
+    except redis.ConnectionError:
+        tools.warning("Unable to invalidate the cache of the new measures.")
+
+
+# Pub/sub channel of the new measures of a sensor, followed by its id
+MEASURES_CHANNEL = "citizenwatt_measures:"
+
+
+def publish_measures(measures):
+    """
+    Publishes new measures, as dicts with sensor_id, value, timestamp and
+    night_rate keys, to the clients of /api/<sensor>/stream.
+
+    The last measure of each sensor is also kept, to be sent first to the
+    new clients.
+    """
+    pipe = get_redis().pipeline(transaction=False)
+    for measure in measures:
+        if measure["night_rate"] == 1:
+            rate = "night"
+        elif measure["night_rate"] == 0:
+            rate = "day"
+        else:
+            rate = None
+        message = json.dumps({"data": measure, "rate": rate})
+        pipe.publish(MEASURES_CHANNEL + str(measure["sensor_id"]), message)
+        pipe.set(KEY_PREFIX + ":last_measure:" + str(measure["sensor_id"]),
+                 message)
+    try:
+        pipe.execute()
+    except redis.ConnectionError:
+        tools.warning("Unable to publish the new measures.")
+
+
+def invalidate_sensor(sensor):
+    """
+    Invalidates all the cache entries of <sensor>, to be called when its
+    stored measures are modified or deleted.
+    """
+    try:
+        get_redis().incr(GENERATION_PREFIX + "data:" + str(sensor))
+    except redis.ConnectionError:
+        tools.warning("Unable to invalidate the cache of sensor " +
+                      str(sensor) + ".")
+
+
+def is_closed(time2):
+    """
+    Returns True if no new measure can have a timestamp lower than <time2>,
+    i.e. if all the buffered measures up to <time2> were written.
+    """
+    return (time2 + config.get("batch_max_latency") + 1 <
+            datetime.datetime.now().timestamp())
+
+
+def last_id(db, sensor):
+    """
+    Returns the id of the last stored measure of <sensor>, 0 if it has no
+    measures.
+
+    It is read from the ring buffer of the sensor if any, else looked up by
+    the position of the measure, on the (sensor_id, seq) index, rather than
+    with a max(id) over all the measures.
+    """
+    recent = ringbuffer.registry.positions(sensor, -1, 0)
+    if recent is not None and recent[1]:
+        return recent[1][-1].id
+    seq = last_seq(db, sensor)
+    if not seq:
+        return 0
+    source = partitions.registry.source(db, sensor)
+    return (db.query(source.c.id)
+            .filter(source.c.sensor_id == sensor,
+                    source.c.seq == seq)
+            .limit(1)
+            .scalar()) or 0
+
+
+class CacheEntry():
+    """
+    Cache entry of an API call on the measures of a sensor.
+
+    Its key, e.g. "citizenwatt:2:1:watts:by_time:1400000000.0:1400003600.0:g0",
+    holds the generation counters of all it depends on, so that bumping a
+    counter invalidates exactly the affected entries:
+
+    * "data:<sensor>", for all the entries of the sensor,
+    * "tail:<sensor>", for the open entries, i.e. the ones new measures of
+    the sensor may fall in,
+    * "providers", for the entries in euros.
+
+    The night rate is stored with each measure, hence its changes only
+    apply to the new measures.
+    """
+    def __init__(self, kind, sensor, watt_euros, params, is_open):
+        self.kind = kind
+        self.is_open = is_open
+        generations = ["data:" + str(sensor)]
+        if is_open:
+            generations.append("tail:" + str(sensor))
+        if watt_euros == "euros":
+            generations.append("providers")
+        generations = get_redis().mget([GENERATION_PREFIX + i
+                                        for i in generations])
+        self.key = ":".join([KEY_PREFIX, str(KEY_VERSION), str(sensor),
+                             watt_euros, kind] +
+                            [str(i) for i in params] +
+                            ["g" + ".".join([i or "0" for i in generations])])
+
+    def fetch(self):
+        """
+        Returns the data stored in this entry, or None.
+        """
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.get(self.key)
+        pipe.hincrby(STATS_KEY, self.kind + ":lookups")
+        data = pipe.execute()[0]
+        if data is None:
+            return None
+        return json.loads(data)
+
+    def store(self, data, miss=True):
+        """
+        Stores <data> in this entry. Open entries only live until worker.py
+        computes them again, as they will soon be invalidated, closed ones
+        for cache_lifetime.
+        """
+        if self.is_open:
+            lifetime = (config.get("precompute_interval") +
+                        config.get("batch_max_latency"))
+        else:
+            lifetime = config.get("cache_lifetime")
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.set(self.key, json.dumps(data), ex=max(1, int(lifetime)))
+        if miss:
+            pipe.hincrby(STATS_KEY, self.kind + ":misses")
+        pipe.execute()
+
+
+def cache_stats():
+    """
+    Returns the number of lookups, misses and the hit rate of the cache,
+    per kind of API call.
+    """
+    stats = {}
+    for field, count in get_redis().hgetall(STATS_KEY).items():
+        kind, name = field.split(":")
+        stats.setdefault(kind, {"lookups": 0, "misses": 0})[name] = int(count)
+    for kind in stats.values():
+        if kind["lookups"]:
+            kind["hit_rate"] = 1 - kind["misses"] / kind["lookups"]
+        else:
+            kind["hit_rate"] = None
+    return stats
+
+
+def query_measures(db, source):
+    """
+    Returns a query on the columns of the measures used by the API, from
+    <source> (see partitions.Partitions.source).
+
+    Rows are returned as lightweight named tuples, instead of ORM objects
+    tracked by the session.
+    """
+    return db.query(source.c.id,
+                    source.c.timestamp,
+                    source.c.value,
+                    source.c.night_rate,
+                    source.c.seq)
+
+
+def filter_positions(query, source, sensor, id1, id2, last):
+    """
+    Filters <query> on the measures of <sensor> from <source> at positions
+    [<id1>, <id2>[ from the end (<id1>, <id2> <= 0), as in Python lists,
+    <last> being the seq of the last measure of the sensor (see
+    ingestion.last_seq).
+
+    The positions are resolved with an index seek on (sensor_id, seq), so
+    that deep positions cost the same as the recent ones.
+    """
+    return (query
+            .filter(source.c.sensor_id == sensor,
+                    source.c.seq > last + id1,
+                    source.c.seq <= last + id2)
+            .order_by(asc(source.c.seq)))
+
+
+def recent_positions(db, sensor, id1, id2):
+    """
+    Returns (last, measures), <measures> being the measures of <sensor> at
+    positions [<id1>, <id2>[ from the end, as in filter_positions, and
+    <last> the position of its last measure.
+
+    They are read from the ring buffer of the sensor if it holds them (see
+    ringbuffer.py), from the database otherwise.
+    """
+    recent = ringbuffer.registry.positions(sensor, id1, id2)
+    if recent is not None:
+        return recent
+    source = partitions.registry.source(db, sensor)
+    last = last_seq(db, sensor)
+    return last, filter_positions(query_measures(db, source), source,
+                                  sensor, id1, id2, last).all()
+
+
+def measures_to_dict(measures, sensor):
+    """
+    Returns a JSON representation of the measures returned by
+    query_measures, with the same fields as tools.to_dict.
+    """
+    return [{"id": i.id,
+             "sensor_id": sensor,
+             "value": i.value,
+             "timestamp": i.timestamp,
+             "night_rate": i.night_rate} for i in measures]
+
+
+def energies_to_watt_euros(energies, watt_euros, duration, db):
+    """
+    Converts a list of energies (see tools.energy, None for empty groups)
+    to the unit asked in the API call, each group lasting <duration> seconds.
+    <duration> can also be the list of the durations of the groups.
+    """
+    if watt_euros == "euros":
+        slopes = tariffs.provider_tariffs.get(0, db)
+    if isinstance(duration, list):
+        durations = duration
+    else:
+        durations = [duration for i in energies]
+
+    data = []
+    for energy, duration in zip(energies, durations):
+        if energy is None:
+            data.append(None)
+            continue
+
+        if watt_euros == "watts":
+            tmp_data = {"value": energy["value"] / duration * 1000 * 3600,
+                        "day_rate": energy["day_rate"] / duration * 1000 * 3600,
+                        "night_rate": energy["night_rate"] / duration * 1000 * 3600}
+        elif watt_euros == 'kwatthours':
+            tmp_data = energy
+        elif watt_euros == 'euros':
+            if slopes is None:
+                tmp_data = {"value": None}
+            else:
+                tmp_data = {"value": (slopes["night"] * energy["night_rate"] +
+                                      slopes["day"] * energy["day_rate"])}
+        data.append(tmp_data)
+    return data
+
 
 def do_cache_ids(sensor, watt_euros, id1, id2, db, force_refresh=False):
     """
@@ -22,36 +431,30 @@ def do_cache_ids(sensor, watt_euros, id1, id2, db, force_refresh=False):
 
     Returns the stored (or computed) data or None if parameters are invalid.
     """
-    r = redis.Redis(decode_responses=True)
+    entry = CacheEntry("by_id", sensor, watt_euros, [id1, id2],
+                       id2 <= 0 or id2 > last_id(db, sensor))
     if not force_refresh:
-        data = r.get(watt_euros + "_" + str(sensor) + "_" + "by_id" + "_" +
-                     str(id1) + "_" + str(id2))
+        data = entry.fetch()
         if data:
             # If found in cache, return it
-            return json.loads(data)
+            return data
 
+    source = partitions.registry.source(db, sensor)
     if id1 >= 0 and id2 >= 0 and id2 >= id1:
-        data = (db.query(database.Measures)
-                .filter(database.Measures.sensor_id == sensor,
-                        database.Measures.id >= id1,
-                        database.Measures.id < id2)
-                .order_by(asc(database.Measures.timestamp))
+        data = (query_measures(db, source)
+                .filter(source.c.sensor_id == sensor,
+                        source.c.id >= id1,
+                        source.c.id < id2)
+                .order_by(asc(source.c.timestamp))
                 .all())
     elif id1 <= 0 and id2 <= 0 and id2 >= id1:
-        data = (db.query(database.Measures)
-                .filter_by(sensor_id=sensor)
-                .order_by(desc(database.Measures.timestamp))
-                .slice(-id2, -id1)
-                .all())
-        data.reverse()
+        last, data = recent_positions(db, sensor, id1, id2)
     else:
         return None
 
     if not data:
         data = None
     else:
-        time1 = data[0].timestamp
-        time2 = data[-1].timestamp
         if watt_euros == 'kwatthours' or watt_euros == 'euros':
             data = tools.energy(data)
             if watt_euros == 'euros':
@@ -71,13 +474,10 @@ def do_cache_ids(sensor, watt_euros, id1, id2, db, force_refresh=False):
                     day_rate = 0
                 data = {"value": night_rate + day_rate}
         else:
-            data = tools.to_dict(data)
+            data = measures_to_dict(data, sensor)
 
     # Store in cache
-    r.set(watt_euros + "_" + str(sensor) + "_" + "by_id" + "_" +
-          str(id1) + "_" + str(id2),
-          json.dumps(data),
-          time2 - time1)
+    entry.store(data, not force_refresh)
 
     return data
 
@@ -91,94 +491,53 @@ def do_cache_group_id(sensor, watt_euros, id1, id2, step, db,
 
     Returns the stored (or computed) data.
     """
-    r = redis.Redis(decode_responses=True)
+    entry = CacheEntry("by_id_step", sensor, watt_euros,
+                       [id1, id2, step, timestep],
+                       id2 <= 0 or id2 > last_id(db, sensor))
     if not force_refresh:
-        data = r.get(watt_euros + "_" + str(sensor) + "_" + "by_id" + "_" +
-                     str(id1) + "_" + str(id2) + "_" +
-                     str(step) + "_" + str(timestep))
+        data = entry.fetch()
         if data:
             # If found in cache, return it
-            return json.loads(data)
+            return data
 
     steps = [i for i in range(id1, id2, step)]
     steps.append(id2)
 
+    source = partitions.registry.source(db, sensor)
     if id1 >= 0 and id2 >= 0 and id2 >= id1:
-        data = (db.query(database.Measures)
-                .filter(database.Measures.sensor_id == sensor,
-                        database.Measures.id >= id1,
-                        database.Measures.id < id2)
-                .order_by(asc(database.Measures.timestamp))
+        data = (query_measures(db, source)
+                .filter(source.c.sensor_id == sensor,
+                        source.c.id >= id1,
+                        source.c.id < id2)
+                .order_by(asc(source.c.timestamp))
                 .all())
     elif id1 <= 0 and id2 <= 0 and id2 >= id1:
-        data = (db.query(database.Measures)
-                .filter_by(sensor_id=sensor)
-                .order_by(desc(database.Measures.timestamp))
-                .slice(-id2, -id1)
-                .all())
-        data.reverse()
+        last, data = recent_positions(db, sensor, id1, id2)
     else:
         raise ValueError
 
-    time2 = None
     if not data:
         data = [None for i in range(len(steps) - 1)]
     else:
-        time1 = data[0].timestamp
-        time2 = data[-1].timestamp
-        data_dict = tools.to_dict(data)
-        tmp = [[] for i in range(len(steps) - 1)]
-        for i in data_dict:
-            tmp[bisect.bisect_left(steps, i["id"]) - 1].append(i)
-
-        data = []
-        for i in tmp:
-            if len(i) == 0:
-                data.append(None)
-                continue
-
-            energy = tools.energy(i)
-            if watt_euros == "watts":
-                tmp_data = {"value": energy["value"] / (step * timestep) * 1000 * 3600,
-                            "day_rate": energy["day_rate"] / (step * timestep) * 1000 * 3600,
-                            "night_rate": energy["night_rate"] / (step * timestep) * 1000 * 3600}
-            elif watt_euros == 'kwatthours':
-                tmp_data = energy
-            elif watt_euros == 'euros':
-                if energy["night_rate"] != 0:
-                    night_rate = tools.watt_euros(0,
-                                                  'night',
-                                                  energy['night_rate'],
-                                                  db)
-                else:
-                    night_rate = 0
-                if energy["day_rate"] != 0:
-                    day_rate = tools.watt_euros(0,
-                                                'day',
-                                                energy['day_rate'],
-                                                db)
-                else:
-                    day_rate = 0
-                tmp_data = {"value": night_rate + day_rate}
-            data.append(tmp_data)
+        if id1 >= 0:
+            ids = [i.id for i in data]
+        else:
+            # Position of the measures from the end, as in Python lists
+            ids = [i.seq - last - 1 for i in data]
+        groups = numpy.searchsorted(steps, ids, side="left") - 1
+        groups = numpy.clip(groups, 0, len(steps) - 2)
+        energies = tools.energy_groups([i.timestamp for i in data],
+                                       [i.value for i in data],
+                                       [i.night_rate for i in data],
+                                       groups,
+                                       len(steps) - 1)
+        data = energies_to_watt_euros(energies, watt_euros, step * timestep,
+                                      db)
     if len(data) == 0:
         data = None
-    if time2 is not None:
-        # Store in cache
-        if time2 < datetime.datetime.now().timestamp():
-            # If new measures are to come, short lifetime (basically timestep)
-            r.set(watt_euros + "_" + str(sensor) + "_" + "by_id" + "_" +
-                str(id1) + "_" + str(id2) + "_" +
-                str(step) + "_" + str(timestep),
-                json.dumps(data),
-                timestep)
-        else:
-            # Else, store for a greater lifetime (basically time2 - time1)
-            r.set(watt_euros + "_" + str(sensor) + "_" + "by_id" + "_" +
-                str(id1) + "_" + str(id2) + "_" +
-                str(step) + "_" + str(timestep),
-                json.dumps(data),
-                time2 - time1)
+
+    # Store in cache
+    entry.store(data, not force_refresh)
 
     return data
 
@@ -189,20 +548,24 @@ def do_cache_times(sensor, watt_euros, time1, time2, db, force_refresh=False):
     /api/<sensor:int>/get/<watt_euros:re:watts|kwatthours|euros>/by_time/<time1:float>/<time2:float>
     Returns the stored (or computed) data.
     """
-    r = redis.Redis(decode_responses=True)
+    entry = CacheEntry("by_time", sensor, watt_euros, [time1, time2],
+                       not is_closed(time2))
     if not force_refresh:
-        data = r.get(watt_euros + "_" + str(sensor) + "_" + "by_time" + "_" +
-                     str(time1) + "_" + str(time2))
+        data = entry.fetch()
         if data:
             # If found in cache, return it
-            return json.loads(data)
-
-    data = (db.query(database.Measures)
-            .filter(database.Measures.sensor_id == sensor,
-                    database.Measures.timestamp >= time1,
-                    database.Measures.timestamp < time2)
-            .order_by(asc(database.Measures.timestamp))
-            .all())
+            return data
+
+    # The recent measures are read from the ring buffer of the sensor
+    data = ringbuffer.registry.times(sensor, time1, time2)
+    if data is None:
+        source = partitions.registry.source(db, sensor, time1, time2)
+        data = (query_measures(db, source)
+                .filter(source.c.sensor_id == sensor,
+                        source.c.timestamp >= time1,
+                        source.c.timestamp < time2)
+                .order_by(asc(source.c.timestamp))
+                .all())
 
     if not data:
         data = None
@@ -220,97 +583,193 @@ def do_cache_times(sensor, watt_euros, time1, time2, db, force_refresh=False):
                                                    db))}
 
         else:
-            data = tools.to_dict(data)
+            data = measures_to_dict(data, sensor)
 
     # Store in cache
-    r.set(watt_euros + "_" + str(sensor) + "_" + "by_id" + "_" +
-          str(time1) + "_" + str(time2),
-          json.dumps(data),
-          int(time2) - int(time1))
+    entry.store(data, not force_refresh)
 
     return data
 
 
+def bucket_key(sensor, start, end, generation):
+    """
+    Returns the cache key of the energy of <sensor> in [<start>, <end>[, for
+    the "data:<sensor>" generation <generation>.
+    """
+    return ":".join([KEY_PREFIX, str(KEY_VERSION), str(sensor), "bucket",
+                     str(float(start)), str(float(end)), "g" + generation])
+
+
+def measure_columns(db, sensor, time1, time2):
+    """
+    Returns the (timestamps, values, night_rates) arrays of the measures of
+    <sensor> with a timestamp in [<time1>, <time2>[, sorted by timestamp.
+
+    The archived months are read from the columnar archive (see
+    archive.py), the others from the database.
+    """
+    end = archive.registry.end(sensor)
+    timestamps, values, night_rates = archive.registry.columns(
+        sensor, time1, min(time2, end))
+    if time2 > end:
+        time1 = max(time1, end)
+        source = partitions.registry.source(db, sensor, time1, time2)
+        data = (query_measures(db, source)
+                .filter(source.c.sensor_id == sensor,
+                        source.c.timestamp >= time1,
+                        source.c.timestamp < time2)
+                .order_by(asc(source.c.timestamp))
+                .all())
+        timestamps = numpy.concatenate([timestamps,
+                                        [i.timestamp for i in data]])
+        values = numpy.concatenate([values, [i.value for i in data]])
+        night_rates = numpy.concatenate([night_rates,
+                                         [i.night_rate for i in data]])
+    return timestamps, values, night_rates
+
+
+def compute_energies(sensor, steps, db):
+    """
+    Returns the energy of <sensor> in each [steps[k], steps[k + 1][ bucket,
+    from the rollup tables if they fit the steps, else from the measures.
+    """
+    energies = rollups.group(db, sensor, steps)
+    if energies is not None:
+        return energies
+
+    timestamps, values, night_rates = measure_columns(db, sensor, steps[0],
+                                                      steps[-1])
+    groups = numpy.searchsorted(steps, timestamps, side="right") - 1
+    return tools.energy_groups(timestamps,
+                               values,
+                               night_rates,
+                               groups,
+                               len(steps) - 1)
+
+
+def bucket_energies(sensor, steps, db, force_refresh=False, count=True):
+    """
+    Returns the energy of <sensor> in each [steps[k], steps[k + 1][ bucket,
+    as a list of tools.energy dicts (None for the empty buckets).
+
+    The buckets which are closed (see is_closed) are cached on their own,
+    so that they are computed once whatever the range asked. Only the
+    missing ones and the open tail are computed, with a single query.
+
+    The lookups are only counted in the stats if <count> is True.
+    """
+    r = get_redis()
+    generation = r.get(GENERATION_PREFIX + "data:" + str(sensor)) or "0"
+    nb_buckets = len(steps) - 1
+    keys = [bucket_key(sensor, steps[k], steps[k + 1], generation)
+            for k in range(nb_buckets) if is_closed(steps[k + 1])]
+
+    if force_refresh:
+        cached = [None for i in keys]
+    else:
+        cached = fetch_many(keys)
+    energies = cached + [None for i in range(nb_buckets - len(keys))]
+    missing = [k for k in range(nb_buckets)
+               if k >= len(keys) or cached[k] is None]
+
+    if missing:
+        first = missing[0]
+        last = missing[-1] + 1
+        computed = compute_energies(sensor, steps[first:last + 1], db)
+        items = []
+        for k in missing:
+            energies[k] = computed[k - first]
+            if k < len(keys):
+                # Empty buckets are stored as {}, to tell them from the
+                # missing keys
+                items.append((keys[k], energies[k] or {},
+                              config.get("cache_lifetime")))
+        if items:
+            store_many(items)
+
+    if keys and count and not force_refresh:
+        pipe = r.pipeline(transaction=False)
+        pipe.hincrby(STATS_KEY, "bucket:lookups", len(keys))
+        pipe.hincrby(STATS_KEY, "bucket:misses",
+                     len([i for i in cached if i is None]))
+        pipe.execute()
+
+    return [i or None for i in energies]
+
+
+# Units of the API calls
+WATT_EUROS = ["watts", "kwatthours", "euros"]
+
+
+def aligned_entry(sensor, watt_euros, steps, align):
+    """
+    Returns the CacheEntry of a by_time call with a step, whose buckets
+    <steps> are aligned on <align>. Such calls are shared by all the clients
+    (see tools.aligned_steps), whatever their exact time1 and time2.
+    """
+    return CacheEntry("by_time_step", sensor, watt_euros,
+                      [align, steps[0], steps[-1], len(steps) - 1],
+                      not is_closed(steps[-1]))
+
+
 def do_cache_group_timestamp(sensor, watt_euros, time1, time2, step, db,
-                             force_refresh=True):
+                             align=None, force_refresh=False):
     """
     Computes the cache (if needed) for the API call
     /api/<sensor:int>/get/<watt_euros:re:watts|kwatthours|euros>/by_time/<time1:float>/<time2:float>/<step:float>
 
+    If <align> is one of tools.ALIGN_UNITS, the bounds of the buckets are
+    snapped to this unit (see tools.aligned_steps), so that they are the same
+    for all the clients, and the whole response is cached. Otherwise, only
+    the energies are cached, per bucket (see bucket_energies).
+
     Returns the stored (or computed) data.
     """
-    r = redis.Redis(decode_responses=True)
-    if not force_refresh:
-        data = r.get(watt_euros + "_" + str(sensor) + "_" + "by_time" + "_" +
-                     str(time1) + "_" + str(time2) + "_" + str(step))
-        if data:
-            # If found in cache, return it
-            return json.loads(data)
-
-    steps = [i for i in numpy.arange(time1, time2, step)]
-    steps.append(time2)
-
-    data = (db.query(database.Measures)
-            .filter(database.Measures.sensor_id == sensor,
-                    database.Measures.timestamp
-                    .between(time1, time2))
-            .order_by(asc(database.Measures.timestamp))
-            .all())
+    entry = None
+    if align is not None:
+        steps = tools.aligned_steps(time1, time2, step, align)
+        durations = numpy.diff(steps).tolist()
+        if len(steps) >= 2:
+            entry = aligned_entry(sensor, watt_euros, steps, align)
+        if entry is not None and not force_refresh:
+            data = entry.fetch()
+            if data:
+                # If found in cache, return it
+                return data
+    else:
+        steps = [i for i in numpy.arange(time1, time2, step)]
+        steps.append(time2)
+        durations = step
 
-    if not data:
-        data = [None for i in range(len(steps) - 1)]
+    if len(steps) < 2:
+        energies = []
     else:
-        tmp = [[] for i in range(len(steps) - 1)]
-        for i in data:
-            index = bisect.bisect_left(steps, i.timestamp)
-            if index > 0:
-                index -= 1
-            tmp[index].append(i)
-
-        data = []
-        for i in tmp:
-            if len(i) == 0:
-                data.append(None)
-                continue
-
-            energy = tools.energy(i)
-            if watt_euros == "watts":
-                tmp_data = {"value": energy["value"] / step * 1000 * 3600,
-                            "day_rate": energy["day_rate"] / step * 1000 * 3600,
-                            "night_rate": energy["night_rate"] / step * 1000 * 3600}
-            elif watt_euros == 'kwatthours':
-                tmp_data = energy
-            elif watt_euros == 'euros':
-                if energy["night_rate"] != 0:
-                    night_rate = tools.watt_euros(0,
-                                                  'night',
-                                                  energy['night_rate'],
-                                                  db)
-                else:
-                    night_rate = 0
-                if energy["day_rate"] != 0:
-                    day_rate = tools.watt_euros(0,
-                                                'day',
-                                                energy['day_rate'],
-                                                db)
-                else:
-                    day_rate = 0
-                tmp_data = {"value": night_rate + day_rate}
-            data.append(tmp_data)
+        energies = bucket_energies(sensor, steps, db, force_refresh,
+                                   entry is None)
+
+    data = energies_to_watt_euros(energies, watt_euros, durations, db)
     if len(data) == 0:
         data = None
-    # Store in cache
-    if time2 < datetime.datetime.now().timestamp():
-        # If new measures are to come, short lifetime (basically timestep)
-        r.setex(watt_euros + "_" + str(sensor) + "_" + "by_time" + "_" +
-                str(time1) + "_" + str(time2) + "_" + str(step),
-                json.dumps(data),
-                int(step))
-    else:
-        # Else, store for a greater lifetime (basically time2 - time1)
-        r.setex(watt_euros + "_" + str(sensor) + "_" + "by_time" + "_" +
-                str(time1) + "_" + str(time2) + "_" + str(step),
-                json.dumps(data),
-                int(time2 - time1))
+
+    if entry is not None:
+        # Store in cache
+        entry.store(data, not force_refresh)
 
     return data
+
+
+def precompute_group_timestamp(sensor, time1, time2, step, align, db,
+                               units=WATT_EUROS):
+    """
+    Computes the aligned by_time call with a step (see
+    do_cache_group_timestamp) in each of <units>, and stores it in the cache.
+    """
+    steps = tools.aligned_steps(time1, time2, step, align)
+    if len(steps) < 2:
+        return
+    energies = bucket_energies(sensor, steps, db, count=False)
+    durations = numpy.diff(steps).tolist()
+    for watt_euros in units:
+        data = energies_to_watt_euros(energies, watt_euros, durations, db)
+        aligned_entry(sensor, watt_euros, steps, align).store(data or None,
+                                                              False)
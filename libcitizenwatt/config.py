@@ -48,8 +48,44 @@ class Config():
         self.set("default_timestep", 8)
         self.set("port", 8080)
         self.set("autoreload", False)
+        self.set_defaults()
         self.save()
 
+    def set_defaults(self):
+        """Sets the settings added after the first release, keeping the
+        values already stored in the config file.
+
+        Returns True if some settings were missing.
+        """
+        defaults = {"batch_size": 64,
+                    "batch_max_latency": 10,
+                    "max_pending_measures": 100000,
+                    "queue_size": 1024,
+                    "redis_host": "localhost",
+                    "redis_port": 6379,
+                    "redis_db": 0,
+                    "redis_socket": "",
+                    "cache_lifetime": 7 * 24 * 3600,
+                    "precompute_interval": 60,
+                    "server_threads": 30,
+                    "max_streams": 20,
+                    "partitioning": False,
+                    "retention_raw_days": 0,
+                    "retention_1m_days": 0,
+                    "retention_1h_days": 0,
+                    "retention_1d_days": 0,
+                    "compaction_interval": 3600,
+                    "compaction_batch_size": 1000,
+                    "ring_buffer_path": "/run/shm/citizenwatt",
+                    "ring_buffer_size": 4096,
+                    "archive": True,
+                    "archive_path": "~/.local/share/citizenwatt/archive",
+                    "session_store": "redis"}
+        missing = [i for i in defaults if i not in self.config]
+        for param in missing:
+            self.set(param, defaults[param])
+        return len(missing) > 0
+
     def load(self):
         try:
             folder_exists = make_sure_path_exists(self.config_path)
@@ -70,6 +106,8 @@ class Config():
             except (ValueError, IOError):
                 tools.warning("Config file could not be read.")
                 sys.exit(1)
+            if self.set_defaults():
+                self.save()
 
     def save(self):
         try:
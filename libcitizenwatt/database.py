@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
-from sqlalchemy import Column, Float
-from sqlalchemy import ForeignKey, Integer, Text, VARCHAR
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import Column, Float, Index, inspect
+from sqlalchemy import ForeignKey, Integer, Text, UniqueConstraint, VARCHAR
+from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.orm import relationship
+from sqlalchemy.schema import CreateColumn
 
 
 Base = declarative_base()
@@ -31,6 +32,63 @@ class Measures(Base):
     value = Column(Float)
     timestamp = Column(Integer, index=True)
     night_rate = Column(Integer)  # Boolean, 1 if night_rate
+    # Position of the measure among the measures of the sensor, from 1
+    seq = Column(Integer)
+
+    # The measures are always queried for a single sensor, by timestamp,
+    # by id ranges or by position (the last ones)
+    __table_args__ = (Index("ix_measures_sensor_id_timestamp",
+                            "sensor_id", "timestamp"),
+                      Index("ix_measures_sensor_id_id", "sensor_id", "id"),
+                      Index("ix_measures_sensor_id_seq", "sensor_id", "seq"))
+
+
+class MeasuresRollup():
+    """Summary of the measures of a sensor over a period, maintained by
+    libcitizenwatt.rollups as measures arrive.
+    """
+    id = Column(Integer, primary_key=True)
+
+    @declared_attr
+    def sensor_id(cls):
+        return Column(Integer,
+                      ForeignKey("sensors.id", ondelete="CASCADE"),
+                      nullable=False)
+
+    @declared_attr
+    def __table_args__(cls):
+        return (UniqueConstraint("sensor_id", "timestamp"),)
+
+    timestamp = Column(Integer)  # Start of the period
+    # Energy (kWh) between the measures of the period, by rate
+    day_rate = Column(Float)
+    night_rate = Column(Float)
+    min_value = Column(Float)
+    max_value = Column(Float)
+    mean_value = Column(Float)
+    count = Column(Integer)
+    # First and last measures of the period, to join consecutive periods
+    first_timestamp = Column(Integer)
+    first_value = Column(Float)
+    first_night_rate = Column(Integer)
+    last_timestamp = Column(Integer)
+    last_value = Column(Float)
+    last_night_rate = Column(Integer)
+
+
+class Measures1m(MeasuresRollup, Base):
+    __tablename__ = "measures_1m"
+    period = 60
+
+
+class Measures1h(MeasuresRollup, Base):
+    __tablename__ = "measures_1h"
+    period = 3600
+
+
+class Measures1d(MeasuresRollup, Base):
+    __tablename__ = "measures_1d"
+    period = 86400
 
 
 class Provider(Base):
@@ -63,3 +121,62 @@ class User(Base):
     # Stored as seconds since beginning of day
     start_night_rate = Column(Integer)
     end_night_rate = Column(Integer)
+
+
+class ApiToken(Base):
+    __tablename__ = "api_tokens"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer,
+                     ForeignKey("users.id", ondelete="CASCADE"),
+                     nullable=False)
+    name = Column(VARCHAR(length=255))
+    # SHA-256 of the token, which is only shown once
+    token_hash = Column(VARCHAR(length=64), unique=True)
+    created = Column(Integer)  # Timestamp
+
+
+def create_missing_columns(engine):
+    """Adds the columns declared on the existing tables but missing from the
+    database, e.g. the ones added after the tables were created by
+    create_all. They are added as nullable, without default.
+
+    Returns the names of the added columns, as "table.column".
+    """
+    inspector = inspect(engine)
+    tables = inspector.get_table_names()
+    added = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = [i["name"] for i in inspector.get_columns(table.name)]
+        for column in table.columns:
+            if column.name not in existing:
+                print("Adding missing column " + table.name + "." +
+                      column.name + "…")
+                ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                engine.execute("ALTER TABLE " + table.name +
+                               " ADD COLUMN " + str(ddl))
+                added.append(table.name + "." + column.name)
+    return added
+
+
+def create_missing_indexes(engine):
+    """Creates the indexes declared on the existing tables but missing from
+    the database, e.g. the ones added after the tables were created by
+    create_all.
+
+    Returns the names of the created indexes.
+    """
+    inspector = inspect(engine)
+    tables = inspector.get_table_names()
+    created = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = [i["name"] for i in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in existing:
+                print("Creating missing index " + index.name + "…")
+                index.create(bind=engine)
+                created.append(index.name)
+    return created
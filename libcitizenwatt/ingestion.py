@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+import asyncio
+import os
+import time
+import types
+
+from libcitizenwatt import database
+from libcitizenwatt import partitions
+from libcitizenwatt import rollups
+from libcitizenwatt import tools
+from sqlalchemy import and_, asc, bindparam, or_
+from sqlalchemy.exc import SQLAlchemyError
+
+
+# Generator-based coroutines run from Python 3.4 on, asyncio.coroutine
+# being gone since Python 3.11
+coroutine = getattr(asyncio, "coroutine", None) or types.coroutine
+
+
+def last_seq(db, sensor_id):
+    """Returns the position of the last measure of a sensor, 0 if it has no
+    measures.
+    """
+    return partitions.registry.max_value(db, "seq", sensor_id) or 0
+
+
+def backfill_seq(db, chunk_size=10000):
+    """Numbers the measures stored before their position (seq) was
+    introduced, sensor by sensor, by timestamp. They are all in the measures
+    table, as they predate the partitions.
+
+    The measures are read by chunks of <chunk_size>, following the
+    (timestamp, id) order, and each chunk is committed, so that the memory
+    used does not depend on the number of measures. Measures without a
+    timestamp are numbered last, by id.
+    """
+    Measures = database.Measures
+    update = (Measures.__table__.update()
+              .where(Measures.id == bindparam("measure_id"))
+              .values(seq=bindparam("new_seq")))
+    for sensor in db.query(database.Sensor).all():
+        if (db.query(Measures.id)
+                .filter(Measures.sensor_id == sensor.id,
+                        Measures.seq == None)
+                .first() is None):
+            continue
+        print("Numbering the measures of sensor " + sensor.name + "…")
+        seq = 0
+        last = None
+        while True:
+            query = (db.query(Measures.id, Measures.timestamp)
+                     .filter(Measures.sensor_id == sensor.id,
+                             Measures.timestamp != None))
+            if last is not None:
+                query = query.filter(or_(Measures.timestamp > last[1],
+                                         and_(Measures.timestamp == last[1],
+                                              Measures.id > last[0])))
+            chunk = (query.order_by(asc(Measures.timestamp), asc(Measures.id))
+                     .limit(chunk_size).all())
+            if not chunk:
+                break
+            seq = number_chunk(db, update, chunk, seq)
+            last = chunk[-1]
+        last_id = 0
+        while True:
+            chunk = (db.query(Measures.id, Measures.timestamp)
+                     .filter(Measures.sensor_id == sensor.id,
+                             Measures.timestamp == None,
+                             Measures.id > last_id)
+                     .order_by(asc(Measures.id))
+                     .limit(chunk_size).all())
+            if not chunk:
+                break
+            seq = number_chunk(db, update, chunk, seq)
+            last_id = chunk[-1][0]
+
+
+def number_chunk(db, update, chunk, seq):
+    """Numbers the measures of <chunk> after position <seq>, and commits.
+    Returns the position of the last one.
+    """
+    db.execute(update, [{"measure_id": row[0], "new_seq": seq + i + 1}
+                        for i, row in enumerate(chunk)])
+    db.commit()
+    return seq + len(chunk)
+
+
+class MeasuresBuffer():
+    """Buffers the incoming measures and writes them to the database by
+    batches.
+
+    A batch is written with a single multi-row INSERT and one UPDATE of
+    `last_timer` per sensor, as soon as it holds `max_size` measures or its
+    oldest measure has been waiting for `max_latency` seconds.
+
+    The measures of each sensor are numbered (seq) as they are written, the
+    buffer being the only writer of the measures.
+
+    `on_write` is called with the list of measures of each batch once it is
+    committed. Its errors are only logged, as the batch is already saved.
+
+    The batches that fail to be written are kept to be retried, up to
+    `max_pending` measures (None for no limit). Past it, the oldest ones
+    are dropped.
+    """
+    def __init__(self, create_session, max_size=64, max_latency=10,
+                 on_write=None, max_pending=None):
+        self.create_session = create_session
+        self.max_size = max_size
+        self.max_latency = max_latency
+        self.on_write = on_write
+        self.max_pending = max_pending
+        self.measures = []
+        self.timers = {}
+        self.oldest = None
+        # Position of the last written measure, per sensor
+        self.last_seq = {}
+
+    def __len__(self):
+        return len(self.measures)
+
+    def add(self, sensor_id, value, timestamp, night_rate, timer):
+        """Adds a measure to the current batch."""
+        if not self.measures:
+            self.oldest = time.monotonic()
+        self.measures.append({"sensor_id": sensor_id,
+                              "value": value,
+                              "timestamp": int(round(timestamp)),
+                              "night_rate": night_rate})
+        self.timers[sensor_id] = timer
+
+    def timeout(self):
+        """Returns the number of seconds left before the current batch has
+        to be flushed, or None if there is nothing to flush.
+        """
+        if not self.measures:
+            return None
+        return max(0, self.oldest + self.max_latency - time.monotonic())
+
+    def is_due(self):
+        """Returns True if the current batch should be flushed now."""
+        return (len(self.measures) >= self.max_size or
+                (len(self.measures) > 0 and self.timeout() == 0))
+
+    def take(self):
+        """Removes the current batch from the buffer and returns it, to be
+        passed to write().
+        """
+        batch = (self.measures, self.timers)
+        self.measures = []
+        self.timers = {}
+        self.oldest = None
+        return batch
+
+    def restore(self, batch):
+        """Puts back a batch that could not be written in front of the
+        buffer. It will be retried after `max_latency` seconds.
+        """
+        measures, timers = batch
+        timers.update(self.timers)
+        self.measures = measures + self.measures
+        self.timers = timers
+        if self.max_pending and len(self.measures) > self.max_pending:
+            dropped = len(self.measures) - self.max_pending
+            tools.warning("Too many pending measures, dropping the " +
+                          str(dropped) + " oldest ones.")
+            del self.measures[:dropped]
+        if self.measures:
+            self.oldest = time.monotonic()
+
+    def write(self, batch):
+        """Writes a batch returned by take() to the database, and updates
+        the rollup tables accordingly.
+        """
+        measures, timers = batch
+        if not measures:
+            return
+
+        db = self.create_session()
+        try:
+            seqs = {}
+            for measure in measures:
+                sensor_id = measure["sensor_id"]
+                if sensor_id not in seqs:
+                    if sensor_id not in self.last_seq:
+                        self.last_seq[sensor_id] = last_seq(db, sensor_id)
+                    seqs[sensor_id] = self.last_seq[sensor_id]
+                seqs[sensor_id] += 1
+                measure["seq"] = seqs[sensor_id]
+            partitions.registry.insert(db, measures)
+            for sensor_id, timer in timers.items():
+                (db.query(database.Sensor)
+                 .filter_by(id=sensor_id)
+                 .update({"last_timer": timer}))
+            rollups.update(db, measures)
+            db.commit()
+            self.last_seq.update(seqs)
+        finally:
+            db.close()
+        if self.on_write is not None:
+            try:
+                self.on_write(measures)
+            except Exception as e:
+                tools.warning("Error after saving measures: " + str(e))
+
+    def flush(self):
+        """Writes the current batch to the database.
+
+        Returns the number of measures written. If the batch could not be
+        saved, it is kept so that the flush can be retried.
+        """
+        batch = self.take()
+        try:
+            self.write(batch)
+        except:
+            self.restore(batch)
+            raise
+        return len(batch[0])
+
+
+class Pipeline():
+    """asyncio ingestion pipeline for the packets sent by receive.cpp on the
+    named fifo.
+
+    * The reader pushes the raw packets read from the (non-blocking) fifo to
+    a bounded queue.
+    * The decode stage drains the queue, turns the packets into measures
+    with the `decode` callback and adds them to the `MeasuresBuffer`.
+    * The persistence stage writes the batches to the database in an
+    executor, so that a slow commit never blocks the reader.
+
+    When the queue is full, the reader stops reading the fifo until the
+    queue is half empty. The packets then wait in the fifo, and receive.cpp
+    blocks on its write, instead of being dropped.
+    """
+    def __init__(self, loop, fd, decode, buffer, packet_size=16,
+                 queue_size=1024, stats_interval=60):
+        self.loop = loop
+        self.fd = fd
+        self.decode = decode
+        self.buffer = buffer
+        self.packet_size = packet_size
+        self.queue = asyncio.Queue(queue_size)
+        self.stats_interval = stats_interval
+        self.partial = b""
+        self.paused = None
+        self.closing = False
+        self.flushing = False
+        self.wakeup = asyncio.Event()
+        self.flushed = asyncio.Event()
+        self.stats = {"packets": 0,
+                      "max_queue_depth": 0,
+                      "pauses": 0,
+                      "paused_time": 0}
+
+    def read_fifo(self):
+        """Reads as many packets as the queue can hold from the fifo."""
+        free = self.queue.maxsize - self.queue.qsize()
+        try:
+            data = os.read(self.fd,
+                           free * self.packet_size - len(self.partial))
+        except BlockingIOError:
+            return
+        if not data:
+            tools.warning("Fifo closed by the receiver.")
+            self.loop.remove_reader(self.fd)
+            self.loop.create_task(self.queue.put(None))
+            return
+
+        data = self.partial + data
+        end = len(data) - len(data) % self.packet_size
+        for i in range(0, end, self.packet_size):
+            self.queue.put_nowait(data[i:i + self.packet_size])
+        self.partial = data[end:]
+        self.stats["packets"] += end // self.packet_size
+        self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"],
+                                            self.queue.qsize())
+
+        if self.queue.full():
+            tools.warning("Ingestion queue is full (" +
+                          str(self.queue.qsize()) + " packets), " +
+                          "pausing fifo reads.")
+            self.loop.remove_reader(self.fd)
+            self.paused = time.monotonic()
+            self.stats["pauses"] += 1
+
+    def resume_reading(self):
+        """Reads the fifo again once the queue is half empty."""
+        if (self.paused is not None and
+                self.queue.qsize() <= self.queue.maxsize // 2):
+            paused_time = time.monotonic() - self.paused
+            self.stats["paused_time"] += paused_time
+            self.paused = None
+            self.loop.add_reader(self.fd, self.read_fifo)
+            print("Fifo reads resumed after %.1fs." % paused_time)
+
+    @coroutine
+    def decode_stage(self):
+        while not self.closing:
+            packets = [(yield from self.queue.get())]
+            while not self.queue.empty():
+                packets.append(self.queue.get_nowait())
+            if packets[-1] is None:
+                self.closing = True
+                packets.pop()
+            self.resume_reading()
+
+            for measure in self.decode(packets):
+                self.buffer.add(*measure)
+            self.wakeup.set()
+
+            # Do not let the buffer grow while the database is busy, the
+            # queue and then the fifo will hold the packets meanwhile.
+            while self.flushing and len(self.buffer) >= self.buffer.max_size:
+                self.flushed.clear()
+                yield from self.flushed.wait()
+
+    @coroutine
+    def persist_stage(self):
+        while not self.closing or len(self.buffer):
+            try:
+                yield from asyncio.wait_for(self.wakeup.wait(),
+                                            self.buffer.timeout())
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if self.buffer.is_due() or (self.closing and len(self.buffer)):
+                yield from self.flush()
+
+    @coroutine
+    def flush(self):
+        """Writes the current batch in an executor."""
+        batch = self.buffer.take()
+        self.flushing = True
+        start = time.monotonic()
+        try:
+            yield from self.loop.run_in_executor(None, self.buffer.write,
+                                                 batch)
+        except SQLAlchemyError as e:
+            self.buffer.restore(batch)
+            tools.warning("Unable to save measures, will retry: " + str(e))
+            if self.closing:
+                raise
+        else:
+            print("Saved successfully %d measures in %.3fs." %
+                  (len(batch[0]), time.monotonic() - start))
+        finally:
+            self.flushing = False
+            self.flushed.set()
+
+    @coroutine
+    def report(self):
+        """Periodically prints the queue depth and backpressure stats."""
+        while True:
+            yield from asyncio.sleep(self.stats_interval)
+            print("Ingestion: %d packets, queue depth %d (max %d), "
+                  "%d measures buffered, paused %d times (%.1fs)." %
+                  (self.stats["packets"],
+                   self.queue.qsize(),
+                   self.stats["max_queue_depth"],
+                   len(self.buffer),
+                   self.stats["pauses"],
+                   self.stats["paused_time"]))
+            self.stats["max_queue_depth"] = self.queue.qsize()
+
+    @coroutine
+    def run(self):
+        """Runs the pipeline until the fifo is closed."""
+        self.loop.add_reader(self.fd, self.read_fifo)
+        report = self.loop.create_task(self.report())
+        try:
+            yield from asyncio.gather(self.decode_stage(),
+                                      self.persist_stage())
+        finally:
+            report.cancel()
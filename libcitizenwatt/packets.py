@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+import numpy
+
+from Crypto.Cipher import AES
+
+
+PACKET_SIZE = 16
+# Layout of a decrypted packet, "<HHHLlH" as sent by the sensor
+PACKET_DTYPE = numpy.dtype([("power", "<u2"),
+                            ("voltage", "<u2"),
+                            ("battery", "<u2"),
+                            ("timer", "<u4"),
+                            ("reserved1", "<i4"),
+                            ("reserved2", "<u2")])
+# receive.cpp prefixes each packet with the base address it was sent to
+FRAME_SIZE = 8 + PACKET_SIZE
+FRAME_DTYPE = numpy.dtype([("address", "<u8"),
+                           ("packet", "V%d" % PACKET_SIZE)])
+
+
+def split_frames(frames):
+    """Groups the frames read from the fifo by base address.
+
+    Returns a dict mapping each base address to the contiguous buffer of its
+    packets, in reception order.
+    """
+    if isinstance(frames, list):
+        frames = b"".join(frames)
+    frames = numpy.frombuffer(frames, dtype=FRAME_DTYPE)
+    return {address: frames["packet"][frames["address"] == address].tobytes()
+            for address in numpy.unique(frames["address"]).tolist()}
+
+
+class Decoder():
+    """Decrypts the packets of a sensor.
+
+    A single AES cipher is kept for the sensor key. As ECB blocks are
+    independent, a backlog of packets is decrypted in one call over a
+    contiguous buffer, and parsed at once into columns.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.cipher = AES.new(key, AES.MODE_ECB)
+
+    def decode(self, packets):
+        """Decrypts a list of packets, or a buffer of contiguous packets.
+
+        Returns a numpy structured array with one row per packet, whose
+        columns are named after the fields of PACKET_DTYPE.
+        """
+        if isinstance(packets, list):
+            packets = b"".join(packets)
+        if len(packets) % PACKET_SIZE:
+            raise ValueError("Truncated packet")
+        return numpy.frombuffer(self.cipher.decrypt(packets),
+                                dtype=PACKET_DTYPE)
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""
+Optional monthly partitioning of the measures, enabled by the
+"partitioning" setting. Partitions hold UTC months.
+
+* On PostgreSQL (>= 11), the measures table is turned into a table
+partitioned by range of timestamp. The measures stored before keep living
+in its default partition, measures_legacy, until the partition of their
+month is created. The planner prunes the partitions by itself.
+* On SQLite, the new measures are stored in one table per month,
+measures_yYYYYmMM, next to the measures table which keeps the older ones.
+source() only selects from the tables matching a time range.
+
+Old partitions can be detached, so that their measures are no longer
+served (the rollups of their months are kept), and archived to a gzipped
+CSV file.
+"""
+import calendar
+import csv
+import datetime
+import gzip
+import re
+import threading
+
+from libcitizenwatt import database
+from libcitizenwatt import tools
+from libcitizenwatt.config import Config
+from sqlalchemy import Index, MetaData, Table
+from sqlalchemy import func, inspect, select, text, union_all
+from sqlalchemy.exc import SQLAlchemyError
+
+
+config = Config()
+
+NAME_PATTERN = re.compile(r"^measures_y(\d{4})m(\d{2})$")
+COLUMNS = ["id", "sensor_id", "value", "timestamp", "night_rate", "seq"]
+
+
+def month_start(timestamp):
+    """Returns the start of the UTC month holding <timestamp>."""
+    date = datetime.datetime.utcfromtimestamp(timestamp)
+    return calendar.timegm((date.year, date.month, 1, 0, 0, 0))
+
+
+def next_month(start):
+    """Returns the start of the UTC month following the one starting at
+    <start>.
+    """
+    date = datetime.datetime.utcfromtimestamp(start)
+    return start + 86400 * tools.last_day(date.month, date.year)
+
+
+def partition_name(start):
+    """Returns the name of the partition of the month starting at <start>."""
+    date = datetime.datetime.utcfromtimestamp(start)
+    return "measures_y%04dm%02d" % (date.year, date.month)
+
+
+def partition_start(name):
+    """Returns the start of the month of partition <name>, or None if it is
+    not the name of a partition.
+    """
+    match = NAME_PATTERN.match(name)
+    if match is None:
+        return None
+    return calendar.timegm((int(match.group(1)), int(match.group(2)), 1,
+                            0, 0, 0))
+
+
+def partition_table(name, metadata):
+    """Returns the Table of a SQLite partition, with the columns and indexes
+    of the measures table.
+    """
+    return Table(name, metadata,
+                 *[column.copy() for column in
+                   database.Measures.__table__.columns],
+                 Index(name + "_sensor_id_timestamp", "sensor_id", "timestamp"),
+                 Index(name + "_sensor_id_id", "sensor_id", "id"),
+                 Index(name + "_sensor_id_seq", "sensor_id", "seq"))
+
+
+def create_partition(conn, start):
+    """Creates the PostgreSQL partition of the month starting at <start>.
+
+    PostgreSQL refuses to create a partition for the rows of the default
+    partition, measures_legacy. If it holds rows of the month, it is
+    detached while they are moved to the new partition, then attached
+    again.
+    """
+    name = partition_name(start)
+    bounds = {"start": start, "end": next_month(start)}
+    in_month = "timestamp >= :start AND timestamp < :end"
+    legacy = conn.execute(text("SELECT 1 FROM measures_legacy WHERE " +
+                               in_month + " LIMIT 1"), bounds).first()
+    if legacy:
+        conn.execute("ALTER TABLE measures DETACH PARTITION measures_legacy")
+    conn.execute("CREATE TABLE IF NOT EXISTS " + name +
+                 " PARTITION OF measures FOR VALUES FROM (" + str(start) +
+                 ") TO (" + str(next_month(start)) + ")")
+    if legacy:
+        print("Moving the measures of " + name + " out of measures_legacy…")
+        conn.execute(text("INSERT INTO " + name + " (" + ", ".join(COLUMNS) +
+                          ") SELECT " + ", ".join(COLUMNS) +
+                          " FROM measures_legacy WHERE " + in_month), bounds)
+        conn.execute(text("DELETE FROM measures_legacy WHERE " + in_month),
+                     bounds)
+        conn.execute("ALTER TABLE measures ATTACH PARTITION "
+                     "measures_legacy DEFAULT")
+
+
+def insert_ids(db, table, measures):
+    """Inserts <measures> in <table> and sets their ids, from their sensor
+    and position (seq).
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        rows = db.execute(table.insert().values(measures)
+                          .returning(table.c.id,
+                                     table.c.sensor_id,
+                                     table.c.seq)).fetchall()
+    else:
+        db.execute(table.insert().values(measures))
+        seqs = {}
+        for measure in measures:
+            seqs.setdefault(measure["sensor_id"], []).append(measure["seq"])
+        rows = []
+        for sensor, sensor_seqs in seqs.items():
+            rows += db.execute(select([table.c.id,
+                                       table.c.sensor_id,
+                                       table.c.seq])
+                               .where(table.c.sensor_id == sensor)
+                               .where(table.c.seq >= min(sensor_seqs))
+                               .where(table.c.seq <= max(sensor_seqs)))
+    ids = dict([((i.sensor_id, i.seq), i.id) for i in rows])
+    for measure in measures:
+        measure["id"] = ids[(measure["sensor_id"], measure["seq"])]
+
+
+class Partitions():
+    """Registry of the monthly partitions of the measures.
+
+    The partitions are listed from the database on first use. The newer
+    months are looked up again when needed, the detached partitions are
+    forgotten when a "partitions" invalidation is received from
+    `cache.invalidate`.
+    """
+    def __init__(self, listener=None):
+        self.listener = listener
+        self.lock = threading.Lock()
+        self.metadata = MetaData()
+        self.partitions = None
+        # Next id of the measures, assigned by insert() on SQLite
+        self.next_id = None
+
+    def mode(self, bind):
+        """Returns "postgresql" or "sqlite" if the measures are partitioned,
+        None otherwise.
+        """
+        if (config.get("partitioning") and
+                bind.dialect.name in ["postgresql", "sqlite"]):
+            return bind.dialect.name
+        return None
+
+    def load(self, bind):
+        """Lists the partitions from the database."""
+        if bind.dialect.name == "postgresql":
+            names = [i[0] for i in bind.execute(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "JOIN pg_class p ON p.oid = i.inhparent "
+                "WHERE p.relname = 'measures'")]
+        else:
+            names = inspect(bind).get_table_names()
+        partitions = {}
+        for name in names:
+            start = partition_start(name)
+            if start is not None:
+                partitions[start] = name
+        self.partitions = partitions
+
+    def get(self, bind, start=None):
+        """Returns a dict mapping the start of each month to the name of its
+        partition. The partitions are listed again if the month starting at
+        <start> is newer than the known ones.
+        """
+        with self.lock:
+            if (self.listener is not None and
+                    self.listener.changed("partitions")):
+                self.partitions = None
+            if (self.partitions is not None and start is not None and
+                    start not in self.partitions and
+                    start > max(list(self.partitions.keys()) + [0])):
+                self.partitions = None
+            if self.partitions is None:
+                self.load(bind)
+            return dict(self.partitions)
+
+    def table(self, name):
+        """Returns the Table of the SQLite partition <name>."""
+        if name not in self.metadata.tables:
+            partition_table(name, self.metadata)
+        return self.metadata.tables[name]
+
+    def setup(self, engine):
+        """Turns the measures table into a partitioned table on PostgreSQL,
+        if partitioning is enabled and it is not done yet, with the
+        partitions of the current and next months.
+        """
+        if self.mode(engine) != "postgresql":
+            return
+        if engine.execute("SELECT 1 FROM pg_partitioned_table p "
+                          "JOIN pg_class c ON c.oid = p.partrelid "
+                          "WHERE c.relname = 'measures'").first():
+            return
+
+        print("Partitioning the measures…")
+        indexes = database.Measures.__table__.indexes
+        with engine.begin() as conn:
+            conn.execute("ALTER TABLE measures RENAME TO measures_legacy")
+            for index in indexes:
+                conn.execute("DROP INDEX IF EXISTS " + index.name)
+            # Keeps the default of id, hence its sequence
+            conn.execute("CREATE TABLE measures "
+                         "(LIKE measures_legacy INCLUDING DEFAULTS) "
+                         "PARTITION BY RANGE (timestamp)")
+            conn.execute("ALTER TABLE measures ATTACH PARTITION "
+                         "measures_legacy DEFAULT")
+            for index in indexes:
+                conn.execute("CREATE INDEX " + index.name + " ON measures (" +
+                             ", ".join([i.name for i in index.columns]) + ")")
+            start = month_start(datetime.datetime.now().timestamp())
+            create_partition(conn, start)
+            create_partition(conn, next_month(start))
+        self.partitions = None
+
+    def create(self, db, start):
+        """Creates the partition of the month starting at <start>, if
+        needed.
+        """
+        # Lists the partitions in the transaction of <db>, which may already
+        # lock the database on SQLite
+        bind = db.connection()
+        if start in self.get(bind, start):
+            return
+        name = partition_name(start)
+        if self.mode(bind) == "postgresql":
+            create_partition(db.connection(), start)
+        else:
+            self.table(name).create(bind=db.connection(), checkfirst=True)
+        with self.lock:
+            if self.partitions is not None:
+                self.partitions[start] = name
+
+    def insert(self, db, measures):
+        """Inserts <measures>, a list of dicts with the columns of the
+        measures, in their partitions, and sets their ids.
+
+        On SQLite, the ids are assigned here so that they are unique among
+        all the partitions. On PostgreSQL, if the partition of a month
+        cannot be created, its measures go to the default partition, to be
+        moved out of it when the partition is created.
+        """
+        table = database.Measures.__table__
+        mode = self.mode(db.get_bind())
+        if mode != "sqlite":
+            for measure in measures:
+                measure.pop("id", None)
+            if mode == "postgresql":
+                for start in sorted(set([month_start(i["timestamp"])
+                                         for i in measures])):
+                    try:
+                        with db.begin_nested():
+                            self.create(db, start)
+                    except SQLAlchemyError as e:
+                        tools.warning("Unable to create partition " +
+                                      partition_name(start) + ": " + str(e))
+            insert_ids(db, table, measures)
+            return
+
+        months = {}
+        for measure in measures:
+            start = month_start(measure["timestamp"])
+            months.setdefault(start, []).append(measure)
+        for start in sorted(months.keys()):
+            self.create(db, start)
+
+        if self.next_id is None:
+            self.next_id = (self.max_value(db, "id") or 0) + 1
+        next_id = self.next_id
+        for measure in measures:
+            measure["id"] = next_id
+            next_id += 1
+        for start, month_measures in months.items():
+            partition = self.table(partition_name(start))
+            db.execute(partition.insert().values(month_measures))
+        self.next_id = next_id
+
+    def tables(self, db, time1=None, time2=None):
+        """Returns the tables holding the measures between <time1> and
+        <time2> (all of them if None): the measures table and, on SQLite,
+        the partitions of the months between <time1> and <time2>.
+        """
+        table = database.Measures.__table__
+        bind = db.get_bind()
+        if self.mode(bind) != "sqlite":
+            return [table]
+
+        start = month_start(time2) if time2 is not None else None
+        tables = [table]
+        for month, name in sorted(self.get(bind, start).items()):
+            if ((time1 is None or next_month(month) > time1) and
+                    (time2 is None or month <= time2)):
+                tables.append(self.table(name))
+        return tables
+
+    def source(self, db, sensor=None, time1=None, time2=None):
+        """Returns the selectable to query the measures from, with the
+        columns of the measures table, for the measures of <sensor> between
+        <time1> and <time2> (all of them if None).
+
+        On SQLite, it is the union of the measures table and of the
+        partitions of the months between <time1> and <time2>, the conditions
+        being applied to each of them. Otherwise, it is the measures table.
+        """
+        if self.mode(db.get_bind()) != "sqlite":
+            return database.Measures.__table__
+
+        selects = []
+        for table in self.tables(db, time1, time2):
+            query = select([table.c[name] for name in COLUMNS])
+            if sensor is not None:
+                query = query.where(table.c.sensor_id == sensor)
+            if time1 is not None:
+                query = query.where(table.c.timestamp >= time1)
+            if time2 is not None:
+                query = query.where(table.c.timestamp <= time2)
+            selects.append(query)
+        if len(selects) == 1:
+            return selects[0].alias("measures")
+        return union_all(*selects).alias("measures")
+
+    def max_value(self, db, column, sensor=None):
+        """Returns the max of <column> over the measures of <sensor> (all of
+        them if None), None if there are none.
+
+        The max is taken in each table, where the indexes answer it, rather
+        than over the union of source(), which SQLite scans.
+        """
+        selects = []
+        for table in self.tables(db):
+            query = select([func.max(table.c[column]).label("value")])
+            if sensor is not None:
+                query = query.where(table.c.sensor_id == sensor)
+            selects.append(query)
+        if len(selects) == 1:
+            return db.execute(selects[0]).scalar()
+        values = union_all(*selects).alias("values")
+        return db.execute(select([func.max(values.c.value)])).scalar()
+
+    def detach(self, db, start):
+        """Detaches the partition of the month starting at <start>: its
+        measures are no longer served, but kept in a standalone table,
+        whose name is returned.
+        """
+        bind = db.get_bind()
+        name = self.get(bind).get(start)
+        if name is None:
+            raise KeyError("No partition for " + partition_name(start) + ".")
+        if self.mode(bind) == "postgresql":
+            db.execute("ALTER TABLE measures DETACH PARTITION " + name)
+            detached = name
+        else:
+            detached = "detached_" + name
+            db.execute("ALTER TABLE " + name + " RENAME TO " + detached)
+            self.metadata.remove(self.table(name))
+        db.commit()
+        with self.lock:
+            self.partitions = None
+        return detached
+
+    def drop(self, db, start):
+        """Drops the partition of the month starting at <start>, with its
+        measures.
+        """
+        bind = db.get_bind()
+        name = self.get(bind).get(start)
+        if name is None:
+            raise KeyError("No partition for " + partition_name(start) + ".")
+        db.execute("DROP TABLE " + name)
+        if name in self.metadata.tables:
+            self.metadata.remove(self.table(name))
+        db.commit()
+        with self.lock:
+            self.partitions = None
+
+    def archive(self, db, start, path):
+        """Detaches the partition of the month starting at <start> if
+        needed, writes its measures to the gzipped CSV file <path> and drops
+        it.
+
+        Returns the number of archived measures.
+        """
+        bind = db.get_bind()
+        if start in self.get(bind):
+            name = self.detach(db, start)
+        elif bind.dialect.name == "postgresql":
+            name = partition_name(start)
+        else:
+            name = "detached_" + partition_name(start)
+
+        table = partition_table(name, MetaData())
+        count = 0
+        with gzip.open(path, "wt", newline="") as fh:
+            writer = csv.writer(fh)
+            writer.writerow(COLUMNS)
+            for row in db.execute(select([table.c[i] for i in COLUMNS])
+                                  .order_by(table.c.id)):
+                writer.writerow(list(row))
+                count += 1
+        db.execute("DROP TABLE " + name)
+        db.commit()
+        return count
+
+
+registry = Partitions()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Retention policy of the measures.
+
+The raw measures are summed up in the rollup tables as they arrive (see
+rollups.py), so the downsampled data already exists when they expire:
+compaction only deletes the raw measures and the rollups older than their
+retention, in small batches committed one at a time, so that process.py
+is never locked out of the database for long.
+
+The retentions are set in days by the "retention_raw_days",
+"retention_1m_days", "retention_1h_days" and "retention_1d_days"
+settings, 0 (the default) meaning forever.
+
+The cache is not invalidated when measures expire: the cached values were
+computed from them, and the rollups and the archive still sum them up.
+
+With the "archive" setting, the closed months are written to the columnar
+archive (see archive.py), and the raw measures only expire once archived.
+"""
+import datetime
+import time
+
+from libcitizenwatt import archive
+from libcitizenwatt import cache
+from libcitizenwatt import database
+from libcitizenwatt import partitions
+from libcitizenwatt import tools
+from libcitizenwatt.config import Config
+from sqlalchemy import select
+
+
+config = Config()
+
+# Pause between two batches, in seconds, to let the writers in
+PAUSE = 0.1
+
+
+def cutoffs(now=None):
+    """Returns a list of (table, cutoff) pairs, the rows of <table> older
+    than <cutoff> having expired.
+    """
+    if now is None:
+        now = datetime.datetime.now().timestamp()
+    retentions = [(database.Measures.__table__, "retention_raw_days"),
+                  (database.Measures1m.__table__, "retention_1m_days"),
+                  (database.Measures1h.__table__, "retention_1h_days"),
+                  (database.Measures1d.__table__, "retention_1d_days")]
+    return [(table, now - config.get(setting) * 86400)
+            for table, setting in retentions if config.get(setting)]
+
+
+def delete_batches(db, table, sensor, cutoff, batch_size):
+    """Deletes the rows of <sensor> older than <cutoff> from <table>, by
+    batches of <batch_size> rows, each in its own transaction.
+
+    Returns the number of deleted rows.
+    """
+    count = 0
+    while True:
+        ids = (select([table.c.id])
+               .where(table.c.sensor_id == sensor)
+               .where(table.c.timestamp < cutoff)
+               .limit(batch_size))
+        deleted = db.execute(table.delete()
+                             .where(table.c.id.in_(ids))).rowcount
+        db.commit()
+        count += deleted
+        if deleted < batch_size:
+            return count
+        time.sleep(PAUSE)
+
+
+def drop_partitions(db, cutoff):
+    """Drops the partitions of the months entirely older than <cutoff>.
+
+    Returns the names of the dropped partitions.
+    """
+    bind = db.get_bind()
+    if partitions.registry.mode(bind) is None:
+        return []
+    dropped = []
+    for start, name in sorted(partitions.registry.get(bind).items()):
+        if partitions.next_month(start) <= cutoff:
+            partitions.registry.drop(db, start)
+            dropped.append(name)
+    if dropped:
+        cache.invalidate("partitions")
+    return dropped
+
+
+def raw_tables(db, cutoff):
+    """Returns the tables holding raw measures older than <cutoff>."""
+    bind = db.get_bind()
+    tables = [database.Measures.__table__]
+    if partitions.registry.mode(bind) == "sqlite":
+        tables += [partitions.registry.table(name) for start, name in
+                   sorted(partitions.registry.get(bind).items())
+                   if start < cutoff]
+    return tables
+
+
+def compact(db, now=None):
+    """Deletes the expired raw measures and rollups of all the sensors.
+
+    With the "archive" setting, the raw measures of a sensor are only
+    deleted up to the end of its archive, and none is deleted if the export
+    failed.
+
+    Returns the number of deleted rows.
+    """
+    sensors = [i.id for i in db.query(database.Sensor).all()]
+    ends = None
+    if config.get("archive"):
+        try:
+            archived = archive.registry.export(db)
+        except Exception as e:
+            db.rollback()
+            tools.warning("Unable to archive the measures, none is " +
+                          "deleted: " + str(e))
+            return 0
+        if archived:
+            print("Archived " + str(archived) + " measures.")
+        # The sensors without measures do not hold the partitions back
+        ends = dict([(sensor, archive.registry.end(sensor))
+                     for sensor in sensors
+                     if partitions.registry.max_value(db, "id", sensor)
+                     is not None])
+    batch_size = config.get("compaction_batch_size")
+    count = 0
+    for table, cutoff in cutoffs(now):
+        sensor_cutoffs = dict([(sensor, cutoff) for sensor in sensors])
+        if table is database.Measures.__table__:
+            if ends is not None:
+                for sensor, end in ends.items():
+                    sensor_cutoffs[sensor] = min(cutoff, end)
+            # A partition holds the measures of all the sensors
+            drop_cutoff = min([cutoff] + list(sensor_cutoffs.values()))
+            for name in drop_partitions(db, drop_cutoff):
+                print("Dropped the expired partition " + name + ".")
+            tables = raw_tables(db, cutoff)
+        else:
+            tables = [table]
+        for table in tables:
+            for sensor in sensors:
+                count += delete_batches(db, table, sensor,
+                                        sensor_cutoffs[sensor], batch_size)
+    return count
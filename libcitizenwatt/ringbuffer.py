@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Ring buffers of the last measures of each sensor, shared between
+process.py, which writes them as measures are saved, and visu.py and
+worker.py, which serve the recent measures from them without querying the
+database.
+
+Each sensor has a memory mapped file under the "ring_buffer_path" setting
+(a tmpfs), holding a header and "ring_buffer_size" slots. The measure at
+position seq (see ingestion.last_seq) is stored in slot seq % size, and
+the buffer holds the consecutive positions from first to last.
+
+process.py is the only writer. It follows a seqlock protocol: the lock
+counter of the header is odd while it writes, and the readers retry when
+the counter is odd or has changed during their read.
+
+The timestamps of the measures of a sensor are assumed to grow with their
+position, as they are stamped by process.py on arrival.
+"""
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+
+from libcitizenwatt import partitions
+from libcitizenwatt import tools
+from libcitizenwatt.config import Config
+from sqlalchemy import desc, select
+
+
+config = Config()
+
+MAGIC = b"CWRB"
+# Magic, number of slots, lock counter, first and last positions held
+HEADER = struct.Struct("<4sIQQQ")
+LOCK = struct.Struct("<Q")
+LOCK_OFFSET = 8
+RANGE = struct.Struct("<QQ")
+RANGE_OFFSET = 16
+# id, timestamp, value, night_rate, seq
+SLOT = struct.Struct("<qqdqq")
+# Attempts of a reader before falling back to the database
+RETRIES = 100
+
+# Same fields as the rows of cache.query_measures
+Measure = collections.namedtuple("Measure",
+                                 ["id", "timestamp", "value", "night_rate",
+                                  "seq"])
+
+
+class RingBuffer():
+    """Ring buffer of the last measures of a sensor, mapped from the file
+    <path>.
+
+    With <size>, the buffer is opened for writing, and the file is created
+    if it does not hold <size> slots.
+    """
+    def __init__(self, path, size=None):
+        if size is not None:
+            if not self.has_size(path, size):
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "wb") as fh:
+                    fh.write(HEADER.pack(MAGIC, size, 0, 0, 0))
+                    fh.write(bytes(SLOT.size * size))
+                os.replace(tmp_path, path)
+            flags, access = os.O_RDWR, mmap.ACCESS_WRITE
+        else:
+            flags, access = os.O_RDONLY, mmap.ACCESS_READ
+
+        fd = os.open(path, flags)
+        try:
+            self.inode = os.fstat(fd).st_ino
+            self.map = mmap.mmap(fd, 0, access=access)
+        finally:
+            os.close(fd)
+        magic, self.size, lock, first, last = HEADER.unpack_from(self.map)
+        if (magic != MAGIC or
+                len(self.map) != HEADER.size + SLOT.size * self.size):
+            raise ValueError("Invalid ring buffer " + path + ".")
+
+    @staticmethod
+    def has_size(path, size):
+        """Returns True if <path> is a ring buffer of <size> slots."""
+        try:
+            with open(path, "rb") as fh:
+                header = fh.read(HEADER.size)
+        except FileNotFoundError:
+            return False
+        return (len(header) == HEADER.size and
+                HEADER.unpack(header)[:2] == (MAGIC, size) and
+                os.path.getsize(path) == HEADER.size + SLOT.size * size)
+
+    def slot(self, seq):
+        """Returns the measure at position <seq>."""
+        offset = HEADER.size + SLOT.size * (seq % self.size)
+        return Measure(*SLOT.unpack_from(self.map, offset))
+
+    def write(self, measures, reset=False):
+        """Adds <measures>, dicts with the columns of the measures sorted by
+        position, to the buffer. With <reset>, the measures held are
+        forgotten first.
+
+        A measure which does not follow the last one held also resets the
+        buffer, so that it always holds consecutive positions.
+        """
+        lock = LOCK.unpack_from(self.map, LOCK_OFFSET)[0]
+        LOCK.pack_into(self.map, LOCK_OFFSET, lock + 1)
+        if reset:
+            first, last = 0, 0
+        else:
+            first, last = RANGE.unpack_from(self.map, RANGE_OFFSET)
+        for measure in measures:
+            if last == 0 or measure["seq"] != last + 1:
+                first = measure["seq"]
+            last = measure["seq"]
+            SLOT.pack_into(self.map,
+                           HEADER.size + SLOT.size * (last % self.size),
+                           measure["id"],
+                           measure["timestamp"],
+                           measure["value"],
+                           measure["night_rate"],
+                           last)
+        first = max(first, last - self.size + 1)
+        RANGE.pack_into(self.map, RANGE_OFFSET, first, last)
+        LOCK.pack_into(self.map, LOCK_OFFSET, lock + 2)
+
+    def read(self, reader):
+        """Returns reader(first, last), run on a consistent state of the
+        buffer holding positions <first> to <last> (0 if empty), or None if
+        the writer kept it busy.
+        """
+        for i in range(RETRIES):
+            lock = LOCK.unpack_from(self.map, LOCK_OFFSET)[0]
+            if lock % 2 == 0:
+                first, last = RANGE.unpack_from(self.map, RANGE_OFFSET)
+                result = reader(first, last)
+                if LOCK.unpack_from(self.map, LOCK_OFFSET)[0] == lock:
+                    return result
+            time.sleep(0)
+        return None
+
+    def search(self, first, last, key, value):
+        """Returns the first position between <first> and <last> + 1 whose
+        measure has a <key> field >= <value>.
+        """
+        low, high = first, last + 1
+        while low < high:
+            middle = (low + high) // 2
+            if getattr(self.slot(middle), key) < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+class RingBuffers():
+    """Ring buffers of all the sensors.
+
+    The methods used by the readers return None when the buffer of the
+    sensor does not hold the requested measures, which should then be
+    queried from the database.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buffers = {}
+
+    def path(self, sensor):
+        """Returns the path of the ring buffer of <sensor>."""
+        return os.path.join(config.get("ring_buffer_path"),
+                            "measures_" + str(sensor))
+
+    def get(self, sensor):
+        """Returns the RingBuffer of <sensor> for reading, None if there is
+        none. It is mapped again when process.py has replaced it.
+        """
+        if not config.get("ring_buffer_size"):
+            return None
+        path = self.path(sensor)
+        with self.lock:
+            buffer = self.buffers.get(sensor)
+            try:
+                if buffer is None or os.stat(path).st_ino != buffer.inode:
+                    buffer = RingBuffer(path)
+            except (OSError, ValueError):
+                buffer = None
+            self.buffers[sensor] = buffer
+        return buffer
+
+    def writer(self, sensor):
+        """Returns the RingBuffer of <sensor> for writing."""
+        with self.lock:
+            if sensor not in self.buffers:
+                os.makedirs(config.get("ring_buffer_path"), exist_ok=True)
+                self.buffers[sensor] = RingBuffer(
+                    self.path(sensor), config.get("ring_buffer_size"))
+            return self.buffers[sensor]
+
+    def load(self, db, sensors):
+        """Fills the ring buffers of <sensors> with their last measures from
+        the database. Called by process.py on startup.
+        """
+        if not config.get("ring_buffer_size"):
+            return
+        try:
+            for sensor in sensors:
+                source = partitions.registry.source(db, sensor)
+                rows = db.execute(select([source.c.id,
+                                          source.c.timestamp,
+                                          source.c.value,
+                                          source.c.night_rate,
+                                          source.c.seq])
+                                  .where(source.c.sensor_id == sensor)
+                                  .order_by(desc(source.c.seq))
+                                  .limit(config.get("ring_buffer_size")))
+                measures = [dict(i) for i in rows][::-1]
+                self.writer(sensor).write(measures, reset=True)
+        except OSError as e:
+            tools.warning("Unable to create the ring buffers: " + str(e))
+
+    def append(self, measures):
+        """Adds <measures>, just saved by ingestion.MeasuresBuffer, to the
+        ring buffers of their sensors.
+        """
+        if not config.get("ring_buffer_size"):
+            return
+        by_sensor = {}
+        for measure in measures:
+            by_sensor.setdefault(measure["sensor_id"], []).append(measure)
+        try:
+            for sensor, sensor_measures in by_sensor.items():
+                self.writer(sensor).write(sensor_measures)
+        except OSError as e:
+            tools.warning("Unable to write the ring buffers: " + str(e))
+
+    def positions(self, sensor, id1, id2):
+        """Returns (last, measures), <measures> being the measures of
+        <sensor> at positions [<id1>, <id2>[ from the end, as in
+        cache.filter_positions, and <last> the position of its last measure.
+        """
+        buffer = self.get(sensor)
+        if buffer is None:
+            return None
+
+        def reader(first, last):
+            seq1 = max(last + id1 + 1, 1)
+            if last == 0 or seq1 < first:
+                return None
+            return last, [buffer.slot(i)
+                          for i in range(seq1, last + id2 + 1)]
+        return buffer.read(reader)
+
+    def by_id(self, sensor, id):
+        """Returns the list of the measures of <sensor> with id <id>."""
+        buffer = self.get(sensor)
+        if buffer is None:
+            return None
+
+        def reader(first, last):
+            if (last == 0 or
+                    not buffer.slot(first).id <= id <= buffer.slot(last).id):
+                return None
+            seq = buffer.search(first, last, "id", id)
+            return [i for i in [buffer.slot(seq)] if i.id == id]
+        return buffer.read(reader)
+
+    def times(self, sensor, time1, time2):
+        """Returns the measures of <sensor> with a timestamp in [<time1>,
+        <time2>[.
+        """
+        buffer = self.get(sensor)
+        if buffer is None:
+            return None
+
+        def reader(first, last):
+            if (last == 0 or
+                    (first > 1 and buffer.slot(first).timestamp >= time1)):
+                return None
+            seq1 = buffer.search(first, last, "timestamp", time1)
+            seq2 = buffer.search(seq1, last, "timestamp", time2)
+            return [buffer.slot(i) for i in range(seq1, seq2)]
+        return buffer.read(reader)
+
+
+registry = RingBuffers()
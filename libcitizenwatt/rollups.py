@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Rollup tables of the measures (see database.MeasuresRollup).
+
+Periods are aligned on multiples of their length since the epoch, hence the
+daily rollups are UTC days. A period holds the measures whose timestamp
+is in [start, start + period[.
+"""
+from libcitizenwatt import database
+from libcitizenwatt import partitions
+from sqlalchemy import asc
+
+
+# From the finest to the coarsest
+LEVELS = [database.Measures1m, database.Measures1h, database.Measures1d]
+
+
+def segment(first_timestamp, first_value, first_night_rate,
+            timestamp, value, night_rate):
+    """Returns the (day_rate, night_rate) energies, in kWh, of the trapeze
+    between two consecutive measures, as integrated by tools.energy.
+    """
+    first_day = 0 if first_night_rate == 1 else first_value
+    first_night = first_value if first_night_rate == 1 else 0
+    day = 0 if night_rate == 1 else value
+    night = value if night_rate == 1 else 0
+    dt = timestamp - first_timestamp
+    return ((first_day + day) / 2 * dt / 1000 / 3600,
+            (first_night + night) / 2 * dt / 1000 / 3600)
+
+
+def add_measure(row, measure):
+    """Adds a measure, more recent than the ones already in <row>, to a
+    rollup row.
+    """
+    timestamp = measure["timestamp"]
+    value = measure["value"]
+    night_rate = measure["night_rate"]
+    if not row.count:
+        row.day_rate = 0
+        row.night_rate = 0
+        row.count = 0
+        row.min_value = value
+        row.max_value = value
+        row.mean_value = value
+        row.first_timestamp = timestamp
+        row.first_value = value
+        row.first_night_rate = night_rate
+    else:
+        day, night = segment(row.last_timestamp, row.last_value,
+                             row.last_night_rate, timestamp, value, night_rate)
+        row.day_rate += day
+        row.night_rate += night
+        row.min_value = min(row.min_value, value)
+        row.max_value = max(row.max_value, value)
+        row.mean_value = ((row.mean_value * row.count + value) /
+                          (row.count + 1))
+    row.count += 1
+    row.last_timestamp = timestamp
+    row.last_value = value
+    row.last_night_rate = night_rate
+
+
+def recompute(db, level, row):
+    """Computes a rollup row again from the stored measures of its period,
+    e.g. when a measure older than its last one arrives late.
+    """
+    end = row.timestamp + level.period
+    source = partitions.registry.source(db, row.sensor_id, row.timestamp, end)
+    measures = (db.query(source.c.timestamp,
+                         source.c.value,
+                         source.c.night_rate)
+                .filter(source.c.sensor_id == row.sensor_id,
+                        source.c.timestamp >= row.timestamp,
+                        source.c.timestamp < end)
+                .order_by(asc(source.c.timestamp),
+                          asc(source.c.id)))
+    row.count = 0
+    for measure in measures:
+        add_measure(row, {"timestamp": measure.timestamp,
+                          "value": measure.value,
+                          "night_rate": measure.night_rate})
+
+
+def update(db, measures):
+    """Adds new measures to the rollup tables.
+
+    <measures> is a list of dicts with sensor_id, timestamp, value and
+    night_rate keys, already stored in the database. The rows which get a
+    measure older than their last one are computed again from the stored
+    measures.
+    """
+    by_sensor = {}
+    for measure in measures:
+        by_sensor.setdefault(measure["sensor_id"], []).append(measure)
+
+    for sensor_id, sensor_measures in by_sensor.items():
+        for level in LEVELS:
+            periods = {}
+            for measure in sensor_measures:
+                start = measure["timestamp"] - measure["timestamp"] % level.period
+                periods.setdefault(start, []).append(measure)
+
+            rows = (db.query(level)
+                    .filter(level.sensor_id == sensor_id,
+                            level.timestamp.in_(list(periods.keys())))
+                    .all())
+            rows = {row.timestamp: row for row in rows}
+            for start in sorted(periods.keys()):
+                row = rows.get(start)
+                period_measures = sorted(periods[start],
+                                         key=lambda i: i["timestamp"])
+                if row is None:
+                    row = level(sensor_id=sensor_id, timestamp=start)
+                    db.add(row)
+                elif (row.count and period_measures[0]["timestamp"] <
+                        row.last_timestamp):
+                    recompute(db, level, row)
+                    continue
+                for measure in period_measures:
+                    add_measure(row, measure)
+
+
+def rebuild(db, sensor_id, chunk_size=10000):
+    """Computes again all the rollups of a sensor from its measures."""
+    for level in LEVELS:
+        db.query(level).filter_by(sensor_id=sensor_id).delete()
+
+    source = partitions.registry.source(db, sensor_id)
+    measures = (db.query(source.c.timestamp,
+                         source.c.value,
+                         source.c.night_rate)
+                .filter(source.c.sensor_id == sensor_id,
+                        source.c.timestamp != None)
+                .order_by(asc(source.c.timestamp),
+                          asc(source.c.id))
+                .yield_per(chunk_size))
+    chunk = []
+    for measure in measures:
+        chunk.append({"sensor_id": sensor_id,
+                      "timestamp": measure.timestamp,
+                      "value": measure.value,
+                      "night_rate": measure.night_rate})
+        if len(chunk) >= chunk_size:
+            update(db, chunk)
+            db.flush()
+            chunk = []
+    update(db, chunk)
+
+
+def backfill(db):
+    """Builds the rollups of the sensors having measures but no rollups yet,
+    i.e. measures stored before the rollups were introduced.
+    """
+    for sensor in db.query(database.Sensor).all():
+        if (db.query(database.Measures1m)
+                .filter_by(sensor_id=sensor.id).first() is None and
+                db.query(database.Measures)
+                .filter_by(sensor_id=sensor.id).first() is not None):
+            print("Building rollups of sensor " + sensor.name + "…")
+            rebuild(db, sensor.id)
+    db.commit()
+
+
+def energy(rows, default_timestep=8):
+    """Returns the energy of consecutive rollup rows, as tools.energy would
+    on the matching measures.
+    """
+    energy = {'night_rate': 0, 'day_rate': 0, 'value': 0}
+    if sum([row.count for row in rows]) == 1:
+        if rows[0].first_night_rate == 1:
+            energy["night_rate"] = (rows[0].first_value / 1000 *
+                                    default_timestep / 3600)
+        else:
+            energy["day_rate"] = (rows[0].first_value / 1000 *
+                                  default_timestep / 3600)
+    else:
+        previous = None
+        for row in rows:
+            energy["day_rate"] += row.day_rate
+            energy["night_rate"] += row.night_rate
+            if previous is not None:
+                day, night = segment(previous.last_timestamp,
+                                     previous.last_value,
+                                     previous.last_night_rate,
+                                     row.first_timestamp,
+                                     row.first_value,
+                                     row.first_night_rate)
+                energy["day_rate"] += day
+                energy["night_rate"] += night
+            previous = row
+    energy['value'] = energy['day_rate'] + energy['night_rate']
+    return energy
+
+
+def fitting_level(steps):
+    """Returns the coarsest rollup table whose periods fit the bounds of
+    <steps>, or None.
+    """
+    for level in reversed(LEVELS):
+        if all([i % level.period == 0 for i in steps]):
+            return level
+    return None
+
+
+def group(db, sensor, steps):
+    """Returns the energy of <sensor> between each consecutive bounds of
+    <steps>, from the coarsest fitting rollup table, as a list of
+    tools.energy dicts (None for the steps without measures).
+
+    Returns None if no rollup table fits the steps.
+    """
+    level = fitting_level(steps)
+    if level is None or len(steps) < 2:
+        return None
+
+    rows = (db.query(level)
+            .filter(level.sensor_id == sensor,
+                    level.timestamp >= steps[0],
+                    level.timestamp < steps[-1])
+            .order_by(asc(level.timestamp))
+            .all())
+
+    groups = [[] for i in range(len(steps) - 1)]
+    index = 0
+    for row in rows:
+        while row.timestamp >= steps[index + 1]:
+            index += 1
+        groups[index].append(row)
+    return [energy(i) if i else None for i in groups]
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import json
+import struct
+
+from libcitizenwatt import database
+from libcitizenwatt.packets import Decoder
+
+
+# receive.cpp listens to each sensor on its own reading pipe, and the nRF24
+# has 5 of them
+MAX_SENSORS = 5
+
+
+def parse_base_address(base_address):
+    """Returns the integer value of a base address as stored in the
+    database (e.g. "0XE056D446D0LL"), or None if it is invalid.
+    """
+    try:
+        return int(base_address.strip("L"), 16)
+    except (AttributeError, ValueError):
+        return None
+
+
+def base_addresses(db):
+    """Returns the valid base addresses of the sensors, in the order of
+    their ids.
+    """
+    addresses = [parse_base_address(sensor.base_address) for sensor in
+                 db.query(database.Sensor).order_by(database.Sensor.id)]
+    return [i for i in addresses if i is not None]
+
+
+class SensorEntry():
+    """Ingestion state of a sensor: decoder for its AES key and last timer.
+    """
+    def __init__(self, sensor):
+        self.id = sensor.id
+        self.name = sensor.name
+        self.aes_key = sensor.aes_key
+        self.last_timer = sensor.last_timer
+        key = struct.pack("<16B", *json.loads(sensor.aes_key))
+        self.decoder = Decoder(key)
+
+
+class SensorTable():
+    """In-memory table of the sensors, keyed by the base address they
+    send their packets to.
+
+    The table is loaded again when a "sensors" invalidation is received from
+    `cache.invalidate`, e.g. when a sensor is added through /api/sensors.
+    """
+    def __init__(self, create_session, listener=None):
+        self.create_session = create_session
+        self.listener = listener
+        self.sensors = {}
+
+    def __len__(self):
+        return len(self.sensors)
+
+    def load(self):
+        """Loads the sensors with a valid AES key and base address.
+
+        The timers of the sensors already known are kept, as they are more
+        recent than the stored ones, unless they were reset.
+
+        Returns the number of sensors loaded.
+        """
+        db = self.create_session()
+        sensors = db.query(database.Sensor).all()
+        db.close()
+
+        old_sensors = {i.id: i for i in self.sensors.values()}
+        self.sensors = {}
+        for sensor in sensors:
+            address = parse_base_address(sensor.base_address)
+            if address is None or not sensor.aes_key:
+                continue
+            entry = SensorEntry(sensor)
+            old_entry = old_sensors.get(sensor.id)
+            if (old_entry is not None and
+                    old_entry.aes_key == entry.aes_key and
+                    entry.last_timer):
+                entry.last_timer = old_entry.last_timer
+            self.sensors[address] = entry
+        return len(self.sensors)
+
+    def refresh(self):
+        """Loads the table again if the sensors changed."""
+        if self.listener is not None and self.listener.changed("sensors"):
+            self.load()
+
+    def get(self, address):
+        """Returns the SensorEntry sending to <address>, or None."""
+        self.refresh()
+        return self.sensors.get(address)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+import datetime
+import threading
+import time
+
+from libcitizenwatt import database
+
+
+def is_night_rate(start_night_rate, end_night_rate, now=None):
+    """Returns True if the night rate applies at <now>, False otherwise.
+
+    All the times are in seconds since the beginning of the day. <now>
+    defaults to the current time.
+    """
+    if now is None:
+        now = datetime.datetime.now()
+        now = 3600 * now.hour + 60 * now.minute
+    if end_night_rate > start_night_rate:
+        return now > start_night_rate and now < end_night_rate
+    else:
+        return now > start_night_rate or now < end_night_rate
+
+
+def next_switch(start_night_rate, end_night_rate, now=None):
+    """Returns the timestamp of the next change of rate after <now> (a
+    timestamp, defaulting to the current time), as given by
+    is_night_rate at the minute resolution.
+    """
+    if now is None:
+        now = time.time()
+    date = datetime.datetime.fromtimestamp(now)
+    midnight = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    switches = []
+    # The night rate starts the minute after start_night_rate and ends at
+    # end_night_rate
+    for seconds in [(start_night_rate + 60) % 86400, end_night_rate % 86400]:
+        for days in [0, 1]:
+            switch = (midnight + datetime.timedelta(days=days,
+                                                    seconds=seconds))
+            if switch.timestamp() > now:
+                switches.append(switch.timestamp())
+    return min(switches)
+
+
+class RateSchedules():
+    """In-memory copy of the night rate periods of the users, by login,
+    with the current rate and the time it lasts until, so that tagging the
+    API responses with the rate is a time comparison.
+
+    A period is kept for <lifetime> seconds, and forgotten as soon as a
+    "night_rate" invalidation is received from `cache.invalidate`.
+    """
+    def __init__(self, listener=None, lifetime=60):
+        self.listener = listener
+        self.lifetime = lifetime
+        self.lock = threading.Lock()
+        # login: [expires, start_night_rate, end_night_rate, rate, until]
+        self.users = {}
+
+    def rate_type(self, login, db):
+        """Returns "day" or "night" according to the night rate period of
+        the user <login> and to the current time, None if there is no such
+        user.
+        """
+        now = time.time()
+        with self.lock:
+            if (self.listener is not None and
+                    self.listener.changed("night_rate")):
+                self.users = {}
+            entry = self.users.get(login)
+            if entry is None or entry[0] < now:
+                user = (db.query(database.User)
+                        .filter_by(login=login)
+                        .first())
+                if user is None:
+                    entry = [now + self.lifetime, None, None, None, None]
+                else:
+                    entry = [now + self.lifetime, user.start_night_rate,
+                             user.end_night_rate, None, 0]
+                self.users[login] = entry
+            if entry[1] is None:
+                return None
+            if entry[4] <= now:
+                if is_night_rate(entry[1], entry[2]):
+                    entry[3] = "night"
+                else:
+                    entry[3] = "day"
+                entry[4] = next_switch(entry[1], entry[2], now)
+            return entry[3]
+
+
+class NightRateSchedule():
+    """In-memory copy of the night rate period of the admin user.
+
+    The period is loaded from the database on first use, and loaded again
+    when a "night_rate" invalidation is received from
+    `cache.invalidate`.
+    """
+    def __init__(self, create_session, listener=None):
+        self.create_session = create_session
+        self.listener = listener
+        self.start_night_rate = None
+        self.end_night_rate = None
+
+    def load(self):
+        """Loads the night rate period from the database."""
+        db = self.create_session()
+        user = db.query(database.User).filter_by(is_admin=1).first()
+        if user is None:
+            self.start_night_rate = None
+            self.end_night_rate = None
+        else:
+            self.start_night_rate = user.start_night_rate
+            self.end_night_rate = user.end_night_rate
+        db.close()
+
+    def rate_type(self, now=None):
+        """Returns 1 if the night rate applies at <now>, 0 if the day rate
+        applies and -1 if the schedule is unknown (install is not complete).
+        """
+        if self.listener is not None and self.listener.changed("night_rate"):
+            self.start_night_rate = None
+        if self.start_night_rate is None:
+            self.load()
+        if self.start_night_rate is None:
+            return -1
+        elif is_night_rate(self.start_night_rate, self.end_night_rate, now):
+            return 1
+        else:
+            return 0
+
+
+class ProviderTariffs():
+    """In-memory copy of the tariffs of the energy providers.
+
+    The tariffs are loaded from the database on first use, and loaded again
+    after invalidate() or when a "providers" invalidation is received from
+    `cache.invalidate`.
+    """
+    def __init__(self, listener=None):
+        self.listener = listener
+        self.lock = threading.Lock()
+        self.tariffs = None
+        self.current = None
+
+    def invalidate(self):
+        self.tariffs = None
+
+    def load(self, db):
+        """Loads the tariffs of all the providers from the database."""
+        tariffs = {}
+        current = None
+        for provider in db.query(database.Provider).all():
+            tariffs[provider.id] = {"day": provider.day_slope_watt_euros,
+                                    "night": provider.night_slope_watt_euros}
+            if provider.current == 1 and current is None:
+                current = provider.id
+        self.current = current
+        self.tariffs = tariffs
+
+    def get(self, energy_provider, db):
+        """Returns the slopes (€/kWh) of the provider with id
+        <energy_provider>, or of the current provider if it is 0, as a dict
+        with "day" and "night" keys.
+
+        Returns None if there is no such provider.
+        """
+        with self.lock:
+            if (self.listener is not None and
+                    self.listener.changed("providers")):
+                self.tariffs = None
+            if self.tariffs is None:
+                self.load(db)
+            if int(energy_provider) == 0:
+                return self.tariffs.get(self.current)
+            else:
+                return self.tariffs.get(int(energy_provider))
+
+
+provider_tariffs = ProviderTariffs()
+rate_schedules = RateSchedules()
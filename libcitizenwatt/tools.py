@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
+import datetime
 import numpy
 import os
 import sys
 
-from libcitizenwatt import database
+from libcitizenwatt import tariffs
 
 
 def warning(*objs):
@@ -11,27 +12,51 @@ def warning(*objs):
     print("WARNING: ", *objs, file=sys.stderr)
 
 
-def to_dict(model):
-    """Returns a JSON representation of an SQLAlchemy-backed object.
+class Serializer():
+    """JSON representation of the rows of an SQLAlchemy model.
 
+    The columns of the model are resolved once, instead of for each row.
     Returns a timestamp for DateTime fields, to be easily JSON serializable.
+    """
+    def __init__(self, model):
+        columns = model.__table__.columns
+        self.columns = [col.name for col in columns]
+        self.timestamps = [col.name for col in columns
+                           if str(col.type) == "TIMESTAMP"]
+
+    def to_dict(self, row):
+        """Returns a dict of the columns of <row>."""
+        dict = {name: getattr(row, name) for name in self.columns}
+        for name in self.timestamps:
+            dict[name] = dict[name].timestamp()
+        return dict
+
+
+serializers = {}
+
+
+def to_dict(model):
+    """Returns a JSON representation of an SQLAlchemy-backed object, or of
+    a list of them.
 
-    TODO : Use runtime inspection API
-    From https://zato.io/blog/posts/converting-sqlalchemy-objects-to-json.html
+    Uses a Serializer per model, created on first use.
     """
     if isinstance(model, list):
         return [to_dict(i) for i in model]
     else:
-        dict = {}
-        dict['id'] = getattr(model, 'id')
+        model_class = type(model)
+        if model_class not in serializers:
+            serializers[model_class] = Serializer(model_class)
+        return serializers[model_class].to_dict(model)
 
-        for col in model._sa_class_manager.mapper.mapped_table.columns:
-            if str(col.type) == "TIMESTAMP":
-                dict[col.name] = getattr(model, col.name).timestamp()
-            else:
-                dict[col.name] = getattr(model, col.name)
 
-        return dict
+def to_columns(rows):
+    """Returns a list of dicts, e.g. from to_dict, as a dict of columns:
+    {"id": [...], "timestamp": [...], ...}.
+    """
+    if not rows:
+        return {}
+    return {name: [row[name] for row in rows] for name in rows[0]}
 
 
 def last_day(month, year):
@@ -39,7 +64,7 @@ def last_day(month, year):
     if month in [1, 3, 5, 7, 8, 10, 12]:
         return 31
     elif month == 2:
-        if year % 4 == 0 and (not year % 100 or year % 400):
+        if year % 4 == 0 and (year % 100 or not year % 400):
             return 29
         else:
             return 28
@@ -78,31 +103,141 @@ def energy(powers, default_timestep=8):
     return energy
 
 
+def energy_groups(timestamps, values, night_rates, groups, nb_groups,
+                  default_timestep=8):
+    """Compute the energy of several groups of measures at once, as
+    energy() would on each group.
+
+    <timestamps>, <values> and <night_rates> are the columns of the measures,
+    sorted by timestamp, and <groups> the index of the group of each
+    measure. Returns a list of <nb_groups> energies, None for the groups
+    without measures.
+    """
+    groups = numpy.asarray(groups, dtype=int)
+    order = numpy.argsort(groups, kind="mergesort")
+    groups = groups[order]
+    x = numpy.asarray(timestamps, dtype=float)[order]
+    values = numpy.asarray(values, dtype=float)[order]
+    night = numpy.asarray(night_rates, dtype=float)[order] == 1
+    night_rate = numpy.where(night, values, 0)
+    day_rate = numpy.where(night, 0, values)
+
+    # Trapezes between consecutive measures of the same group
+    same_group = groups[1:] == groups[:-1]
+    d = numpy.diff(x)
+    night_areas = numpy.where(same_group,
+                              d * (night_rate[1:] + night_rate[:-1]) / 2.0, 0)
+    day_areas = numpy.where(same_group,
+                            d * (day_rate[1:] + day_rate[:-1]) / 2.0, 0)
+    night_energy = numpy.bincount(groups[1:], night_areas,
+                                  nb_groups) / 1000 / 3600
+    day_energy = numpy.bincount(groups[1:], day_areas,
+                                nb_groups) / 1000 / 3600
+
+    # Groups of a single measure last for default_timestep
+    counts = numpy.bincount(groups, minlength=nb_groups)
+    single = counts == 1
+    night_energy[single] = (numpy.bincount(groups, night_rate, nb_groups)[single] /
+                            1000 * default_timestep / 3600)
+    day_energy[single] = (numpy.bincount(groups, day_rate, nb_groups)[single] /
+                          1000 * default_timestep / 3600)
+
+    energies = []
+    for count, night_value, day_value in zip(counts.tolist(),
+                                             night_energy.tolist(),
+                                             day_energy.tolist()):
+        if count == 0:
+            energies.append(None)
+        else:
+            energies.append({"night_rate": night_value,
+                             "day_rate": day_value,
+                             "value": day_value + night_value})
+    return energies
+
+
 def watt_euros(energy_provider, tariff, consumption, db):
-    if energy_provider != 0:
-        provider = (db.query(database.Provider)
-                    .filter_by(id=energy_provider)
-                    .first())
-    else:
-        provider = (db.query(database.Provider)
-                    .filter_by(current=1)
-                    .first())
-    if not provider:
+    """Returns the cost of <consumption> kWh at <tariff> ("day" or "night")
+    for the provider with id <energy_provider>, or for the current provider
+    if it is 0.
+
+    The tariffs are cached in memory, see tariffs.ProviderTariffs.
+    """
+    slopes = tariffs.provider_tariffs.get(energy_provider, db)
+    if not slopes or tariff not in slopes:
         data = None
     else:
-        if tariff == "night":
-            data = provider.night_slope_watt_euros * consumption
-        elif tariff == "day":
-            data = provider.day_slope_watt_euros * consumption
-        else:
-            data = None
+        data = slopes[tariff] * consumption
     return data
 
 
-def update_base_address(base_address):
-    """Update the address of the base stored in
+def update_base_addresses(base_addresses):
+    """Update the addresses of the base, one per sensor, stored in
     ~/.config/citizenwatt/base_address
     """
     path = os.path.expanduser("~/.config/citizenwatt/base_address")
     with open(path, "w+") as fh:
-        fh.write(str(base_address))
+        fh.write("\n".join([str(i) for i in base_addresses]))
+
+
+# Wall-clock units the bounds of the grouped API calls can be aligned on
+ALIGN_UNITS = ["minute", "hour", "day", "month"]
+
+
+def floor_date(timestamp, align):
+    """Returns the start of the <align> unit holding <timestamp>, as a naive
+    datetime in the local time of the base.
+    """
+    date = datetime.datetime.fromtimestamp(timestamp)
+    date = date.replace(second=0, microsecond=0)
+    if align in ["hour", "day", "month"]:
+        date = date.replace(minute=0)
+    if align in ["day", "month"]:
+        date = date.replace(hour=0)
+    if align == "month":
+        date = date.replace(day=1)
+    return date
+
+
+def next_date(date, align, nb_units=1):
+    """Returns the start of the <nb_units>-th <align> unit after the one
+    starting at <date>.
+    """
+    if align == "minute":
+        return date + datetime.timedelta(minutes=nb_units)
+    elif align == "hour":
+        return date + datetime.timedelta(hours=nb_units)
+    elif align == "day":
+        return date + datetime.timedelta(days=nb_units)
+    else:
+        for i in range(nb_units):
+            date += datetime.timedelta(days=last_day(date.month, date.year))
+        return date
+
+
+def aligned_steps(time1, time2, step, align):
+    """Returns the bounds of the buckets of a grouped API call, snapped to
+    the <align> boundaries ("minute", "hour", "day" or "month") of the
+    local time of the base.
+
+    The first bound is the boundary nearest to <time1>, and the buckets
+    cover up to <time2>. Each bucket lasts for the whole number of units
+    nearest to <step> seconds, months being taken as 30 days for that.
+    """
+    date = floor_date(time1, align)
+    if next_date(date, align).timestamp() - time1 < time1 - date.timestamp():
+        date = next_date(date, align)
+    unit = {"minute": 60, "hour": 3600, "day": 86400, "month": 30 * 86400}
+    unit = unit[align]
+    nb_units = max(1, int(round(step / unit)))
+    # Tolerance for the clients whose clock is slightly off
+    end = time2 - unit / 100
+
+    steps = [date.timestamp()]
+    while steps[-1] < end:
+        if align in ["minute", "hour"]:
+            # Constant length, even when the local time changes
+            steps.append(steps[-1] + nb_units * unit)
+        else:
+            date = next_date(date, align, nb_units)
+            steps.append(date.timestamp())
+    return steps
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Manages the monthly partitions of the measures (see
+libcitizenwatt/partitions.py).
+
+Usage:
+    manage_partitions.py list
+    manage_partitions.py detach YYYY-MM
+    manage_partitions.py archive YYYY-MM [FILE]
+"""
+
+import calendar
+import sys
+
+from libcitizenwatt import cache
+from libcitizenwatt import database
+from libcitizenwatt import partitions
+from libcitizenwatt.config import Config
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+
+def parse_month(month):
+    """Returns the start of the UTC month "YYYY-MM"."""
+    try:
+        year, month = [int(i) for i in month.split("-")]
+        return calendar.timegm((year, month, 1, 0, 0, 0))
+    except ValueError:
+        sys.exit("Invalid month " + month + ", expected YYYY-MM.")
+
+
+def invalidate(db):
+    """Notifies the other processes that measures are no longer served."""
+    cache.invalidate("partitions")
+    for sensor in db.query(database.Sensor).all():
+        cache.invalidate_sensor(sensor.id)
+
+
+# Configuration
+config = Config()
+
+# DB initialization
+database_url = (config.get("database_type") + "://" + config.get("username") +
+                ":" + config.get("password") + "@" + config.get("host") + "/" +
+                config.get("database"))
+engine = create_engine(database_url, echo=config.get("debug"))
+db = sessionmaker(bind=engine)()
+
+if len(sys.argv) < 2 or sys.argv[1] not in ["list", "detach", "archive"]:
+    sys.exit(__doc__)
+elif partitions.registry.mode(engine) is None:
+    sys.exit("Partitioning is disabled, or not supported by the database.")
+
+if sys.argv[1] == "list":
+    for start, name in sorted(partitions.registry.get(engine).items()):
+        print(name)
+elif len(sys.argv) < 3:
+    sys.exit(__doc__)
+elif sys.argv[1] == "detach":
+    start = parse_month(sys.argv[2])
+    try:
+        print("Detached to " + partitions.registry.detach(db, start) + ".")
+    except KeyError as e:
+        sys.exit(str(e))
+    invalidate(db)
+else:
+    start = parse_month(sys.argv[2])
+    if len(sys.argv) > 3:
+        path = sys.argv[3]
+    else:
+        path = partitions.partition_name(start) + ".csv.gz"
+    count = partitions.registry.archive(db, start, path)
+    print("Archived " + str(count) + " measures to " + path + ".")
+    invalidate(db)
+db.close()
@@ -1,48 +1,92 @@
 #!/usr/bin/env python3
 
+import asyncio
 import datetime
-import json
+import fcntl
 import os
 import stat
-import struct
 import sys
 import time
 
+from libcitizenwatt import cache
 from libcitizenwatt import database
+from libcitizenwatt import partitions
+from libcitizenwatt import ringbuffer
+from libcitizenwatt import rollups
 from libcitizenwatt import tools
-from Crypto.Cipher import AES
 from libcitizenwatt.config import Config
+from libcitizenwatt.ingestion import backfill_seq, MeasuresBuffer, Pipeline
+from libcitizenwatt.packets import FRAME_SIZE, split_frames
+from libcitizenwatt.sensors import SensorTable
+from libcitizenwatt.tariffs import NightRateSchedule
 from sqlalchemy import create_engine
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker
 
 
-def get_rate_type(db):
-    """Returns "day" or "night" according to current time
+def decode(frames):
+    """Decrypts the frames read from the fifo.
+
+    Returns the list of the matching measures, as arguments for
+    MeasuresBuffer.add, skipping the invalid packets. The last packet of a
+    sensor is stamped with the current time, and the previous ones of a
+    backlog are dated back by their timer (ms) difference with it.
     """
-    user = db.query(database.User).filter_by(is_admin=1).first()
-    now = datetime.datetime.now()
-    now = 3600 * now.hour + 60 * now.minute
-    if user is None:
-        return -1
-    elif user.end_night_rate > user.start_night_rate:
-        if now > user.start_night_rate and now < user.end_night_rate:
-            return 1
-        else:
-            return 0
+    measures = []
+    now = datetime.datetime.now().timestamp()
+    night_rate = schedule.rate_type()
+    for address, packets in split_frames(frames).items():
+        sensor = sensors.get(address)
+        if sensor is None:
+            tools.warning("Got packets for unknown base address " +
+                          hex(address) + ", skipping them.")
+            continue
+
+        decoded = sensor.decoder.decode(packets)
+        if config.get("debug"):
+            print("New incoming measures from " + sensor.name + ":" +
+                  str(decoded))
+
+        timers = decoded["timer"].tolist()
+        for power, timer in zip(decoded["power"].tolist(), timers):
+            if(sensor.last_timer and sensor.last_timer > 0 and
+               sensor.last_timer < 4233600000 and
+               timer < sensor.last_timer):
+                tools.warning("Invalid timer in the last packet from " +
+                              sensor.name + ", skipping it")
+            else:
+                measures.append((sensor.id,
+                                 power,
+                                 now - max(0, timers[-1] - timer) / 1000,
+                                 night_rate,
+                                 timer))
+                sensor.last_timer = timer
+    return measures
+
+
+def flush(buffer):
+    """Writes the buffered measures to the database."""
+    try:
+        nb_measures = buffer.flush()
+    except SQLAlchemyError as e:
+        tools.warning("Unable to save " + str(len(buffer)) +
+                      " measures: " + str(e))
     else:
-        if now > user.start_night_rate or now < user.end_night_rate:
-            return 1
-        else:
-            return 0
+        if nb_measures:
+            print("Saved successfully " + str(nb_measures) + " measures.")
 
-def get_cw_sensor():
-    """Returns the citizenwatt sensor object or None"""
-    db = create_session()
-    sensor = (db.query(database.Sensor)
-              .filter_by(name="CitizenWatt")
-              .first())
-    db.close()
-    return sensor
+
+def new_measures(measures):
+    """Adds the measures just saved to the ring buffers, invalidates the
+    cache of their sensors and publishes them to the live streams.
+    """
+    ringbuffer.registry.append(measures)
+    cache.new_measures(measures)
+    cache.publish_measures([{"sensor_id": i["sensor_id"],
+                             "value": i["value"],
+                             "timestamp": i["timestamp"],
+                             "night_rate": i["night_rate"]}
+                            for i in measures])
 
 
 # Configuration
@@ -55,55 +99,47 @@ database_url = (config.get("database_type") + "://" + config.get("username") +
 engine = create_engine(database_url, echo=config.get("debug"))
 create_session = sessionmaker(bind=engine)
 database.Base.metadata.create_all(engine)
-
-sensor = get_cw_sensor()
-while not sensor or not sensor.aes_key:
+database.create_missing_columns(engine)
+database.create_missing_indexes(engine)
+partitions.registry.setup(engine)
+
+db = create_session()
+backfill_seq(db)
+rollups.backfill(db)
+ringbuffer.registry.load(db, [i.id for i in db.query(database.Sensor).all()])
+db.close()
+
+partitions.registry.listener = cache.InvalidationListener()
+sensors = SensorTable(create_session, cache.InvalidationListener())
+while not sensors.load():
     tools.warning("Install is not complete ! " +
-                    "Visit http://citizenwatt.local first.")
+                  "Visit http://citizenwatt.local first.")
     time.sleep(1)
-    sensor = get_cw_sensor()
-
-key = json.loads(sensor.aes_key)
-key = struct.pack("<16B", *key)
-
 
 try:
     assert(stat.S_ISFIFO(os.stat(config.get("named_fifo")).st_mode))
 except (AssertionError, FileNotFoundError):
     sys.exit("Unable to open fifo " + config.get("named_fifo") + ".")
 
+schedule = NightRateSchedule(create_session, cache.InvalidationListener())
+buffer = MeasuresBuffer(create_session,
+                        config.get("batch_size"),
+                        config.get("batch_max_latency"),
+                        new_measures,
+                        config.get("max_pending_measures"))
+
+# Blocks until receive.cpp opens the fifo, then reads it without blocking
+fifo = os.open(config.get("named_fifo"), os.O_RDONLY)
+flags = fcntl.fcntl(fifo, fcntl.F_GETFL)
+fcntl.fcntl(fifo, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+loop = asyncio.get_event_loop()
+pipeline = Pipeline(loop, fifo, decode, buffer, FRAME_SIZE,
+                    queue_size=config.get("queue_size"))
 try:
-    with open(config.get("named_fifo"), 'rb') as fifo:
-        while True:
-            measure = fifo.read(16)
-            print("New encrypted packet:" + str(measure))
-
-            decryptor = AES.new(key, AES.MODE_ECB)
-            measure = decryptor.decrypt(measure)
-            measure = struct.unpack("<HHHLlH", measure)
-            print("New incoming measure:" + str(measure))
-
-            power = measure[0]
-            voltage = measure[1]
-            battery = measure[2]
-            timer = measure[3]
-
-            if(sensor.last_timer and sensor.last_timer > 0 and
-               sensor.last_timer < 4233600000 and
-               timer < sensor.last_timer):
-                tools.warning("Invalid timer in the last packet, skipping it")
-            else:
-                db = create_session()
-                measure_db = database.Measures(sensor_id=sensor.id,
-                                               value=power,
-                                               timestamp=datetime.datetime.now().timestamp(),
-                                               night_rate=get_rate_type(db))
-                db.add(measure_db)
-                sensor.last_timer = timer
-                (db.query(database.Sensor)
-                 .filter_by(name="CitizenWatt")
-                 .update({"last_timer": sensor.last_timer}))
-                db.commit()
-                print("Saved successfully.")
+    loop.run_until_complete(pipeline.run())
 except KeyboardInterrupt:
     pass
+finally:
+    flush(buffer)
+    os.close(fifo)
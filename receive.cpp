@@ -1,4 +1,5 @@
 #include <cstdlib>
+#include <cstring>
 #include <iostream>
 #include <fstream>
 #include <string>
@@ -31,6 +32,10 @@ const int NRF_CHANNEL = 0x4c;
 
 const uint64_t default_addr = 0xE056D446D0LL;
 
+// One reading pipe per sensor. The nRF24 has 5 of them, whose addresses must
+// only differ by their last byte.
+const int MAX_SENSORS = 5;
+
 //RF24 radio(RPI_V2_GPIO_P1_15, RPI_V2_GPIO_P1_24, BCM2835_SPI_SPEED_8MHZ);
 RF24 radio("/dev/spidev0.0",8000000 , 25);
 
@@ -40,6 +45,9 @@ char * myfifo = "/tmp/sensor";
 
 int main() {
     uint8_t payload[] = {0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0};
+    // Frame sent to the fifo: base address of the sensor, then its payload
+    uint8_t frame[sizeof(uint64_t) + sizeof(payload)];
+    uint8_t pipe;
 
     // Create FIFO
     mkfifo(myfifo, 0666);
@@ -48,16 +56,28 @@ int main() {
     // Open FIFO - while wait here until another thread opens the same fifo
     fd = open(myfifo, O_WRONLY);
 
-    // Get the address to listen on
+    // Get the addresses to listen on, one per line
+    std::string config_path = "";
+    const char * home = getenv("HOME");
+    if (home != NULL) {
+        config_path = std::string(home) + "/.config/citizenwatt/base_address";
+    }
     std::ifstream config_addr;
-    config_addr.open("~/.config/citizenwatt/base_address", std::ios::in);
-    uint64_t addr;
+    config_addr.open(config_path.c_str(), std::ios::in);
+    uint64_t addrs[MAX_SENSORS];
+    int nb_addrs = 0;
     if (config_addr.is_open()) {
-        config_addr >> addr;
+        while (nb_addrs < MAX_SENSORS && config_addr >> addrs[nb_addrs]) {
+            nb_addrs++;
+        }
         config_addr.close();
+    } else {
+        std::cerr << "Unable to open " << config_path
+                  << ", listening on the default address only.\n";
     }
-    else {
-        addr = default_addr;
+    if (nb_addrs == 0) {
+        addrs[0] = default_addr;
+        nb_addrs = 1;
     }
 
     // Initialize nRF
@@ -75,8 +95,10 @@ int main() {
     radio.setAutoAck(1);
     // Use the best PA level
     radio.setPALevel(NRF_PA_LEVEL);
-    // Open reading pipe
-    radio.openReadingPipe(1, addr);
+    // Open reading pipes
+    for(int i=0; i<nb_addrs; i++) {
+        radio.openReadingPipe(i + 1, addrs[i]);
+    }
 
     radio.startListening();
 
@@ -88,7 +110,7 @@ int main() {
             return 0;
         }
 
-        if(radio.available()) {
+        if(radio.available(&pipe) && pipe >= 1 && pipe <= nb_addrs) {
             radio.read(&payload, sizeof(payload));
 
             if(DEBUG) {
@@ -99,8 +121,10 @@ int main() {
                 std::cout << "\n";
             }
 
-            // Send to fifo
-            write(fd, payload, sizeof(payload));
+            // Send to fifo, tagged with the address of the sensor
+            memcpy(frame, &addrs[pipe - 1], sizeof(uint64_t));
+            memcpy(frame + sizeof(uint64_t), payload, sizeof(payload));
+            write(fd, frame, sizeof(frame));
             // Maybe needed ? fflush(fd)
         }
 	sleep(2);
@@ -9,6 +9,14 @@ var App = function() {
 	  , hash = HashManager()
 	  , rate = RateDisplay()
 	  ;
+	var stream = null; // Live measures, in instant view
+
+	function closeStream() {
+		if (stream) {
+			stream.close();
+			stream = null;
+		}
+	}
 
 	function reload(_, callback) {
 		var mode = menu.getMode()
@@ -16,6 +24,7 @@ var App = function() {
 		  , unit = menu.getUnit()
 		  ;
 
+		closeStream();
 		graph.clean();
 		graph = unit == 'energy' ? Graph(mode == 'now' ? 'W' : 'kWh') : PriceGraph(mode == 'now' ? 'cents/min' : '€');
 		graph.autoremove = mode == 'now' && date === null;
@@ -101,7 +110,8 @@ var App = function() {
 					+= '/by_time/'
 					+  dateutils.getDayStart(date) / 1000.0 + '/'
 					+  dateutils.getDayEnd(date) / 1000.0 + '/'
-					+  dateutils.getHourLength(date) / 1000.0;
+					+  dateutils.getHourLength(date) / 1000.0
+					+  '?align=hour';
 					graph.setOverviewLabel('Consommation ' + dateutils.humanDay(date));
 					modifier = 1. / (dateutils.getMonthLength(date) / dateutils.getDayLength());
 					break;
@@ -111,7 +121,8 @@ var App = function() {
 					+= '/by_time/'
 					+  (dateutils.getWeekStart(date) / 1000.0) + '/'
 					+  ((dateutils.getWeekStart(date) + dateutils.getDayLength(date) * 7) / 1000.0) + '/' // Avoid pbs with Daylight Saving Time
-					+  (dateutils.getDayLength(date) / 1000.0);
+					+  (dateutils.getDayLength(date) / 1000.0)
+					+  '?align=day';
 					graph.setOverviewLabel('Consommation ' + dateutils.humanWeek(date));
 					modifier = 7. / (dateutils.getMonthLength(date) / dateutils.getDayLength());
 					break;
@@ -121,7 +132,8 @@ var App = function() {
 					+= '/by_time/'
 					+  dateutils.getMonthStart(date) / 1000.0 + '/'
 					+  dateutils.getMonthEnd(date) / 1000.0 + '/'
-					+  dateutils.getDayLength(date) / 1000.0;
+					+  dateutils.getDayLength(date) / 1000.0
+					+  '?align=day';
 					graph.setOverviewLabel('Consommation ' + dateutils.humanMonth(date));
 					modifier = 1.0;
 					break;
@@ -181,7 +193,20 @@ var App = function() {
 	 */
 	api.update = function() {
 		if (menu.getMode() == 'now' && menu.getDate() === null && menu.isUpdated()) {
+			if (stream) return;
 			provider.getSensorId(function(sensor_id) {
+				if (menu.getUnit() == 'energy' && !stream) {
+					// Live power is pushed by the server, no need to poll
+					stream = provider.stream(sensor_id, function(m) {
+						// Skip the measures already fetched at init (server time)
+						if (m.timestamp * 1000.0 > graph.last_call * 1000.0 + dateutils.offset) {
+							graph.addRect(m.value);
+							graph.setOverview(m.value);
+						}
+					});
+					if (stream) return;
+				}
+
 				var target
 				= '/' + sensor_id + '/get/'
 				+ menu.getUnitString()
@@ -36,6 +36,28 @@ var DataProvider = function() {
 	}
 
 
+	/**
+	 * Get the new measures of a sensor as they arrive, through server-sent
+	 * events.
+	 * @param sensor_id: Sensor to follow
+	 * @param callback: callback that takes each new measure
+	 * @return the EventSource, to be closed with close(), or null if the
+	 * browser does not support it.
+	 */
+	api.stream = function(sensor_id, callback) {
+		if (!window.EventSource) return null;
+		var source = new EventSource(API_URL + '/' + sensor_id + '/stream');
+		source.onmessage = function(ev) {
+			var res = JSON.parse(ev.data);
+			if (res.rate) {
+				api.onratechange(res.rate);
+			}
+			callback(res.data);
+		};
+		return source;
+	}
+
+
 	/**
 	 * Get current provider info
 	 * @param callback: callback that takes provider
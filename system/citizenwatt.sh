@@ -21,6 +21,9 @@ sleep 0.2
 echo "Starting processing script…"
 screen -dmS process && screen -S process -p 0 -X stuff "while true; do python3 process.py; done$(printf \\r)"
 echo "Done !\n"
+echo "Starting precomputation worker…"
+screen -dmS worker && screen -S worker -p 0 -X stuff "while true; do python3 worker.py; done$(printf \\r)"
+echo "Done !\n"
 
 while ! curl -s --head http://localhost:8080 2>&1 > /dev/null; do
     echo "Webserver is starting…"
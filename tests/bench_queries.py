@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""Benchmark of the queries of the API on a synthetic dataset.
+
+Fills a database (SQLite file by default, not the one of the config) with
+several years of measures for a few sensors, then records the EXPLAIN plan
+and the latency of each query shape used by cache.py and visu.py.
+
+With --partitioning, the measures are stored in monthly partitions (see
+libcitizenwatt/partitions.py), and queried through them.
+
+Usage: python3 bench_queries.py [--url URL] [--years N] [--sensors N]
+                                [--timestep S] [--runs N] [--partitioning]
+                                [--output FILE]
+"""
+
+import argparse
+import datetime
+import json
+import random
+import statistics
+import time
+
+from libcitizenwatt import cache
+from libcitizenwatt import database
+from libcitizenwatt import partitions
+from libcitizenwatt import rollups
+from libcitizenwatt.ingestion import backfill_seq
+from sqlalchemy import asc, create_engine, desc, func, select, union_all
+from sqlalchemy.orm import sessionmaker
+
+
+def fill(db, nb_sensors, years, timestep, chunk_size=1000):
+    """Adds <nb_sensors> sensors with a measure every <timestep> seconds
+    for the last <years> years, if the database is empty.
+    """
+    if db.query(database.Sensor).first() is not None:
+        print("Using the existing dataset.")
+        return
+
+    measure_type = database.MeasureType(name="Electricity")
+    db.add(measure_type)
+    db.flush()
+    sensors = []
+    for i in range(nb_sensors):
+        sensor = database.Sensor(name="Sensor " + str(i),
+                                 type_id=measure_type.id,
+                                 last_timer=0)
+        db.add(sensor)
+        db.flush()
+        sensors.append(sensor.id)
+    db.commit()
+
+    end = int(datetime.datetime.now().timestamp())
+    start = end - int(years * 365 * 86400)
+    print("Inserting " + str(len(sensors) * (end - start) // timestep) +
+          " measures…")
+    measures = []
+    for seq, timestamp in enumerate(range(start, end, timestep)):
+        for sensor in sensors:
+            measures.append({"sensor_id": sensor,
+                             "value": random.randint(0, 4000),
+                             "timestamp": timestamp,
+                             "night_rate": int(timestamp % 86400 < 21600),
+                             "seq": seq + 1})
+        if len(measures) >= chunk_size:
+            partitions.registry.insert(db, measures)
+            measures = []
+    if measures:
+        partitions.registry.insert(db, measures)
+    db.commit()
+    rollups.backfill(db)
+
+
+def query_shapes(db, sensor):
+    """Returns the (name, query) of the query shapes of the API, for
+    <sensor>, on the last day of data.
+    """
+    source = partitions.registry.source(db, sensor)
+    last = (db.query(source)
+            .filter(source.c.sensor_id == sensor)
+            .order_by(desc(source.c.seq))
+            .first())
+    time2 = last.timestamp
+    time1 = time2 - 86400
+    id2 = last.id
+    id1 = id2 - 500
+    day = partitions.registry.source(db, sensor, time1, time2)
+    # The max of each table, as in partitions.max_value
+    seqs = union_all(*[select([func.max(table.c.seq).label("value")])
+                       .where(table.c.sensor_id == sensor)
+                       for table in partitions.registry.tables(db)])
+    seqs = seqs.alias("values")
+    return [("by_id single",
+             db.query(source).filter(source.c.sensor_id == sensor,
+                                     source.c.id == id2)),
+            ("by_id range",
+             cache.query_measures(db, source)
+             .filter(source.c.sensor_id == sensor,
+                     source.c.id >= id1,
+                     source.c.id < id2)
+             .order_by(asc(source.c.timestamp))),
+            ("by_id last",
+             cache.filter_positions(cache.query_measures(db, source), source,
+                                    sensor, -500, 0, last.seq)),
+            ("by_id deep",
+             cache.filter_positions(cache.query_measures(db, source), source,
+                                    sensor, -last.seq // 2 - 500,
+                                    -last.seq // 2, last.seq)),
+            ("by_time single",
+             db.query(day).filter(day.c.sensor_id == sensor,
+                                  day.c.timestamp == time2)),
+            ("by_time range",
+             cache.query_measures(db, day)
+             .filter(day.c.sensor_id == sensor,
+                     day.c.timestamp >= time1,
+                     day.c.timestamp < time2)
+             .order_by(asc(day.c.timestamp))),
+            # cache.last_id, without a ring buffer
+            ("last seq",
+             db.query(func.max(seqs.c.value))),
+            ("last id",
+             db.query(source.c.id)
+             .filter(source.c.sensor_id == sensor,
+                     source.c.seq == last.seq)
+             .limit(1)),
+            ("rollup 1h range",
+             db.query(database.Measures1h)
+             .filter(database.Measures1h.sensor_id == sensor,
+                     database.Measures1h.timestamp >= time1 - 30 * 86400,
+                     database.Measures1h.timestamp < time2)
+             .order_by(asc(database.Measures1h.timestamp)))]
+
+
+def explain(db, query):
+    """Returns the plan of <query>, as a list of lines."""
+    dialect = db.bind.dialect
+    sql = str(query.statement.compile(dialect=dialect,
+                                      compile_kwargs={"literal_binds": True}))
+    if dialect.name == "sqlite":
+        rows = db.execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+        return [str(row[-1]) for row in rows]
+    else:
+        rows = db.execute("EXPLAIN " + sql).fetchall()
+        return [" ".join([str(i) for i in row]) for row in rows]
+
+
+def bench(db, query, runs):
+    """Returns the median latency of <query>, in milliseconds."""
+    latencies = []
+    for i in range(runs):
+        start = time.perf_counter()
+        query.all()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return statistics.median(latencies)
+
+
+parser = argparse.ArgumentParser(description="Benchmark of the API queries.")
+parser.add_argument("--url", default="sqlite:////tmp/citizenwatt_bench.db",
+                    help="database URL (default: %(default)s)")
+parser.add_argument("--years", type=float, default=2,
+                    help="years of measures (default: %(default)s)")
+parser.add_argument("--sensors", type=int, default=2,
+                    help="number of sensors (default: %(default)s)")
+parser.add_argument("--timestep", type=int, default=60,
+                    help="seconds between measures (default: %(default)s)")
+parser.add_argument("--runs", type=int, default=20,
+                    help="runs of each query (default: %(default)s)")
+parser.add_argument("--partitioning", action="store_true",
+                    help="store the measures in monthly partitions")
+parser.add_argument("--output", default="bench_queries.json",
+                    help="results file (default: %(default)s)")
+args = parser.parse_args()
+
+# Only for this run, the config file is not saved
+partitions.config.set("partitioning", args.partitioning)
+
+engine = create_engine(args.url)
+database.Base.metadata.create_all(engine)
+database.create_missing_columns(engine)
+database.create_missing_indexes(engine)
+partitions.registry.setup(engine)
+db = sessionmaker(bind=engine)()
+backfill_seq(db)
+
+fill(db, args.sensors, args.years, args.timestep)
+sensor = db.query(database.Sensor).first().id
+
+results = []
+for name, query in query_shapes(db, sensor):
+    result = {"query": name,
+              "plan": explain(db, query),
+              "latency_ms": bench(db, query, args.runs)}
+    results.append(result)
+    print("%-16s %8.2f ms" % (name, result["latency_ms"]))
+    for line in result["plan"]:
+        print("    " + line)
+db.close()
+
+with open(args.output, "w") as fh:
+    fh.write(json.dumps({"url": args.url,
+                         "partitioning": args.partitioning,
+                         "years": args.years,
+                         "sensors": args.sensors,
+                         "timestep": args.timestep,
+                         "results": results}, indent=4))
+print("Results written to " + args.output + ".")
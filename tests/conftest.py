@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Fixtures of the tests of libcitizenwatt, run with pytest from the root of
+the repository."""
+import os
+import tempfile
+
+# The modules load (and create) ~/.config/citizenwatt/config.json on import
+os.environ["HOME"] = tempfile.mkdtemp()
+
+import pytest
+
+from libcitizenwatt import cache
+from libcitizenwatt import database
+from libcitizenwatt import partitions
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+
+class FakeRedis():
+    """In-memory stand-in for the Redis commands used by cache.py."""
+    def __init__(self):
+        self.data = {}
+        self.published = []
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        self.data[key] = str(value)
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1)
+        return int(self.data[key])
+
+    def hincrby(self, key, field, amount=1):
+        fields = self.data.setdefault(key, {})
+        fields[field] = str(int(fields.get(field, 0)) + amount)
+        return int(fields[field])
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+        return 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline():
+    """Queues the commands until execute(), as redis.client.Pipeline."""
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+        return command
+
+    def execute(self):
+        results = [getattr(self.redis, name)(*args, **kwargs)
+                   for name, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    """Replaces the Redis server of cache.py with a FakeRedis."""
+    fake = FakeRedis()
+    monkeypatch.setattr(cache, "get_redis", lambda: fake)
+    return fake
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    """Gives each test its own registry of partitions."""
+    fresh = partitions.Partitions()
+    monkeypatch.setattr(partitions, "registry", fresh)
+    return fresh
+
+
+@pytest.fixture
+def create_session(tmp_path):
+    """Returns the session factory of a new SQLite database, with a sensor
+    of id 1 and one of id 2.
+    """
+    engine = create_engine("sqlite:///" + str(tmp_path / "citizenwatt.db"))
+    database.Base.metadata.create_all(engine)
+    create_session = sessionmaker(bind=engine)
+    db = create_session()
+    db.add(database.MeasureType(id=1, name="Électricité"))
+    db.add(database.Sensor(id=1, name="CitizenWatt", type_id=1,
+                           last_timer=0))
+    db.add(database.Sensor(id=2, name="Other", type_id=1, last_timer=0))
+    db.commit()
+    db.close()
+    return create_session
+
+
+@pytest.fixture
+def db(create_session):
+    """Returns a session on the database of create_session."""
+    session = create_session()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def failing_commits(create_session):
+    """Returns a session factory like create_session, whose commits fail
+    while its "fail" attribute is True.
+    """
+    def failing_session():
+        session = create_session()
+        commit = session.commit
+
+        def failing_commit():
+            if failing_session.fail:
+                raise OperationalError("COMMIT", {},
+                                       Exception("database is locked"))
+            commit()
+        session.commit = failing_commit
+        return session
+    failing_session.fail = True
+    return failing_session
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+import time
+
+import pytest
+
+from libcitizenwatt import archive
+from libcitizenwatt import database
+from libcitizenwatt import partitions
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    """Returns a new Archive under a temporary directory."""
+    monkeypatch.setitem(archive.config.config, "archive_path", str(tmp_path))
+    return archive.Archive()
+
+
+def add(db, sensor_id, timestamp, value, night_rate):
+    db.add(database.Measures(sensor_id=sensor_id, timestamp=timestamp,
+                             value=value, night_rate=night_rate))
+
+
+def test_write_round_trip(db, store):
+    start = partitions.month_start(1400000000)
+    end = partitions.next_month(start)
+    add(db, 1, start + 20, 2.5, 1)
+    add(db, 1, start + 10, None, -1)
+    add(db, 1, end, 3, 0)
+    add(db, 2, start + 15, 4, 0)
+    db.commit()
+
+    assert store.write(db, 1, start) == 2
+
+    assert store.months(1) == [start]
+    assert store.end(1) == end
+    timestamps, values, night_rates = store.columns(1, start, end)
+    assert timestamps.tolist() == [start + 10, start + 20]
+    assert values.tolist() == [0, 2.5]
+    assert night_rates.tolist() == [-1, 1]
+    assert store.columns(1, start + 15, end)[0].tolist() == [start + 20]
+    assert store.columns(2, start, end)[0].tolist() == []
+
+
+def test_export_closed_months(db, store):
+    now = time.time()
+    current = partitions.month_start(now)
+    previous = partitions.month_start(current - 1)
+    add(db, 1, previous + 10, 1, 0)
+    add(db, 1, now, 2, 0)
+    db.commit()
+
+    assert store.export(db) == 1
+    assert store.months(1) == [previous]
+    assert store.months(2) == []
+    # Archived months are not written again
+    assert store.export(db) == 0
+
+
+def test_export_survives_a_failed_month(db, store, monkeypatch):
+    now = time.time()
+    previous = partitions.month_start(partitions.month_start(now) - 1)
+    add(db, 1, previous + 10, 1, 0)
+    add(db, 2, previous + 10, 2, 0)
+    db.commit()
+    write = store.write
+
+    def failing_write(db, sensor, start):
+        if sensor == 1:
+            raise OSError("No space left on device")
+        return write(db, sensor, start)
+    monkeypatch.setattr(store, "write", failing_write)
+
+    assert store.export(db) == 1
+    assert store.months(1) == []
+    assert store.months(2) == [previous]
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+import re
+
+from libcitizenwatt import auth
+
+
+class Listener():
+    def __init__(self):
+        self.topics = set()
+
+    def changed(self, topic):
+        changed = topic in self.topics
+        self.topics.discard(topic)
+        return changed
+
+
+def test_new_token():
+    tokens = set([auth.new_token() for i in range(100)])
+    assert len(tokens) == 100
+    for token in tokens:
+        assert re.match(r"^[A-Za-z0-9_-]{43}$", token)
+
+
+def test_hash_token():
+    assert auth.hash_token("abc") == auth.hash_token("abc")
+    assert auth.hash_token("abc") != auth.hash_token("abd")
+    assert len(auth.hash_token("abc")) == 64
+
+
+def test_verified_credentials():
+    listener = Listener()
+    credentials = auth.VerifiedCredentials(listener)
+    calls = []
+
+    def verify(result):
+        def verify():
+            calls.append(result)
+            return result
+        return verify
+
+    assert not credentials.check("token:bad", verify(False))
+    assert not credentials.check("token:bad", verify(False))
+    assert calls == [False, False]
+
+    assert credentials.check("token:good", verify(True))
+    assert credentials.check("token:good", verify(False))
+    assert calls == [False, False, True]
+
+    # A revoked token is verified again
+    listener.topics.add("credentials")
+    assert not credentials.check("token:good", verify(False))
+
+
+def test_verified_credentials_expire(monkeypatch):
+    credentials = auth.VerifiedCredentials(lifetime=60)
+    now = [1000]
+    monkeypatch.setattr(auth.time, "time", lambda: now[0])
+
+    assert credentials.check("password:x", lambda: True)
+    now[0] += 30
+    assert credentials.check("password:x", lambda: False)
+    now[0] += 31
+    assert not credentials.check("password:x", lambda: False)
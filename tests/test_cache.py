@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+import time
+
+import pytest
+
+from libcitizenwatt import cache
+from libcitizenwatt import database
+from libcitizenwatt import partitions
+from libcitizenwatt import ringbuffer
+from libcitizenwatt import rollups
+from libcitizenwatt import tools
+
+
+def entry(is_open, watt_euros="watts", sensor=1):
+    return cache.CacheEntry("by_time", sensor, watt_euros, [0, 60], is_open)
+
+
+def test_store_many_round_trip(redis):
+    cache.store_many([("a", [1, 2], None), ("b", {"value": 1}, 60)])
+    assert cache.fetch_many(["a", "b", "c"]) == [[1, 2], {"value": 1}, None]
+    assert cache.fetch_many([]) == []
+    assert cache.fetch("b") == {"value": 1}
+
+
+def test_entry_round_trip_and_stats(redis):
+    first = entry(False)
+    assert first.fetch() is None
+    first.store([1, 2, 3])
+    assert entry(False).fetch() == [1, 2, 3]
+
+    stats = cache.cache_stats()["by_time"]
+    assert stats == {"lookups": 2, "misses": 1, "hit_rate": 0.5}
+
+
+def test_invalidate_sensor_changes_all_its_keys(redis):
+    keys = [entry(False).key, entry(True).key]
+    other = entry(False, sensor=2).key
+
+    cache.invalidate_sensor(1)
+
+    assert entry(False).key not in keys
+    assert entry(True).key not in keys
+    assert entry(False, sensor=2).key == other
+
+
+def test_new_measures_only_change_open_keys(redis):
+    closed, open_ = entry(False).key, entry(True).key
+    other = entry(True, sensor=2).key
+
+    cache.new_measures([{"sensor_id": 1, "timestamp": time.time()}])
+
+    assert entry(False).key == closed
+    assert entry(True).key != open_
+    assert entry(True, sensor=2).key == other
+
+
+def test_late_measures_change_closed_keys(redis):
+    closed = entry(False).key
+    late = time.time() - cache.config.get("batch_max_latency") - 60
+
+    cache.new_measures([{"sensor_id": 1, "timestamp": late}])
+
+    assert entry(False).key != closed
+
+
+def test_providers_only_change_euros_keys(redis):
+    watts, euros = entry(False).key, entry(False, "euros").key
+
+    cache.invalidate("providers")
+
+    assert entry(False).key == watts
+    assert entry(False, "euros").key != euros
+    assert (cache.INVALIDATION_CHANNEL, "providers") in redis.published
+
+
+def test_is_closed():
+    now = time.time()
+    assert cache.is_closed(now - cache.config.get("batch_max_latency") - 2)
+    assert not cache.is_closed(now)
+
+
+# Aligned on a UTC day
+START = 1400000000 - 1400000000 % 86400
+
+
+def add_measures(db, count, timestep=10):
+    """Stores <count> measures of sensor 1 every <timestep> seconds from
+    START, and updates the rollups.
+    """
+    measures = [{"sensor_id": 1, "timestamp": START + i * timestep,
+                 "value": 100 + i % 7, "night_rate": i % 2}
+                for i in range(count)]
+    db.execute(database.Measures.__table__.insert().values(measures))
+    rollups.update(db, measures)
+    db.commit()
+    return db.query(database.Measures).order_by(database.Measures.id).all()
+
+
+def expected(measures, steps):
+    """Returns tools.energy over each [steps[k], steps[k + 1][ bucket."""
+    energies = []
+    for start, end in zip(steps[:-1], steps[1:]):
+        bucket = [i for i in measures if start <= i.timestamp < end]
+        energies.append(tools.energy(bucket) if bucket else None)
+    return energies
+
+
+def assert_energies(energies, expected):
+    assert len(energies) == len(expected)
+    for energy, expected_energy in zip(energies, expected):
+        if expected_energy is None:
+            assert energy is None
+        else:
+            assert energy == pytest.approx(expected_energy)
+
+
+def test_buckets_are_half_open(redis, db):
+    measures = add_measures(db, 200)
+    # No rollup fits 90s steps: computed from the measures, some of them
+    # falling on the bounds
+    steps = [START + 30 + 90 * k for k in range(20)]
+    assert rollups.fitting_level(steps) is None
+
+    assert_energies(cache.bucket_energies(1, steps, db),
+                    expected(measures, steps))
+
+
+def test_buckets_match_the_rollups(redis, db):
+    measures = add_measures(db, 400)
+    steps = [START + 60 * k for k in range(70)]
+    assert rollups.fitting_level(steps) is not None
+
+    assert_energies(cache.bucket_energies(1, steps, db),
+                    expected(measures, steps))
+
+
+def test_closed_buckets_are_reused(redis, db):
+    measures = add_measures(db, 200)
+    steps = [START + 30 + 90 * k for k in range(10)]
+    cache.bucket_energies(1, steps[:6], db)
+    db.query(database.Measures).delete()
+    db.commit()
+
+    # The first buckets come from the cache, the others are computed again
+    energies = cache.bucket_energies(1, steps[3:], db)
+    assert_energies(energies[:2], expected(measures, steps[3:6]))
+    assert energies[2:] == [None for i in steps[6:]]
+    stats = cache.cache_stats()["bucket"]
+    assert (stats["lookups"], stats["misses"]) == (11, 9)
+
+    cache.invalidate_sensor(1)
+    assert cache.bucket_energies(1, steps[3:], db) == [None for i in steps[4:]]
+    assert_energies(cache.bucket_energies(1, steps[3:6], db,
+                                          force_refresh=True),
+                    [None, None])
+
+
+def test_precomputed_views_are_hits(redis, db):
+    add_measures(db, 2000, timestep=60)
+    time1, time2 = START, START + 86400
+    cache.precompute_group_timestamp(1, time1, time2, 3600, "hour", db,
+                                     ["kwatthours"])
+
+    # A client a few seconds off shares the same buckets
+    data = cache.do_cache_group_timestamp(1, "kwatthours", time1 + 5,
+                                          time2 + 5, 3600, db, align="hour")
+
+    assert len(data) == 24
+    assert cache.cache_stats()["by_time_step"] == {"lookups": 1, "misses": 0,
+                                                   "hit_rate": 1}
+    assert data == cache.do_cache_group_timestamp(1, "kwatthours", time1,
+                                                  time2, 3600, db,
+                                                  align="hour",
+                                                  force_refresh=True)
+
+
+@pytest.mark.parametrize("partitioning", [False, True])
+def test_last_id_per_sensor(db, monkeypatch, tmp_path, partitioning):
+    monkeypatch.setitem(partitions.config.config, "partitioning",
+                        partitioning)
+    monkeypatch.setitem(ringbuffer.config.config, "ring_buffer_path",
+                        str(tmp_path))
+    monkeypatch.setitem(ringbuffer.config.config, "ring_buffer_size", 4)
+    monkeypatch.setattr(ringbuffer, "registry", ringbuffer.RingBuffers())
+    measures = [{"sensor_id": sensor_id, "timestamp": START + seq,
+                 "value": 1, "night_rate": 0, "seq": seq}
+                for seq in [1, 2] for sensor_id in [1, 2]]
+    partitions.registry.insert(db, measures)
+    db.commit()
+
+    assert cache.last_id(db, 1) == 3
+    assert cache.last_id(db, 2) == 4
+    assert cache.last_id(db, 3) == 0
+
+    # Read from the ring buffer of the sensor if any, written by process.py
+    ringbuffer.RingBuffers().append([dict(measures[2], id=42)])
+    assert cache.last_id(db, 1) == 42
+    assert cache.last_id(db, 2) == 4
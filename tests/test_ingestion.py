@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+import asyncio
+import fcntl
+import os
+import struct
+
+import pytest
+
+from libcitizenwatt import database
+from libcitizenwatt.ingestion import backfill_seq, last_seq
+from libcitizenwatt.ingestion import MeasuresBuffer, Pipeline
+from sqlalchemy.exc import OperationalError
+
+
+def stored(db, sensor_id):
+    """Returns the values of the stored measures of <sensor_id>."""
+    return [i.value for i in
+            db.query(database.Measures)
+            .filter_by(sensor_id=sensor_id)
+            .order_by(database.Measures.id)]
+
+
+def numbered(db, sensor_id):
+    """Returns the (seq, value) of the stored measures of <sensor_id>."""
+    return [(i.seq, i.value) for i in
+            db.query(database.Measures)
+            .filter_by(sensor_id=sensor_id)
+            .order_by(database.Measures.seq)]
+
+
+def test_flush_writes_the_batch(create_session, db):
+    buffer = MeasuresBuffer(create_session)
+    buffer.add(1, 100, 1400000000, 0, 10)
+    buffer.add(2, 200, 1400000001, 0, 20)
+    buffer.add(1, 101, 1400000008, 1, 11)
+
+    assert buffer.flush() == 3
+    assert len(buffer) == 0
+    assert buffer.flush() == 0
+    assert stored(db, 1) == [100, 101]
+    assert stored(db, 2) == [200]
+    assert db.query(database.Sensor).get(1).last_timer == 11
+    assert db.query(database.Sensor).get(2).last_timer == 20
+
+
+def test_on_write_gets_the_written_batches(create_session):
+    written = []
+    buffer = MeasuresBuffer(create_session, on_write=written.extend)
+    buffer.add(1, 100, 1400000000, 0, 10)
+    buffer.add(2, 200, 1400000001, 0, 20)
+    buffer.flush()
+
+    assert [(i["sensor_id"], i["value"]) for i in written] == [(1, 100),
+                                                               (2, 200)]
+
+
+def test_failed_flush_keeps_the_batch(failing_commits, db):
+    written = []
+    buffer = MeasuresBuffer(failing_commits, on_write=written.extend)
+    buffer.add(1, 100, 1400000000, 0, 10)
+    with pytest.raises(OperationalError):
+        buffer.flush()
+    assert len(buffer) == 1
+    assert stored(db, 1) == []
+    assert written == []
+
+    buffer.add(1, 101, 1400000008, 0, 11)
+    failing_commits.fail = False
+    assert buffer.flush() == 2
+    assert stored(db, 1) == [100, 101]
+    assert db.query(database.Sensor).get(1).last_timer == 11
+    assert [i["value"] for i in written] == [100, 101]
+    # The failed attempt did not consume positions
+    assert numbered(db, 1) == [(1, 100), (2, 101)]
+
+
+def test_failed_on_write_keeps_the_saved_batch(create_session, db, capsys):
+    def on_write(measures):
+        raise RuntimeError("Redis is down")
+    buffer = MeasuresBuffer(create_session, on_write=on_write)
+    buffer.add(1, 100, 1400000000, 0, 10)
+
+    assert buffer.flush() == 1
+    assert len(buffer) == 0
+    assert "Redis is down" in capsys.readouterr().err
+
+    buffer.add(1, 101, 1400000008, 0, 11)
+    buffer.flush()
+    # The saved batch is not written again
+    assert numbered(db, 1) == [(1, 100), (2, 101)]
+
+
+def test_flush_numbers_the_measures_per_sensor(create_session, db):
+    buffer = MeasuresBuffer(create_session)
+    buffer.add(1, 100, 1400000000, 0, 10)
+    buffer.add(2, 200, 1400000001, 0, 20)
+    buffer.add(1, 101, 1400000008, 1, 11)
+    buffer.flush()
+    buffer.add(1, 102, 1400000016, 1, 12)
+    buffer.flush()
+
+    assert numbered(db, 1) == [(1, 100), (2, 101), (3, 102)]
+    assert numbered(db, 2) == [(1, 200)]
+    assert last_seq(db, 1) == 3
+    assert last_seq(db, 2) == 1
+
+
+def test_seq_follows_the_stored_measures(create_session, db):
+    db.add(database.Measures(sensor_id=1, value=1, timestamp=1, seq=41))
+    db.commit()
+
+    buffer = MeasuresBuffer(create_session)
+    buffer.add(1, 100, 1400000000, 0, 10)
+    buffer.flush()
+
+    assert numbered(db, 1) == [(41, 1), (42, 100)]
+
+
+def test_backfill_seq_numbers_by_timestamp(db):
+    # id: (sensor_id, timestamp)
+    rows = {1: (1, 30), 2: (1, 10), 3: (2, 10), 4: (1, None), 5: (1, 20),
+            6: (1, 10), 7: (1, None)}
+    for id, (sensor_id, timestamp) in rows.items():
+        db.add(database.Measures(id=id, sensor_id=sensor_id, value=id,
+                                 timestamp=timestamp))
+    db.commit()
+
+    backfill_seq(db, chunk_size=2)
+
+    # By (timestamp, id), then the measures without timestamp by id
+    assert numbered(db, 1) == [(1, 2), (2, 6), (3, 5), (4, 1), (5, 4), (6, 7)]
+    assert numbered(db, 2) == [(1, 3)]
+
+
+def test_backfill_seq_skips_numbered_sensors(db):
+    db.add(database.Measures(id=1, sensor_id=1, value=1, timestamp=1, seq=5))
+    db.commit()
+
+    backfill_seq(db)
+
+    assert numbered(db, 1) == [(5, 1)]
+
+
+def test_restore_keeps_at_most_max_pending(create_session):
+    buffer = MeasuresBuffer(create_session, max_pending=3)
+    for i in range(2):
+        buffer.add(1, i, 1400000000 + i, 0, i)
+    batch = buffer.take()
+    for i in range(2, 4):
+        buffer.add(1, i, 1400000000 + i, 0, i)
+
+    buffer.restore(batch)
+
+    assert [i["value"] for i in buffer.measures] == [1, 2, 3]
+    assert buffer.timers == {1: 3}
+
+
+def test_is_due(create_session):
+    buffer = MeasuresBuffer(create_session, max_size=2, max_latency=60)
+    assert buffer.timeout() is None
+    assert not buffer.is_due()
+    buffer.add(1, 100, 1400000000, 0, 10)
+    assert 0 < buffer.timeout() <= 60
+    assert not buffer.is_due()
+    buffer.add(1, 101, 1400000008, 0, 11)
+    assert buffer.is_due()
+
+
+def test_is_due_after_max_latency(create_session):
+    buffer = MeasuresBuffer(create_session, max_size=64, max_latency=0)
+    buffer.add(1, 100, 1400000000, 0, 10)
+    assert buffer.timeout() == 0
+    assert buffer.is_due()
+
+
+def decode(packets):
+    """Decodes the packets of run_pipeline: a measure of sensor 1 each."""
+    values = [struct.unpack("<I", packet)[0] for packet in packets]
+    return [(1, value, 1400000000 + value, 0, value) for value in values]
+
+
+def run_pipeline(buffer, values, queue_size=1024):
+    """Runs a Pipeline reading packets holding <values> from a pipe, until
+    the end of the pipe.
+    """
+    read_fd, write_fd = os.pipe()
+    flags = fcntl.fcntl(read_fd, fcntl.F_GETFL)
+    fcntl.fcntl(read_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    os.write(write_fd, b"".join([struct.pack("<I", i) for i in values]))
+    os.close(write_fd)
+    loop = asyncio.new_event_loop()
+    # The queue and the events of the pipeline use the current loop
+    asyncio.set_event_loop(loop)
+    pipeline = Pipeline(loop, read_fd, decode, buffer, packet_size=4,
+                        queue_size=queue_size)
+    try:
+        loop.run_until_complete(pipeline.run())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+        os.close(read_fd)
+    return pipeline
+
+
+def test_pipeline_writes_all_the_packets(create_session, db):
+    buffer = MeasuresBuffer(create_session, max_size=4, max_latency=60)
+    batches = []
+    write = buffer.write
+
+    def counting_write(batch):
+        batches.append(len(batch[0]))
+        write(batch)
+    buffer.write = counting_write
+
+    pipeline = run_pipeline(buffer, range(10))
+
+    assert stored(db, 1) == list(range(10))
+    assert sum(batches) == 10
+    assert max(batches) <= 10
+    assert pipeline.stats["packets"] == 10
+    assert pipeline.stats["pauses"] == 0
+    assert db.query(database.Sensor).get(1).last_timer == 9
+
+
+def test_pipeline_pauses_the_reads_when_the_queue_is_full(create_session,
+                                                          db):
+    buffer = MeasuresBuffer(create_session, max_size=4, max_latency=60)
+
+    pipeline = run_pipeline(buffer, range(100), queue_size=8)
+
+    assert pipeline.stats["pauses"] > 0
+    assert pipeline.stats["max_queue_depth"] <= 8
+    assert stored(db, 1) == list(range(100))
+
+
+def test_pipeline_retries_a_failed_batch(failing_commits, db, capsys):
+    buffer = MeasuresBuffer(failing_commits, max_size=4, max_latency=0)
+    write = buffer.write
+
+    def failing_once(batch):
+        try:
+            write(batch)
+        finally:
+            failing_commits.fail = False
+    buffer.write = failing_once
+
+    run_pipeline(buffer, range(20), queue_size=8)
+
+    assert "will retry" in capsys.readouterr().err
+    assert stored(db, 1) == list(range(20))
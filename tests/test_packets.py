@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+import struct
+
+import pytest
+
+from Crypto.Cipher import AES
+from libcitizenwatt import packets
+
+
+KEY = bytes(range(16))
+
+
+def encrypt(*fields):
+    """Returns the packet of a sensor holding <fields>, encrypted with KEY."""
+    return AES.new(KEY, AES.MODE_ECB).encrypt(struct.pack("<HHHLlH",
+                                                          *fields))
+
+
+def test_decode_matches_struct_unpack():
+    sent = [(100, 230, 3300, 8000, 0, 0), (4000, 231, 3290, 16000, -1, 7)]
+    decoded = packets.Decoder(KEY).decode([encrypt(*i) for i in sent])
+
+    assert decoded.tolist() == sent
+    assert decoded["power"].tolist() == [100, 4000]
+    assert decoded["timer"].tolist() == [8000, 16000]
+
+
+def test_decode_a_buffer():
+    buffer = encrypt(1, 2, 3, 4, 5, 6) + encrypt(7, 8, 9, 10, 11, 12)
+    decoded = packets.Decoder(KEY).decode(buffer)
+    assert decoded["power"].tolist() == [1, 7]
+    assert len(packets.Decoder(KEY).decode(b"")) == 0
+
+
+def test_decode_truncated():
+    with pytest.raises(ValueError):
+        packets.Decoder(KEY).decode(encrypt(1, 2, 3, 4, 5, 6)[:-1])
+
+
+def test_split_frames():
+    frames = [struct.pack("<Q", 0xA) + b"a" * 16,
+              struct.pack("<Q", 0xB) + b"b" * 16,
+              struct.pack("<Q", 0xA) + b"c" * 16]
+    assert packets.split_frames(frames) == {0xA: b"a" * 16 + b"c" * 16,
+                                            0xB: b"b" * 16}
+    assert packets.split_frames(b"".join(frames)) == \
+        packets.split_frames(frames)
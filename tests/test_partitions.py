@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+import calendar
+import csv
+import gzip
+
+import pytest
+
+from libcitizenwatt import database
+from libcitizenwatt import partitions
+from sqlalchemy import inspect, select
+
+
+JANUARY = calendar.timegm((2014, 1, 1, 0, 0, 0))
+FEBRUARY = calendar.timegm((2014, 2, 1, 0, 0, 0))
+MARCH = calendar.timegm((2014, 3, 1, 0, 0, 0))
+
+
+@pytest.fixture(autouse=True)
+def partitioning(monkeypatch):
+    monkeypatch.setitem(partitions.config.config, "partitioning", True)
+
+
+def measure(sensor_id, timestamp, seq):
+    return {"sensor_id": sensor_id, "value": seq, "timestamp": timestamp,
+            "night_rate": 0, "seq": seq}
+
+
+def values(db, source):
+    return sorted([i.value for i in db.execute(select([source.c.value]))])
+
+
+def test_months():
+    assert partitions.month_start(JANUARY + 86400 * 40) == FEBRUARY
+    assert partitions.next_month(JANUARY) == FEBRUARY
+    assert partitions.next_month(FEBRUARY) == MARCH
+    assert partitions.partition_name(FEBRUARY) == "measures_y2014m02"
+    assert partitions.partition_start("measures_y2014m02") == FEBRUARY
+    assert partitions.partition_start("measures_1m") is None
+
+
+def test_insert_routes_to_the_months(db, registry):
+    db.add(database.Measures(id=7, sensor_id=1, value=0, timestamp=1, seq=1))
+    db.commit()
+    measures = [measure(1, JANUARY + 10, 2), measure(2, FEBRUARY, 1),
+                measure(1, FEBRUARY + 10, 3)]
+
+    registry.insert(db, measures)
+    db.commit()
+
+    assert [i["id"] for i in measures] == [8, 9, 10]
+    tables = inspect(db.get_bind()).get_table_names()
+    assert "measures_y2014m01" in tables and "measures_y2014m02" in tables
+    assert values(db, registry.table("measures_y2014m01")) == [2]
+    assert values(db, registry.table("measures_y2014m02")) == [1, 3]
+    assert values(db, database.Measures.__table__) == [0]
+
+
+def test_source_unions_the_months_in_range(db, registry):
+    db.add(database.Measures(id=1, sensor_id=1, value=0, timestamp=1, seq=1))
+    db.commit()
+    registry.insert(db, [measure(1, JANUARY, 2), measure(1, FEBRUARY, 3),
+                         measure(2, FEBRUARY, 1)])
+    db.commit()
+
+    assert values(db, registry.source(db)) == [0, 1, 2, 3]
+    assert values(db, registry.source(db, 1)) == [0, 2, 3]
+    source = registry.source(db, 1, FEBRUARY, MARCH)
+    assert values(db, source) == [3]
+    compiled = str(source.element)
+    assert "measures_y2014m02" in compiled
+    assert "measures_y2014m01" not in compiled
+
+
+def test_max_value_takes_the_max_of_each_table(db, registry):
+    db.add(database.Measures(id=1, sensor_id=1, value=0, timestamp=1, seq=1))
+    db.commit()
+    assert registry.max_value(db, "seq", 1) == 1
+    assert registry.max_value(db, "seq", 2) is None
+
+    registry.insert(db, [measure(1, JANUARY, 2), measure(1, FEBRUARY, 3),
+                         measure(2, JANUARY, 1)])
+    db.commit()
+
+    assert registry.max_value(db, "seq", 1) == 3
+    assert registry.max_value(db, "seq", 2) == 1
+    assert registry.max_value(db, "id") == 4
+
+def test_detach_and_archive(db, registry, tmp_path):
+    registry.insert(db, [measure(1, JANUARY, 1), measure(1, FEBRUARY, 2)])
+    db.commit()
+
+    path = str(tmp_path / "measures_y2014m01.csv.gz")
+    assert registry.archive(db, JANUARY, path) == 1
+
+    assert list(registry.get(db.get_bind()).keys()) == [FEBRUARY]
+    assert values(db, registry.source(db)) == [2]
+    with gzip.open(path, "rt") as fh:
+        rows = list(csv.reader(fh))
+    assert rows[0] == partitions.COLUMNS
+    assert rows[1][partitions.COLUMNS.index("value")] == "1.0"
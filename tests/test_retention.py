@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+import calendar
+
+import pytest
+
+from libcitizenwatt import archive
+from libcitizenwatt import cache
+from libcitizenwatt import database
+from libcitizenwatt import partitions
+from libcitizenwatt import retention
+from libcitizenwatt import rollups
+
+
+DAY = 86400
+# Aligned on a UTC day
+START = 1400000000 - 1400000000 % DAY
+NOW = START + 10 * DAY
+
+
+@pytest.fixture
+def settings(monkeypatch, tmp_path):
+    """Returns a function setting the retention settings for the test, the
+    archive being written under a temporary directory.
+    """
+    monkeypatch.setattr(retention, "PAUSE", 0)
+    monkeypatch.setitem(archive.config.config, "archive_path", str(tmp_path))
+    monkeypatch.setattr(archive, "registry", archive.Archive())
+
+    def settings(**values):
+        for key, value in values.items():
+            monkeypatch.setitem(retention.config.config, key, value)
+    settings(retention_raw_days=0, retention_1m_days=0, retention_1h_days=0,
+             retention_1d_days=0)
+    return settings
+
+
+def add_days(db, sensor_id, days, start=START):
+    """Stores a measure of <sensor_id> at noon of each day of <days>, and
+    updates the rollups.
+    """
+    measures = [{"sensor_id": sensor_id, "value": 100, "night_rate": 0,
+                 "timestamp": start + i * DAY + DAY // 2, "seq": i + 1}
+                for i in days]
+    for measure in measures:
+        db.add(database.Measures(**measure))
+    rollups.update(db, measures)
+    db.commit()
+
+
+def timestamps(db, model, sensor_id=1):
+    return [i.timestamp for i in
+            db.query(model).filter_by(sensor_id=sensor_id)
+            .order_by(model.timestamp)]
+
+
+def test_cutoffs(settings):
+    assert retention.cutoffs(NOW) == []
+
+    settings(retention_raw_days=3, retention_1h_days=30)
+
+    assert retention.cutoffs(NOW) == [
+        (database.Measures.__table__, NOW - 3 * DAY),
+        (database.Measures1h.__table__, NOW - 30 * DAY)]
+
+
+def test_delete_batches(db, settings):
+    add_days(db, 1, range(10))
+    add_days(db, 2, range(10))
+    table = database.Measures.__table__
+
+    assert retention.delete_batches(db, table, 1, START + 5 * DAY, 2) == 5
+
+    assert len(timestamps(db, database.Measures)) == 5
+    assert timestamps(db, database.Measures)[0] == START + 5 * DAY + DAY // 2
+    assert len(timestamps(db, database.Measures, 2)) == 10
+    assert retention.delete_batches(db, table, 1, START + 5 * DAY, 2) == 0
+
+
+def cache_key(sensor):
+    return cache.CacheEntry("by_time", sensor, "watts", [0, 60], False).key
+
+
+def test_compact(db, settings, redis):
+    add_days(db, 1, range(10))
+    add_days(db, 2, range(10))
+    settings(retention_raw_days=3, retention_1m_days=5)
+    keys = [cache_key(1), cache_key(2)]
+
+    # Raw measures and minutes of both sensors
+    assert retention.compact(db, NOW) == 2 * (7 + 5)
+
+    assert len(timestamps(db, database.Measures)) == 3
+    assert len(timestamps(db, database.Measures, 2)) == 3
+    assert len(timestamps(db, database.Measures1m)) == 5
+    assert len(timestamps(db, database.Measures1h)) == 10
+    assert len(timestamps(db, database.Measures1d)) == 10
+    # The cached values stay valid
+    assert [cache_key(1), cache_key(2)] == keys
+
+
+def test_compact_keeps_the_measures_not_archived(db, settings, monkeypatch):
+    add_days(db, 1, range(10))
+    add_days(db, 2, range(10))
+    settings(retention_raw_days=3)
+    write = archive.registry.write
+
+    def failing_write(db, sensor, start):
+        if sensor == 1:
+            raise OSError("No space left on device")
+        return write(db, sensor, start)
+    monkeypatch.setattr(archive.registry, "write", failing_write)
+
+    assert retention.compact(db, NOW) == 7
+
+    assert len(timestamps(db, database.Measures)) == 10
+    assert len(timestamps(db, database.Measures, 2)) == 3
+
+
+def test_compact_deletes_nothing_if_the_export_fails(db, settings,
+                                                     monkeypatch):
+    add_days(db, 1, range(10))
+    settings(retention_raw_days=3, retention_1m_days=5)
+
+    def failing_export(db):
+        raise OSError("Permission denied")
+    monkeypatch.setattr(archive.registry, "export", failing_export)
+
+    assert retention.compact(db, NOW) == 0
+
+    assert len(timestamps(db, database.Measures)) == 10
+    assert len(timestamps(db, database.Measures1m)) == 10
+
+def test_compact_drops_the_expired_partitions(db, settings, registry,
+                                              monkeypatch, redis):
+    monkeypatch.setitem(partitions.config.config, "partitioning", True)
+    january = calendar.timegm((2014, 1, 1, 0, 0, 0))
+    march = calendar.timegm((2014, 3, 1, 0, 0, 0))
+    # From January 1 to February 20, every 10 days
+    registry.insert(db, [{"sensor_id": 1, "value": 1, "night_rate": 0,
+                          "timestamp": january + i * 10 * DAY, "seq": i + 1}
+                         for i in range(6)])
+    db.commit()
+    settings(retention_raw_days=10)
+
+    # Cutoff on February 19
+    retention.compact(db, march)
+
+    assert list(registry.get(db.get_bind()).values()) == ["measures_y2014m02"]
+    assert ([i.timestamp for i in db.execute(registry.source(db).select())] ==
+            [january + 50 * DAY])
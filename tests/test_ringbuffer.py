@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import pytest
+
+from libcitizenwatt import ringbuffer
+
+
+@pytest.fixture
+def buffers(monkeypatch, tmp_path):
+    """Returns new RingBuffers of 4 slots under a temporary directory."""
+    monkeypatch.setitem(ringbuffer.config.config, "ring_buffer_path",
+                        str(tmp_path))
+    monkeypatch.setitem(ringbuffer.config.config, "ring_buffer_size", 4)
+    return ringbuffer.RingBuffers()
+
+
+def measures(sensor_id, seqs):
+    return [{"id": 10 * seq, "sensor_id": sensor_id, "timestamp": 100 * seq,
+             "value": float(seq), "night_rate": seq % 2, "seq": seq}
+            for seq in seqs]
+
+
+def seqs(rows):
+    return [i.seq for i in rows]
+
+
+def test_wraps_around(buffers):
+    buffers.append(measures(1, range(1, 7)))
+    reader = ringbuffer.RingBuffers()
+
+    last, rows = reader.positions(1, -2, 0)
+    assert last == 6
+    assert seqs(rows) == [5, 6]
+    assert rows[-1] == ringbuffer.Measure(60, 600, 6.0, 0, 6)
+    assert seqs(reader.positions(1, -4, -1)[1]) == [3, 4, 5]
+    # Position 2 was overwritten
+    assert reader.positions(1, -5, 0) is None
+    assert reader.positions(2, -1, 0) is None
+
+
+def test_gap_resets_the_buffer(buffers):
+    buffers.append(measures(1, [1, 2, 3]))
+    buffers.append(measures(1, [7]))
+
+    assert seqs(buffers.positions(1, -1, 0)[1]) == [7]
+    assert buffers.positions(1, -2, 0) is None
+
+
+def test_by_id_and_times(buffers):
+    buffers.append(measures(1, range(1, 7)))
+
+    assert seqs(buffers.by_id(1, 50)) == [5]
+    assert buffers.by_id(1, 55) == []
+    # Older than the buffer
+    assert buffers.by_id(1, 20) is None
+    assert seqs(buffers.times(1, 450, 600)) == [5]
+    assert buffers.times(1, 100, 600) is None
+
+
+def test_read_waits_for_the_writer(buffers):
+    buffers.append(measures(1, [1]))
+    writer = buffers.writer(1)
+    reader = ringbuffer.RingBuffers().get(1)
+
+    # Odd lock counter: a write is in progress
+    ringbuffer.LOCK.pack_into(writer.map, ringbuffer.LOCK_OFFSET, 3)
+    assert reader.read(lambda first, last: last) is None
+
+    ringbuffer.LOCK.pack_into(writer.map, ringbuffer.LOCK_OFFSET, 4)
+    attempts = []
+
+    def racing_reader(first, last):
+        # The first attempt sees a write happen during the read
+        if not attempts:
+            writer.write(measures(1, [2]))
+        attempts.append(last)
+        return last
+    assert reader.read(racing_reader) == 2
+    assert attempts == [1, 2]
+
+
+def test_reader_follows_a_new_file(buffers, monkeypatch):
+    buffers.append(measures(1, [1, 2]))
+    reader = ringbuffer.RingBuffers()
+    assert reader.positions(1, -1, 0)[0] == 2
+
+    monkeypatch.setitem(ringbuffer.config.config, "ring_buffer_size", 8)
+    ringbuffer.RingBuffers().append(measures(1, [5]))
+
+    assert reader.positions(1, -1, 0)[0] == 5
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+import collections
+import random
+
+import pytest
+
+from libcitizenwatt import database
+from libcitizenwatt import rollups
+from libcitizenwatt import tools
+
+
+# Aligned on a UTC day
+START = 1400000000 - 1400000000 % 86400
+Measure = collections.namedtuple("Measure",
+                                 ["timestamp", "value", "night_rate"])
+
+
+def points(count, timestep=7):
+    """Returns <count> measures every <timestep> seconds from START, some
+    at the night rate, one falling on the start of the second hour.
+    """
+    timestamps = [START + i * timestep for i in range(count)]
+    timestamps.append(START + 3600)
+    return [Measure(timestamp, 100 + timestamp % 50, (timestamp // 1000) % 2)
+            for timestamp in sorted(set(timestamps))]
+
+
+def store(db, measures, batch_size=50):
+    """Stores <measures> and updates the rollups, by batches."""
+    for i in range(0, len(measures), batch_size):
+        batch = [{"sensor_id": 1, "timestamp": measure.timestamp,
+                  "value": measure.value, "night_rate": measure.night_rate}
+                 for measure in measures[i:i + batch_size]]
+        db.execute(database.Measures.__table__.insert().values(batch))
+        rollups.update(db, batch)
+        db.commit()
+
+
+def expected(measures, steps):
+    """Returns the energies of tools.energy over the measures of each step
+    [steps[i], steps[i + 1][.
+    """
+    energies = []
+    for time1, time2 in zip(steps[:-1], steps[1:]):
+        group = [i for i in measures if time1 <= i.timestamp < time2]
+        energies.append(tools.energy(group) if group else None)
+    return energies
+
+
+def assert_energies(energies, expected):
+    assert len(energies) == len(expected)
+    for energy, expected_energy in zip(energies, expected):
+        if expected_energy is None:
+            assert energy is None
+        else:
+            assert energy == pytest.approx(expected_energy)
+
+
+@pytest.mark.parametrize("step", [60, 600, 3600])
+def test_group_matches_tools_energy(db, step):
+    measures = points(2000)
+    store(db, measures)
+    steps = list(range(START - step, START + 5 * 3600, step))
+
+    assert_energies(rollups.group(db, 1, steps), expected(measures, steps))
+
+
+def test_group_uses_the_coarsest_level():
+    assert rollups.fitting_level([START, START + 86400]) is \
+        database.Measures1d
+    assert rollups.fitting_level([START, START + 7200]) is \
+        database.Measures1h
+    assert rollups.fitting_level([START, START + 90]) is None
+
+
+def test_group_without_fitting_level(db):
+    assert rollups.group(db, 1, [START, START + 90]) is None
+
+
+def test_single_measure(db):
+    measures = [Measure(START + 10, 500, 1)]
+    store(db, measures)
+    steps = [START, START + 60, START + 120]
+
+    assert_energies(rollups.group(db, 1, steps), expected(measures, steps))
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_measures_out_of_order(db, seed):
+    measures = points(1000)
+    shuffled = list(measures)
+    # Swap some measures, within and across batches
+    generator = random.Random(seed)
+    for i in range(50):
+        a = generator.randrange(len(shuffled))
+        b = min(len(shuffled) - 1, a + generator.randrange(1, 80))
+        shuffled[a], shuffled[b] = shuffled[b], shuffled[a]
+    store(db, shuffled)
+
+    for step in [60, 3600]:
+        steps = list(range(START, START + 3 * 3600, step))
+        assert_energies(rollups.group(db, 1, steps),
+                        expected(measures, steps))
+    for row in db.query(database.Measures1m):
+        period = [i for i in measures
+                  if row.timestamp <= i.timestamp < row.timestamp + 60]
+        assert row.count == len(period)
+        assert row.first_timestamp == period[0].timestamp
+        assert row.last_timestamp == period[-1].timestamp
+
+
+def test_rebuild_matches_update(db):
+    measures = points(1000, timestep=13)
+    store(db, measures)
+    steps = list(range(START, START + 4 * 3600, 600))
+    energies = rollups.group(db, 1, steps)
+
+    rollups.rebuild(db, 1)
+    db.commit()
+
+    assert_energies(rollups.group(db, 1, steps), energies)
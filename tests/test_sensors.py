@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import json
+
+from libcitizenwatt import database
+from libcitizenwatt.sensors import base_addresses, parse_base_address
+from libcitizenwatt.sensors import SensorTable
+
+
+KEY = json.dumps(list(range(16)))
+
+
+class Listener():
+    """Stand-in for cache.InvalidationListener."""
+    def __init__(self):
+        self.topics = set()
+
+    def poll(self, timeout=0):
+        topics = self.topics
+        self.topics = set()
+        return topics
+
+    def changed(self, topic):
+        return topic in self.poll()
+
+
+def configure(db, sensor_id, base_address, aes_key=KEY, last_timer=None):
+    sensor = db.query(database.Sensor).get(sensor_id)
+    sensor.base_address = base_address
+    sensor.aes_key = aes_key
+    if last_timer is not None:
+        sensor.last_timer = last_timer
+    db.commit()
+
+
+def test_parse_base_address():
+    assert parse_base_address("0XE056D446D0LL") == 0xE056D446D0
+    assert parse_base_address("0xe056d446d1") == 0xE056D446D1
+    assert parse_base_address("nope") is None
+    assert parse_base_address(None) is None
+
+
+def test_base_addresses(db):
+    assert base_addresses(db) == []
+    configure(db, 2, "0XE056D446D1LL")
+    configure(db, 1, "0XE056D446D0LL", aes_key=None)
+    db.add(database.Sensor(id=3, name="Invalid", type_id=1,
+                           base_address="nope"))
+    db.commit()
+
+    assert base_addresses(db) == [0xE056D446D0, 0xE056D446D1]
+
+
+def test_load_keys_the_sensors_by_address(create_session, db):
+    configure(db, 1, "0XE056D446D0LL")
+    configure(db, 2, "0XE056D446D1LL", aes_key=None)
+    table = SensorTable(create_session)
+
+    assert table.load() == 1
+    assert len(table) == 1
+    assert table.get(0xE056D446D0).id == 1
+    assert table.get(0xE056D446D1) is None
+    assert len(table.get(0xE056D446D0).decoder.decode(b"\0" * 32)) == 2
+
+
+def test_load_keeps_the_newer_timers(create_session, db):
+    configure(db, 1, "0XE056D446D0LL", last_timer=100)
+    configure(db, 2, "0XE056D446D1LL", last_timer=100)
+    table = SensorTable(create_session)
+    table.load()
+    table.get(0xE056D446D0).last_timer = 500
+    table.get(0xE056D446D1).last_timer = 500
+
+    # The timer of sensor 2 was reset
+    configure(db, 2, "0XE056D446D1LL", last_timer=0)
+    table.load()
+
+    assert table.get(0xE056D446D0).last_timer == 500
+    assert table.get(0xE056D446D1).last_timer == 0
+
+
+def test_reloads_on_invalidation(create_session, db):
+    listener = Listener()
+    table = SensorTable(create_session, listener)
+    table.load()
+    configure(db, 2, "0XE056D446D1LL")
+
+    assert table.get(0xE056D446D1) is None
+    listener.topics.add("sensors")
+    assert table.get(0xE056D446D1).id == 2
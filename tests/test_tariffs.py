@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+import datetime
+
+from libcitizenwatt import database
+from libcitizenwatt import tariffs
+
+
+# Night rate from 22:00 to 6:00, in seconds since the beginning of the day
+START = 22 * 3600
+END = 6 * 3600
+
+
+class Listener():
+    """Stand-in for cache.InvalidationListener."""
+    def __init__(self):
+        self.topics = set()
+
+    def poll(self, timeout=0):
+        topics = self.topics
+        self.topics = set()
+        return topics
+
+    def changed(self, topic):
+        return topic in self.poll()
+
+
+def add_admin(create_session, start, end):
+    db = create_session()
+    db.add(database.User(login="admin", is_admin=1, start_night_rate=start,
+                         end_night_rate=end))
+    db.commit()
+    db.close()
+
+
+def test_is_night_rate_boundaries():
+    # The night rate starts after START and ends at END
+    assert not tariffs.is_night_rate(START, END, START)
+    assert tariffs.is_night_rate(START, END, START + 60)
+    assert tariffs.is_night_rate(START, END, 0)
+    assert tariffs.is_night_rate(START, END, END - 60)
+    assert not tariffs.is_night_rate(START, END, END)
+    assert not tariffs.is_night_rate(START, END, 12 * 3600)
+
+
+def test_is_night_rate_within_a_day():
+    assert tariffs.is_night_rate(3600, 7 * 3600, 2 * 3600)
+    assert not tariffs.is_night_rate(3600, 7 * 3600, 3600)
+    assert not tariffs.is_night_rate(3600, 7 * 3600, 23 * 3600)
+
+
+def test_schedule_rate_type(create_session):
+    add_admin(create_session, START, END)
+    schedule = tariffs.NightRateSchedule(create_session)
+
+    assert schedule.rate_type(START) == 0
+    assert schedule.rate_type(START + 60) == 1
+    assert schedule.rate_type(END - 60) == 1
+    assert schedule.rate_type(END) == 0
+
+
+def test_schedule_without_admin(create_session):
+    schedule = tariffs.NightRateSchedule(create_session)
+    assert schedule.rate_type(0) == -1
+
+
+def test_schedule_follows_the_invalidations(create_session, db):
+    listener = Listener()
+    schedule = tariffs.NightRateSchedule(create_session, listener)
+    assert schedule.rate_type(0) == -1
+
+    add_admin(create_session, START, END)
+    listener.topics.add("night_rate")
+    assert schedule.rate_type(0) == 1
+
+    db.query(database.User).update({"start_night_rate": 3600,
+                                    "end_night_rate": 7 * 3600})
+    db.commit()
+    # Kept in memory until invalidated
+    assert schedule.rate_type(0) == 1
+    listener.topics.add("other")
+    assert schedule.rate_type(0) == 1
+    listener.topics.add("night_rate")
+    assert schedule.rate_type(0) == 0
+    assert schedule.rate_type(2 * 3600) == 1
+
+
+def test_provider_tariffs(db):
+    db.add(database.Provider(id=1, name="A", type_id=1, current=0,
+                             day_slope_watt_euros=0.15,
+                             night_slope_watt_euros=0.1))
+    db.add(database.Provider(id=2, name="B", type_id=1, current=1,
+                             day_slope_watt_euros=0.2,
+                             night_slope_watt_euros=0.12))
+    db.commit()
+    listener = Listener()
+    provider_tariffs = tariffs.ProviderTariffs(listener)
+
+    assert provider_tariffs.get(1, db) == {"day": 0.15, "night": 0.1}
+    # 0 is the current provider
+    assert provider_tariffs.get(0, db) == {"day": 0.2, "night": 0.12}
+    assert provider_tariffs.get(3, db) is None
+
+    db.query(database.Provider).update({"day_slope_watt_euros": 0.3})
+    db.commit()
+    # Kept in memory until invalidated
+    assert provider_tariffs.get("1", None)["day"] == 0.15
+    listener.topics.add("providers")
+    assert provider_tariffs.get(1, db)["day"] == 0.3
+
+
+def at(day, hour, minute=0):
+    return datetime.datetime(2014, 5, day, hour, minute).timestamp()
+
+
+def test_next_switch():
+    assert tariffs.next_switch(START, END, at(13, 12)) == at(13, 22, 1)
+    assert tariffs.next_switch(START, END, at(13, 23)) == at(14, 6)
+    assert tariffs.next_switch(START, END, at(13, 3)) == at(13, 6)
+    assert tariffs.next_switch(START, END, at(13, 6)) == at(13, 22, 1)
+
+
+def test_next_switch_matches_is_night_rate():
+    for hour, minute in [(21, 59), (22, 0), (22, 1), (5, 59), (6, 0)]:
+        now = at(13, hour, minute)
+        switch = tariffs.next_switch(START, END, now)
+        date = datetime.datetime.fromtimestamp(switch)
+        before = 3600 * date.hour + 60 * date.minute - 60
+        after = 3600 * date.hour + 60 * date.minute
+        assert (tariffs.is_night_rate(START, END, before % 86400) !=
+                tariffs.is_night_rate(START, END, after))
+
+
+def test_rate_schedules(db):
+    db.add(database.User(login="admin", start_night_rate=START,
+                         end_night_rate=END))
+    db.commit()
+    listener = Listener()
+    schedules = tariffs.RateSchedules(listener)
+
+    if tariffs.is_night_rate(START, END):
+        expected = "night"
+    else:
+        expected = "day"
+    assert schedules.rate_type("admin", db) == expected
+    assert schedules.rate_type("nobody", db) is None
+    # Served from memory
+    assert schedules.rate_type("admin", None) == expected
+
+    listener.topics.add("night_rate")
+    db.query(database.User).update({"start_night_rate": None})
+    db.commit()
+    assert schedules.rate_type("admin", db) is None
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+import collections
+import datetime
+import random
+import time
+
+import pytest
+
+from libcitizenwatt import database
+from libcitizenwatt import tools
+
+
+Measure = collections.namedtuple("Measure",
+                                 ["timestamp", "value", "night_rate"])
+
+
+def per_group(measures, groups, nb_groups):
+    """Returns the energies of tools.energy over each group."""
+    energies = []
+    for group in range(nb_groups):
+        members = [i for i, g in zip(measures, groups) if g == group]
+        energies.append(tools.energy(members) if members else None)
+    return energies
+
+
+def assert_energies(energies, expected):
+    assert len(energies) == len(expected)
+    for energy, expected_energy in zip(energies, expected):
+        if expected_energy is None:
+            assert energy is None
+        else:
+            assert energy == pytest.approx(expected_energy)
+
+
+def energy_groups(measures, groups, nb_groups):
+    return tools.energy_groups([i.timestamp for i in measures],
+                               [i.value for i in measures],
+                               [i.night_rate for i in measures],
+                               groups, nb_groups)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_energy_groups_matches_energy(seed):
+    rand = random.Random(seed)
+    timestamp = 1400000000
+    measures = []
+    for i in range(500):
+        timestamp += rand.randint(1, 20)
+        measures.append(Measure(timestamp, rand.uniform(0, 4000),
+                                rand.choice([0, 1, -1])))
+    nb_groups = 40
+    # Sorted groups, some empty and some of a single measure
+    groups = sorted([rand.randint(0, nb_groups - 1) for i in measures])
+
+    assert_energies(energy_groups(measures, groups, nb_groups),
+                    per_group(measures, groups, nb_groups))
+
+
+def test_energy_groups_single_and_empty():
+    measures = [Measure(10, 1000, 0), Measure(20, 2000, 1),
+                Measure(30, 3000, 1), Measure(40, 500, 0)]
+    groups = [0, 2, 2, 3]
+
+    energies = energy_groups(measures, groups, 5)
+
+    assert_energies(energies, per_group(measures, groups, 5))
+    assert energies[1] is None and energies[4] is None
+    assert energies[0]["day_rate"] == pytest.approx(1000 / 1000 * 8 / 3600)
+    assert energies[2]["night_rate"] == pytest.approx(25000 / 1000 / 3600)
+
+
+def test_energy_groups_without_measures():
+    assert energy_groups([], [], 3) == [None, None, None]
+
+
+def test_to_dict_and_to_columns():
+    rows = [database.Measures(id=1, sensor_id=2, value=3.5, timestamp=10,
+                              night_rate=0),
+            database.Measures(id=2, sensor_id=2, value=4.5, timestamp=18,
+                              night_rate=1)]
+
+    dicts = tools.to_dict(rows)
+
+    assert dicts[0] == dict(tools.to_dict(rows[0]))
+    assert dicts[1]["value"] == 4.5 and dicts[1]["night_rate"] == 1
+    columns = tools.to_columns(dicts)
+    assert columns["id"] == [1, 2]
+    assert columns["timestamp"] == [10, 18]
+    assert sorted(columns.keys()) == sorted(dicts[0].keys())
+    assert tools.to_columns([]) == {}
+
+
+@pytest.fixture
+def paris(monkeypatch):
+    """Sets the local time of the base to Europe/Paris."""
+    monkeypatch.setenv("TZ", "Europe/Paris")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def local(*args):
+    return datetime.datetime(*args).timestamp()
+
+
+def test_last_day():
+    assert tools.last_day(2, 1900) == 28
+    assert tools.last_day(2, 2000) == 29
+    assert tools.last_day(2, 2014) == 28
+    assert tools.last_day(2, 2016) == 29
+    assert tools.last_day(4, 2014) == 30
+    assert tools.last_day(12, 2014) == 31
+
+
+def test_floor_and_next_date(paris):
+    date = tools.floor_date(local(2014, 3, 30, 14, 25, 12), "month")
+    assert date == datetime.datetime(2014, 3, 1)
+    assert tools.next_date(date, "month", 2) == datetime.datetime(2014, 5, 1)
+    assert (tools.next_date(datetime.datetime(1900, 2, 1), "month") ==
+            datetime.datetime(1900, 3, 1))
+    assert (tools.floor_date(local(2014, 3, 30, 14, 25, 12), "hour") ==
+            datetime.datetime(2014, 3, 30, 14))
+
+
+def test_aligned_days_across_dst_in_spring(paris):
+    steps = tools.aligned_steps(local(2014, 3, 29, 0, 10),
+                                local(2014, 4, 1), 86400, "day")
+
+    assert steps[0] == local(2014, 3, 29)
+    assert steps[-1] == local(2014, 4, 1)
+    # March 30 lasts 23 hours
+    lengths = [b - a for a, b in zip(steps[:-1], steps[1:])]
+    assert lengths == [86400, 82800, 86400]
+
+
+def test_aligned_days_across_dst_in_autumn(paris):
+    steps = tools.aligned_steps(local(2014, 10, 25, 23, 50),
+                                local(2014, 10, 28), 86400, "day")
+
+    # Nearest boundary to time1
+    assert steps[0] == local(2014, 10, 26)
+    lengths = [b - a for a, b in zip(steps[:-1], steps[1:])]
+    assert lengths == [90000, 86400]
+
+
+def test_aligned_hours_across_dst(paris):
+    steps = tools.aligned_steps(local(2014, 3, 30, 0, 20),
+                                local(2014, 3, 30, 6), 3600, "hour")
+
+    # Six bounds for five hours of local time, as 2:00 does not exist
+    assert len(steps) == 6
+    assert set([b - a for a, b in zip(steps[:-1], steps[1:])]) == set([3600])
+    assert datetime.datetime.fromtimestamp(steps[2]).hour == 3
+
+
+def test_aligned_months(paris):
+    steps = tools.aligned_steps(local(2014, 1, 1), local(2014, 4, 1),
+                                30 * 86400, "month")
+
+    assert [datetime.datetime.fromtimestamp(i).month for i in steps] == \
+        [1, 2, 3, 4]
+    # A 2-month step
+    steps = tools.aligned_steps(local(2014, 1, 1), local(2014, 5, 1),
+                                61 * 86400, "month")
+    assert [datetime.datetime.fromtimestamp(i).month for i in steps] == \
+        [1, 3, 5]
@@ -72,6 +72,50 @@
                     </form>
                 </article>
 
+                <article id="api_tokens">
+                    <h2>Jetons d'API</h2>
+
+                    % if defined('new_token'):
+                        <p>
+                            Nouveau jeton&nbsp;: <code>{{ new_token }}</code>
+                        </p>
+                        <p class="form-help">
+                            Copiez-le maintenant, il ne sera plus affiché. Il s'utilise à la place du login et du mot de passe, avec le paramètre POST <code>token</code>.
+                        </p>
+                    % end
+
+                    % if len(api_tokens) > 0:
+                        <table>
+                            <tr>
+                                <th>Nom</th>
+                                <th>Créé le</th>
+                                <th>Révoquer</th>
+                            </tr>
+                        % for token in api_tokens:
+                            <tr>
+                                <td>{{ token["name"] }}</td>
+                                <td>{{ token["created"] }}</td>
+                                <td>
+                                    <form method="post" action="/settings/api_tokens/{{ token["id"] }}/delete">
+                                        <input type="submit" value="Révoquer"/>
+                                    </form>
+                                </td>
+                            </tr>
+                        % end
+                        </table>
+                    % end
+
+                    <form method="post" action="/settings/api_tokens">
+                        <p class="form-item">
+                            <label for="token_name">Nom&nbsp;: </label>
+                            <input type="text" name="name" id="token_name"/>
+                        </p>
+                        <p>
+                            <input type="submit" value="Créer un jeton"/>
+                        </p>
+                    </form>
+                </article>
+
                 <article id="sensors">
                     <h2>Capteurs</h2>
 
@@ -3,20 +3,29 @@ import datetime
 import hashlib
 import json
 import os
+import redis
 import requests
 import subprocess
 import sys
+import threading
 
 
+from libcitizenwatt import auth
 from libcitizenwatt import cache
 from libcitizenwatt import database
+from libcitizenwatt import partitions
+from libcitizenwatt import ringbuffer
+from libcitizenwatt import tariffs
 from libcitizenwatt import tools
 from bottle import abort, Bottle, SimpleTemplate, static_file
-from bottle import redirect, request, run
+from bottle import redirect, request, response, run
 from bottle.ext import sqlalchemy
-from bottlesession import PickleSession, authenticator
+from bottlesession import MemorySession, PickleSession, RedisSession
+from bottlesession import authenticator
 from libcitizenwatt.config import Config
-from sqlalchemy import create_engine, desc
+from libcitizenwatt.sensors import base_addresses, MAX_SENSORS
+from libcitizenwatt.sensors import parse_base_address
+from sqlalchemy import create_engine
 from sqlalchemy.exc import OperationalError, ProgrammingError
 
 
@@ -26,21 +35,7 @@ from sqlalchemy.exc import OperationalError, ProgrammingError
 def get_rate_type(db):
     """Returns "day" or "night" according to current time"""
     session = session_manager.get_session()
-    user = db.query(database.User).filter_by(login=session.get("login")).first()
-    now = datetime.datetime.now()
-    now = 3600 * now.hour + 60 * now.minute
-    if user is None:
-        return None
-    elif user.end_night_rate > user.start_night_rate:
-        if now > user.start_night_rate and now < user.end_night_rate:
-            return "night"
-        else:
-            return "day"
-    else:
-        if now > user.start_night_rate or now < user.end_night_rate:
-            return "night"
-        else:
-            return "day"
+    return tariffs.rate_schedules.rate_type(session.get("login"), db)
 
 
 def update_providers(fetch, db):
@@ -78,25 +73,61 @@ def update_providers(fetch, db):
                                         current=(1 if old_current and old_current.name == provider["name"] else 0),
                                         threshold=int(provider["threshold"]))
         db.add(provider_db)
+    db.commit()
+    tariffs.provider_tariffs.invalidate()
+    cache.invalidate("providers")
     return providers
 
 
+def format_measures(data):
+    """Returns the list of measures <data> in the format asked by the client:
+    a list of measures by default, or a dict of columns if the request has a
+    format=columns query parameter.
+    """
+    if request.query.get("format") == "columns" and isinstance(data, list):
+        return tools.to_columns(data)
+    else:
+        return data
+
+
+def update_base_addresses(db):
+    """Updates the addresses receive.cpp listens on, from the base addresses
+    of all the sensors, and notifies process.py that the sensors changed.
+    """
+    tools.update_base_addresses(base_addresses(db))
+    cache.invalidate("sensors")
+
+
 def api_auth(post, db):
     """
-    Handles login authentication for API.
+    Handles login authentication for API, with an API token (issued from
+    /settings) or a login and password.
+
+    The credentials verified recently are not checked against the database
+    again, see auth.VerifiedCredentials.
 
     Returns True if login is ok, False otherwise.
     """
-    login = post.get("login")
-    user = db.query(database.User).filter_by(login=login).first()
+    token = post.get("token")
+    if token:
+        token_hash = auth.hash_token(token)
+        return auth.verified_credentials.check(
+            "token:" + token_hash,
+            lambda: (db.query(database.ApiToken)
+                     .filter_by(token_hash=token_hash)
+                     .first()) is not None)
 
+    login = post.get("login")
     password = (config.get("salt") +
                 hashlib.sha256(post.get("password", "").encode('utf-8'))
                 .hexdigest())
-    if user and user.password == password:
-        return True
-    else:
-        return False
+
+    def verify():
+        user = db.query(database.User).filter_by(login=login).first()
+        return user is not None and user.password == password
+    key = hashlib.sha256((str(login) + ":" + password).encode('utf-8'))
+    return auth.verified_credentials.check("password:" + key.hexdigest(),
+                                           verify)
 
 
 # ===============
@@ -119,9 +150,23 @@ plugin = sqlalchemy.Plugin(
 )
 app.install(plugin)
 
-session_manager = PickleSession()
+tariffs.provider_tariffs.listener = cache.InvalidationListener()
+tariffs.rate_schedules.listener = cache.InvalidationListener()
+auth.verified_credentials.listener = cache.InvalidationListener()
+partitions.registry.listener = cache.InvalidationListener()
+
+if config.get("session_store") == "memory":
+    session_manager = MemorySession()
+elif config.get("session_store") == "pickle":
+    session_manager = PickleSession()
+else:
+    session_manager = RedisSession(cache.get_redis(),
+                                   prefix="citizenwatt:session:")
 valid_user = authenticator(session_manager, login_url='/login')
 
+# Each client of /api/<sensor>/stream holds a server thread
+streams = threading.BoundedSemaphore(config.get("max_streams"))
+
 
 # ===
 # API
@@ -153,6 +198,50 @@ def api_sensors_post(db):
         abort(403, "Access forbidden")
 
 
+@app.route("/api/sensors/add",
+           method="post")
+def api_sensors_add_post(db):
+    """Adds a sensor, from its name, base address and AES key (16 numbers
+    between 0 and 255, separated by dashes).
+
+    Returns the new sensor."""
+    if not api_auth(request.POST, db):
+        abort(403, "Access forbidden")
+
+    name = request.POST.get("name", "").strip()
+    base_address_int = parse_base_address(request.POST.get("base_address"))
+    try:
+        aes_key = [int(i.strip()) for i in
+                   request.POST.get("aes_key", "").split("-")]
+        if len(aes_key) != 16 or max(aes_key) > 255 or min(aes_key) < 0:
+            raise ValueError
+    except ValueError:
+        abort(400, "Invalid AES key.")
+    if not name or base_address_int is None:
+        abort(400, "Invalid parameters")
+    if db.query(database.Sensor).filter_by(name=name).first():
+        abort(400, "A sensor with this name already exists.")
+    if len(base_addresses(db)) >= MAX_SENSORS:
+        abort(400, "The base can not receive more than " +
+              str(MAX_SENSORS) + " sensors.")
+
+    electricity_type = (db.query(database.Sensor)
+                        .filter_by(name="CitizenWatt")
+                        .first()
+                        .type_id)
+    sensor = database.Sensor(name=name,
+                             type_id=electricity_type,
+                             last_timer=0,
+                             aes_key=json.dumps(aes_key),
+                             base_address=(str(hex(base_address_int))
+                                           .upper() + "LL"))
+    db.add(sensor)
+    db.commit()
+    update_base_addresses(db)
+
+    return api_sensor(sensor.id, db)
+
+
 @app.route("/api/sensors/<id:int>",
            apply=valid_user())
 def api_sensor(id, db):
@@ -224,6 +313,25 @@ def api_time_post(db):
         abort(403, "Access forbidden")
 
 
+@app.route("/api/cache_stats",
+           apply=valid_user())
+def api_cache_stats(db):
+    """
+    Returns the number of lookups, misses and the hit rate of the cache, per
+    kind of API call (by_id, by_id_step, by_time) and for the buckets of
+    by_time calls with a step."""
+    return {"data": cache.cache_stats()}
+
+
+@app.route("/api/cache_stats",
+           method="post")
+def api_cache_stats_post(db):
+    if api_auth(request.POST, db):
+        return api_cache_stats(db)
+    else:
+        abort(403, "Access forbidden")
+
+
 @app.route("/api/<sensor:int>/get/watts/by_id/<id1:int>",
            apply=valid_user())
 def api_get_id(sensor, id1, db):
@@ -235,20 +343,20 @@ def api_get_id(sensor, id1, db):
     If no matching data is found, returns null.
     """
     if id1 >= 0:
-        data = (db.query(database.Measures)
-                .filter_by(sensor_id=sensor, id=id1)
-                .first())
+        data = ringbuffer.registry.by_id(sensor, id1)
+        if data is None:
+            source = partitions.registry.source(db, sensor)
+            data = (cache.query_measures(db, source)
+                    .filter(source.c.sensor_id == sensor,
+                            source.c.id == id1)
+                    .all())
     else:
-        data = (db.query(database.Measures)
-                .filter_by(sensor_id=sensor)
-                .order_by(desc(database.Measures.timestamp))
-                .slice(-id1, -id1)
-                .first())
+        last, data = cache.recent_positions(db, sensor, id1, id1 + 1)
 
     if not data:
         data = None
     else:
-        data = tools.to_dict(data)
+        data = cache.measures_to_dict(data, sensor)[0]
 
     return {"data": data, "rate": get_rate_type(db)}
 
@@ -262,6 +370,56 @@ def api_get_id_post(sensor, id1, db):
         abort(403, "Access forbidden")
 
 
+@app.route("/api/<sensor:int>/stream",
+           apply=valid_user())
+def api_stream(sensor, db):
+    """
+    Server-sent events stream of the new measures of sensor <sensor>, in
+    watts, as published by process.py.
+
+    Each event holds the measure and the current rate, as
+    {"data": measure, "rate": "day"|"night"}. The last measure is sent
+    first. A comment is sent every 15s to keep the connection open.
+
+    At most max_streams streams are served at once, so that they leave
+    server threads for the other requests.
+    """
+    if not streams.acquire(blocking=False):
+        abort(503, "Too many live streams, retry later.")
+    r = cache.get_redis()
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(cache.MEASURES_CHANNEL + str(sensor))
+        last_measure = r.get(cache.KEY_PREFIX + ":last_measure:" +
+                             str(sensor))
+    except redis.ConnectionError:
+        pubsub.close()
+        streams.release()
+        abort(503, "Live measures are not available.")
+
+    response.content_type = "text/event-stream"
+    response.set_header("Cache-Control", "no-cache")
+
+    def stream():
+        try:
+            # Reconnect after a timestep if the connection is lost
+            yield ("retry: " + str(config.get("default_timestep") * 1000) +
+                   "\n\n")
+            if last_measure:
+                yield "data: " + last_measure + "\n\n"
+            while True:
+                message = pubsub.get_message(timeout=15)
+                if message:
+                    yield "data: " + message["data"] + "\n\n"
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            pubsub.close()
+            streams.release()
+
+    return stream()
+
+
 @app.route("/api/<sensor:int>/get/<watt_euros:re:watts|kwatthours|euros>/by_id/<id1:int>/<id2:int>",
            apply=valid_user())
 def api_get_ids(sensor, watt_euros, id1, id2, db):
@@ -271,7 +429,8 @@ def api_get_ids(sensor, watt_euros, id1, id2, db):
 
     If id1 and id2 are negative, counts from the end of the measures.
 
-    * If `watts_euros` is watts, returns the list of measures.
+    * If `watts_euros` is watts, returns the list of measures, or a dict of
+    columns with ?format=columns.
     * If `watt_euros` is kwatthours, returns the total energy for all the
     measures (dict).
     * If `watt_euros` is euros, returns the cost of all the measures (dict).
@@ -289,7 +448,7 @@ def api_get_ids(sensor, watt_euros, id1, id2, db):
     else:
         data = cache.do_cache_ids(sensor, watt_euros, id1, id2, db)
 
-    return {"data": data, "rate": get_rate_type(db)}
+    return {"data": format_measures(data), "rate": get_rate_type(db)}
 
 
 @app.route("/api/<sensor:int>/get/<watt_euros:re:watts|kwatthours|euros>/by_id/<id1:int>/<id2:int>",
@@ -360,14 +519,15 @@ def api_get_time(sensor, time1, db):
     if time1 < 0:
         abort(400, "Invalid timestamp.")
 
-    data = (db.query(database.Measures)
-            .filter_by(sensor_id=sensor,
-                       timestamp=time1)
+    source = partitions.registry.source(db, sensor, time1, time1)
+    data = (cache.query_measures(db, source)
+            .filter(source.c.sensor_id == sensor,
+                    source.c.timestamp == time1)
             .first())
     if not data:
         data = None
     else:
-        data = tools.to_dict(data)
+        data = cache.measures_to_dict([data], sensor)[0]
 
     return {"data": data, "rate": get_rate_type(db)}
 
@@ -388,7 +548,8 @@ def api_get_times(sensor, watt_euros, time1, time2, db):
     Returns measures between timestamps <time1> and <time2>
     from sensor <sensor> in watts or euros.
 
-    * If `watts_euros` is watts, returns the list of measures.
+    * If `watts_euros` is watts, returns the list of measures, or a dict of
+    columns with ?format=columns.
     * If `watt_euros` is kwatthours, returns the total energy for all the
     measures (dict).
     * If `watt_euros` is euros, returns the cost of all the measures (dict).
@@ -402,7 +563,7 @@ def api_get_times(sensor, watt_euros, time1, time2, db):
 
     data = cache.do_cache_times(sensor, watt_euros, time1, time2, db)
 
-    return {"data": data, "rate": get_rate_type(db)}
+    return {"data": format_measures(data), "rate": get_rate_type(db)}
 
 
 @app.route("/api/<sensor:int>/get/<watt_euros:re:watts|kwatthours|euros>/by_time/<time1:float>/<time2:float>",
@@ -426,17 +587,25 @@ def api_get_times_step(sensor, watt_euros, time1, time2, step, db):
     * If `watt_euros` is kwatthours, returns the total energy for each group.
     * If `watt_euros` is euros, returns the cost of each group.
 
+    With ?align=minute|hour|day|month, the groups are snapped to this unit of
+    the local time of the base (e.g. whole hours), starting from the
+    boundary nearest to `time1`.
+
     Returns measure in ASC order of timestamp.
     """
+    align = request.query.get("align")
     if time1 < 0 or time2 < 0 or step <= 0:
         abort(400, "Invalid parameters")
+    elif align is not None and align not in tools.ALIGN_UNITS:
+        abort(400, "Invalid alignment.")
 
     data = cache.do_cache_group_timestamp(sensor,
                                           watt_euros,
                                           time1,
                                           time2,
                                           step,
-                                          db)
+                                          db,
+                                          align)
 
     return {"data": data, "rate": get_rate_type(db)}
 
@@ -595,6 +764,8 @@ def conso(db):
 @app.route("/reset_timer/<sensor:int>", apply=valid_user())
 def reset_timer(sensor, db):
     db.query(database.Sensor).filter_by(id=sensor).update({"last_timer": 0})
+    db.commit()
+    cache.invalidate("sensors")
     redirect("/settings")
 
 
@@ -627,9 +798,18 @@ def settings(db):
                         "%02d" % ((user.start_night_rate % 3600) // 60))
     end_night_rate = ("%02d" % (user.end_night_rate // 3600) + ":" +
                       "%02d" % ((user.end_night_rate % 3600) // 60))
+    api_tokens = [{"id": token.id,
+                   "name": token.name,
+                   "created": datetime.datetime.fromtimestamp(token.created)
+                   .strftime("%d/%m/%Y %H:%M")}
+                  for token in (db.query(database.ApiToken)
+                                .filter_by(user_id=user.id)
+                                .order_by(database.ApiToken.id)
+                                .all())]
 
     return {"sensors": sensors,
             "providers": providers,
+            "api_tokens": api_tokens,
             "start_night_rate": start_night_rate,
             "end_night_rate": end_night_rate,
             "base_address": sensor_cw["base_address"],
@@ -657,6 +837,9 @@ def settings_post(db):
              .filter_by(login=session["login"])
              .update({"password": password},
                      synchronize_session=False))
+            db.commit()
+            auth.verified_credentials.invalidate()
+            cache.invalidate("credentials")
         else:
             error = {"title": "Les mots de passe ne sont pas identiques.",
                      "content": ("Les deux mots de passe doient " +
@@ -669,6 +852,9 @@ def settings_post(db):
     provider = (db.query(database.Provider)
                 .filter_by(name=provider)
                 .update({"current": 1}))
+    db.commit()
+    tariffs.provider_tariffs.invalidate()
+    cache.invalidate("providers")
 
     raw_start_night_rate = request.forms.get("start_night_rate")
     raw_end_night_rate = request.forms.get("end_night_rate")
@@ -686,10 +872,6 @@ def settings_post(db):
         settings_json.update({"err": error})
         return settings_json
 
-    sensor = db.query(database.Sensor).filter_by(name="CitizenWatt").first()
-    if base_address != sensor.base_address:
-        tools.update_base_address(base_address_int)
-
     try:
         aes_key = [int(i.strip()) for i in raw_aes_key.split("-")]
         if len(aes_key) != 16:
@@ -706,6 +888,7 @@ def settings_post(db):
      .filter_by(name="CitizenWatt")
      .update({"base_address": base_address, "aes_key": json.dumps(aes_key)}))
     db.commit()
+    update_base_addresses(db)
 
     try:
         start_night_rate = raw_start_night_rate.split(":")
@@ -741,10 +924,50 @@ def settings_post(db):
      .filter_by(login=session["login"])
      .update({"start_night_rate": start_night_rate,
               "end_night_rate": end_night_rate}))
+    db.commit()
+    cache.invalidate("night_rate")
 
     redirect("/settings")
 
 
+@app.route("/settings/api_tokens",
+           template="settings",
+           apply=valid_user(),
+           method="post")
+def api_tokens_post(db):
+    """Issues a new API token, shown only once"""
+    session = session_manager.get_session()
+    user = db.query(database.User).filter_by(login=session["login"]).first()
+    name = request.forms.get("name", "").strip() or "API"
+
+    token = auth.new_token()
+    db.add(database.ApiToken(user_id=user.id,
+                             name=name,
+                             token_hash=auth.hash_token(token),
+                             created=int(datetime.datetime.now().timestamp())))
+    db.commit()
+
+    settings_json = settings(db)
+    settings_json.update({"new_token": token})
+    return settings_json
+
+
+@app.route("/settings/api_tokens/<id:int>/delete",
+           apply=valid_user(),
+           method="post")
+def api_token_delete(id, db):
+    """Revokes an API token"""
+    session = session_manager.get_session()
+    user = db.query(database.User).filter_by(login=session["login"]).first()
+    (db.query(database.ApiToken)
+     .filter_by(id=id, user_id=user.id)
+     .delete())
+    db.commit()
+    auth.verified_credentials.invalidate()
+    cache.invalidate("credentials")
+    redirect("/settings")
+
+
 @app.route("/update", name="update")
 def update():
     """Handles updating"""
@@ -852,6 +1075,9 @@ def install(db):
                              type_id=electricity_type.id,
                              last_timer=0)
     db.add(sensor)
+    db.commit()
+    cache.invalidate("sensors")
+    cache.invalidate("credentials")
 
     return {"login": '',
             "providers": providers,
@@ -903,7 +1129,7 @@ def install_post(db):
                  "content": ("L'adresse de la base entrée est invalide.")}
         ret.update({"err": error})
         return ret
-    tools.update_base_address(base_address_int)
+    tools.update_base_addresses([base_address_int])
     try:
         aes_key = [int(i.strip()) for i in raw_aes_key.split("-")]
         if len(aes_key) != 16:
@@ -919,6 +1145,7 @@ def install_post(db):
      .filter_by(name="CitizenWatt")
      .update({"base_address": base_address, "aes_key": json.dumps(aes_key)}))
     db.commit()
+    cache.invalidate("sensors")
 
     try:
         start_night_rate = raw_start_night_rate.split(":")
@@ -961,6 +1188,10 @@ def install_post(db):
         provider = (db.query(database.Provider)
                     .filter_by(name=provider)
                     .update({"current": 1}))
+        db.commit()
+        tariffs.provider_tariffs.invalidate()
+        cache.invalidate("night_rate")
+        cache.invalidate("providers")
 
         session = session_manager.get_session()
         session['valid'] = True
@@ -983,5 +1214,7 @@ if __name__ == '__main__':
     SimpleTemplate.defaults["get_url"] = app.get_url
     SimpleTemplate.defaults["API_URL"] = app.get_url("index")
     SimpleTemplate.defaults["valid_session"] = lambda: session_manager.get_session()['valid']
+    # Each client of /api/<sensor>/stream holds a thread
     run(app, host="0.0.0.0", port=config.get("port"), debug=config.get("debug"),
-        reloader=config.get("autoreload"), server="cherrypy")
+        reloader=config.get("autoreload"), server="cherrypy",
+        numthreads=config.get("server_threads"))
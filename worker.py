@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""Precomputes the views of the dashboard in the cache, right after each
+flush of new measures by process.py, so that visu.py never computes them
+on the request path.
+
+Also deletes the expired measures in the background (see
+libcitizenwatt/retention.py)."""
+
+import datetime
+import redis
+import threading
+import time
+
+from libcitizenwatt import cache
+from libcitizenwatt import database
+from libcitizenwatt import partitions
+from libcitizenwatt import retention
+from libcitizenwatt import tariffs
+from libcitizenwatt import tools
+from libcitizenwatt.config import Config
+from sqlalchemy import create_engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker
+
+
+# Units of the aligned views of the dashboard, watts being only used by
+# the live view
+DASHBOARD_UNITS = ["kwatthours", "euros"]
+
+
+def views(now=None):
+    """Returns the (time1, time2, step, align) of the aligned by_time calls
+    of the dashboard (see static/js/conso/App.js) at <now>: today by hour,
+    this week by day and this month by day.
+    """
+    if now is None:
+        now = datetime.datetime.now().timestamp()
+    today = tools.floor_date(now, "day")
+    week = today - datetime.timedelta(days=today.weekday())
+    month = tools.floor_date(now, "month")
+    return [(today.timestamp(),
+             tools.next_date(today, "day").timestamp(),
+             3600,
+             "hour"),
+            # As App.js, a week lasts 7 * 86400s, even across DST changes
+            (week.timestamp(),
+             week.timestamp() + 7 * 86400,
+             86400,
+             "day"),
+            (month.timestamp(),
+             tools.next_date(month, "month").timestamp(),
+             86400,
+             "day")]
+
+
+def precompute(db):
+    """Computes the aligned views of the dashboard for all the sensors and
+    stores them in the cache. The closed buckets already cached are reused.
+    """
+    for sensor in db.query(database.Sensor).all():
+        for time1, time2, step, align in views():
+            cache.precompute_group_timestamp(sensor.id, time1, time2, step,
+                                             align, db, DASHBOARD_UNITS)
+
+
+def compaction():
+    """Deletes the expired measures every compaction_interval."""
+    while True:
+        start = time.monotonic()
+        db = create_session()
+        try:
+            count = retention.compact(db)
+        except Exception as e:
+            # Keeps the thread alive whatever the error
+            db.rollback()
+            tools.warning("Unable to delete the expired measures: " + str(e))
+        else:
+            if count:
+                print("Deleted " + str(count) + " expired rows in %.3fs." %
+                      (time.monotonic() - start))
+        finally:
+            db.close()
+        time.sleep(config.get("compaction_interval"))
+
+
+# Configuration
+config = Config()
+
+# DB initialization
+database_url = (config.get("database_type") + "://" + config.get("username") +
+                ":" + config.get("password") + "@" + config.get("host") + "/" +
+                config.get("database"))
+engine = create_engine(database_url, echo=config.get("debug"))
+create_session = sessionmaker(bind=engine)
+
+tariffs.provider_tariffs.listener = cache.InvalidationListener()
+tariffs.rate_schedules.listener = cache.InvalidationListener()
+partitions.registry.listener = cache.InvalidationListener()
+listener = cache.InvalidationListener()
+threading.Thread(target=compaction, daemon=True).start()
+while True:
+    # New measures, new tariffs, or refresh every precompute_interval to
+    # follow the beginning of a new day
+    topics = listener.poll(config.get("precompute_interval"))
+    if topics and not topics & set(["measures", "providers", cache.ALL]):
+        continue
+
+    start = time.monotonic()
+    db = create_session()
+    try:
+        precompute(db)
+    except (SQLAlchemyError, redis.ConnectionError) as e:
+        tools.warning("Unable to precompute the views: " + str(e))
+        time.sleep(config.get("precompute_interval"))
+    else:
+        print("Precomputed the views in %.3fs." %
+              (time.monotonic() - start))
+    finally:
+        db.close()